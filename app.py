@@ -1,54 +1,41 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, session, Response, abort, g, stream_with_context
 from datetime import datetime, timedelta
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired
-import sqlite3
 import os
-import pandas as pd
 from werkzeug.utils import secure_filename
-from read_excel import process_excel_file
 from functools import wraps
 import time
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 import uuid
 import threading
+import json
+import hashlib
+import csv
+import io
+import tempfile
 from auth_client import AuthClient
-from readers.santander import SantanderReader
-from readers.itau import ItauReader
-import re
+import assets
+import compression
+import db
+import metrics
+import profiling
+import jobs
+import maintenance
+import scheduler
+from categories import CATEGORY_IDS, VIEW_CATEGORIES, filter_category_ids, view_category
+from cnpj import cnpj_cache, failed_cnpjs, get_company_info, retry_failed_cnpjs as retry_cnpj_lookups
+from fts import detect_fts, description_match
+from reconcile import AF_COMPANIES, AF_DESCRIPTION_EXCLUSIONS, internal_match
+from migrations import setup_schema
+from logs import get_logger
 
 app = Flask(__name__)
+logger = get_logger('app')
 app.config['SECRET_KEY'] = 'your-secret-key-here'
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=1)  # Set session lifetime to 1 hour
 
 # Global variables
 upload_progress = {}  # Dictionary to track file upload progress
-cnpj_cache = {}  # Cache for storing company information 
-failed_cnpjs = set()  # Set for storing failed CNPJs
-
-AF_COMPANIES = {
-    '50389827000107': 'AF ENERGY SOLAR 360',
-    '43077430000114': 'AF 360 CORRETORA DE SEGUROS LTDA',
-    '53720093000195': 'AF CREDITO BANK',
-    '55072511000100': 'AF COMERCIO DE CALCADOS LTDA',
-    '17814862000150': 'AF 360 FRANQUIAS LTDA'
-}
-
-PRIMARY_TYPES = ['PIX RECEBIDO', 'TED RECEBIDA', 'PAGAMENTO']
-
-TYPE_MAPPING = {
-    'APLICACAO': 'CONTAMAX',
-    'RESGATE': 'CONTAMAX',
-    'COMPENSACAO': 'CHEQUE',
-    'COMPRA': 'CARTAO',
-    'TAXA': 'DESPESAS OPERACIONAIS',
-    'TARIFA': 'DESPESAS OPERACIONAIS',
-    'IOF': 'DESPESAS OPERACIONAIS',
-    'MULTA': 'DESPESAS OPERACIONAIS',
-    'DEBITO': 'DESPESAS OPERACIONAIS',
-}
 
 # Initialize AuthClient
 auth_client = AuthClient(
@@ -56,6 +43,8 @@ auth_client = AuthClient(
     app_name=os.getenv('APP_NAME', 'financeiro')
 )
 auth_client.init_app(app)
+assets.init_app(app)
+compression.init_app(app)
 
 # Ensure the upload and instance folders exist
 for folder in ['instance', 'uploads']:
@@ -67,13 +56,39 @@ RATE_LIMIT_WINDOW = 60  # seconds
 REQUEST_LIMIT = 60      # requests per window
 request_history = {}
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    """Observe the route latency once the response (streamed or not) is sent"""
+    start = g.get('request_start')
+    if start is not None:
+        labels = {
+            'method': request.method,
+            'route': request.url_rule.rule if request.url_rule else 'unmatched',
+            'status': response.status_code
+        }
+        response.call_on_close(
+            lambda: metrics.REQUEST_DURATION.observe(time.perf_counter() - start, **labels))
+    return response
+
+def verify_token(token):
+    """auth_client.verify_token with its latency recorded"""
+    start = time.perf_counter()
+    verification = auth_client.verify_token(token)
+    result = 'valid' if verification and verification.get('valid') else 'invalid'
+    metrics.AUTH_DURATION.observe(time.perf_counter() - start, result=result)
+    return verification
+
 @app.route('/auth')
 def auth():
     token = request.args.get('token')
     if not token:
         return redirect('https://af360bank.onrender.com/login')
     
-    verification = auth_client.verify_token(token)
+    verification = verify_token(token)
     if not verification or not verification.get('valid'):
         return redirect('https://af360bank.onrender.com/login')
     
@@ -91,7 +106,7 @@ def login_required(f):
         if not token:
             return redirect('https://af360bank.onrender.com/login')
         
-        verification = auth_client.verify_token(token)
+        verification = verify_token(token)
         if not verification or not verification.get('valid'):
             session.clear()
             return redirect('https://af360bank.onrender.com/login')
@@ -121,88 +136,42 @@ def rate_limit():
         return wrapped
     return decorator
 
-# Database connection helper
+# Database connection helper (per-thread connection, see db.py)
 def get_db_connection():
-    # Ensure instance directory exists
-    os.makedirs('instance', exist_ok=True)
-    conn = sqlite3.connect('instance/financas.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    return db.get_connection()
 
 # Database initialization
-def init_db():
+def init_db(migrate=True):
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Create tables
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date DATE NOT NULL,
-            description TEXT NOT NULL,
-            value REAL NOT NULL,
-            type TEXT NOT NULL,
-            transaction_type TEXT NOT NULL,
-            document TEXT
-        )
-    ''')
-    
-    # Create indexes
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions(date)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_type ON transactions(type)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_document ON transactions(document)')
-    
-    conn.commit()
+    if migrate:
+        setup_schema(conn)
+    detect_fts(conn.cursor())
     conn.close()
 
-# Initialize the database when the app starts
-init_db()
+# Under gunicorn the master migrated the database before forking the
+# workers (gunicorn.conf.py); otherwise migrate when the app starts
+init_db(migrate=os.getenv('SCHEMA_READY') != '1')
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'xls', 'xlsx'}
-
-def get_company_info(cnpj):
-    """Fetch company information using cache if available"""
-    # Normalize CNPJ
-    cnpj = ''.join(filter(str.isdigit, cnpj))
-    if len(cnpj) == 15 and cnpj.startswith('0'):
-        cnpj = cnpj[1:]
-    
-    # Check cache first
-    if cnpj in cnpj_cache:
-        return cnpj_cache[cnpj]
-    
-    try:
-        session = requests.Session()
-        retries = Retry(total=3, backoff_factor=0.5)
-        session.mount('https://', HTTPAdapter(max_retries=retries))
-        
-        response = session.get(f'https://brasilapi.com.br/api/cnpj/v1/{cnpj}', timeout=10)
-        if response.status_code == 200:
-            company_info = response.json()
-            cnpj_cache[cnpj] = company_info
-            if cnpj in failed_cnpjs:
-                failed_cnpjs.remove(cnpj)
-            return company_info
-        else:
-            failed_cnpjs.add(cnpj)
-            print(f"Failed to fetch CNPJ {cnpj}: Status {response.status_code}")
-    except Exception as e:
-        print(f"Error fetching company information for {cnpj}: {str(e)}")
-        failed_cnpjs.add(cnpj)
-    return None
+# Columnar read cache of the ledger views (ledger_cache.py); off by
+# default, so the workers start without numpy
+if os.getenv('LEDGER_CACHE') == '1':
+    import ledger_cache
+else:
+    ledger_cache = None
 
-def format_company_info(company_info, cnpj):
-    """Format company info for display"""
-    return {
-        'cnpj': cnpj,
-        'nome_fantasia': company_info.get('nome_fantasia', ''),
-        'razao_social': company_info.get('razao_social', ''),
-        'formatted_name': (
-            company_info.get('nome_fantasia') or 
-            company_info.get('razao_social', '')
-        ) + f" (CNPJ: {cnpj})"
-    }
+# Background maintenance (scheduler.py); off in the benchmarks
+if os.getenv('SCHEDULER_ENABLED', '1') == '1':
+    scheduler.start()
+
+def get_data_generation(conn):
+    """Return the current data generation of the ledger"""
+    row = conn.execute('SELECT generation FROM ledger_state WHERE id = 1').fetchone()
+    return row[0] if row else 0
+
+def allowed_file(filename):
+    # readers (and pandas) are only imported by the upload path
+    import readers
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in readers.supported_extensions()
 
 def is_af_company_transaction(description):
     """Check if transaction description contains an AF company name"""
@@ -219,6 +188,8 @@ def index():
 @login_required
 @rate_limit()
 def upload_file():
+    import readers
+
     try:
         if not session.get('authenticated'):
             return redirect('https://af360bank.onrender.com/login')
@@ -234,11 +205,34 @@ def upload_file():
         
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
+            tmp_path, sha256, size = save_upload(file, filename)
+            
+            # The same file again (after a timeout, a second click...):
+            # answer with the import that already ran or is running
+            known = jobs.get_statement_file(sha256)
+            if known is not None and not jobs.can_reimport(known):
+                os.remove(tmp_path)
+                return duplicate_upload_response(known)
+            
+            # Detect the layout from the first rows; the bank chosen in the
+            # form is only used when no reader recognizes the file
+            reader = readers.detect_reader(tmp_path) or readers.get_reader(bank_type, tmp_path)
+            if reader is None:
+                os.remove(tmp_path)
+                return jsonify({'success': False, 'message': 'Formato de extrato não reconhecido'})
             
-            # Initialize progress
             process_id = str(uuid.uuid4())
+            owner = jobs.new_owner()
+            # Stored under its hash: concurrent uploads never overwrite each other
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], sha256 + os.path.splitext(tmp_path)[1])
+            known = jobs.claim_statement_file(sha256, reader.bank, filename, size, process_id,
+                                              filepath, owner)
+            if known is not None:
+                os.remove(tmp_path)
+                return duplicate_upload_response(known)
+            os.replace(tmp_path, filepath)
+            
+            # Initialize progress
             upload_progress[process_id] = {
                 'status': 'processing',
                 'current': 0,
@@ -246,18 +240,13 @@ def upload_file():
                 'message': 'Iniciando processamento...'
             }
             
-            # Select reader based on bank type
-            if bank_type == 'santander':
-                reader = SantanderReader()
-            elif bank_type == 'itau':
-                reader = ItauReader()
-            else:
-                return jsonify({'success': False, 'message': 'Banco não suportado'})
+            # Optional cProfile dump of the whole import
+            cprofile = CPROFILE_IMPORTS or request.form.get('profile') == '1'
             
             # Process file in separate thread
             thread = threading.Thread(
-                target=reader.process_file, 
-                args=(filepath, process_id, upload_progress)
+                target=run_import, 
+                args=(reader, filepath, process_id, owner, cprofile, sha256)
             )
             thread.start()
             
@@ -272,242 +261,286 @@ def upload_file():
     except Exception as e:
         return jsonify({'success': False, 'message': f'Erro ao processar arquivo: {str(e)}'})
 
-def find_matching_column(df, column_names):
-    for col in df.columns:
-        if col.upper() in [name.upper() for name in column_names]:
-            return col
-    return None
-
-def extract_transaction_info(description, value):
-    transaction_info = {
-        'description': description,
-        'tipo': None,
-        'document': None
-    }
-    
-    # Detecta o tipo de transação e CNPJ
-    if 'PIX' in description.upper():
-        transaction_info['tipo'] = 'PIX RECEBIDO' if value > 0 else 'PIX ENVIADO'
-    elif 'TED' in description.upper():
-        transaction_info['tipo'] = 'TED RECEBIDA' if value > 0 else 'TED ENVIADA'
-    elif 'PAGAMENTO' in description.upper():
-        transaction_info['tipo'] = 'PAGAMENTO'
-    
-    # Extrai CNPJ se presente
-    if transaction_info['tipo']:
-        enriched_description = extract_and_enrich_cnpj(description, transaction_info['tipo'])
-        transaction_info['description'] = enriched_description
-    
-    return transaction_info
-
-def process_date(date_val):
-    """Process date values from Excel"""
-    if pd.isna(date_val):
-        return None
-        
-    try:
-        if isinstance(date_val, str):
-            try:
-                return datetime.strptime(date_val, '%d/%m/%Y').date()
-            except ValueError:
-                try:
-                    return datetime.strptime(date_val, '%Y-%m-%d').date()
-                except ValueError:
-                    return None
-        elif isinstance(date_val, datetime):
-            return date_val.date()
-        else:
-            return pd.to_datetime(date_val).date()
-    except:
-        return None
-
-def process_value(value):
-    """Process monetary values from Excel"""
-    if pd.isna(value):
-        return None
-        
-    try:
-        if isinstance(value, (int, float)):
-            return float(value)
-        else:
-            value_str = str(value).replace('R$', '').strip()
-            return float(value_str.replace('.', '').replace(',', '.'))
-    except:
-        return None
-
-def extract_cnpj(description):
-    """Extract CNPJ from description"""
-    import re
-    
-    cnpj_patterns = [
-        r'CNPJ[:\s]*(\d{14,15})',
-        r'CNPJ[:\s]*(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})',
-        r'\b(\d{14,15})\b',
-        r'\b(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})\b'
-    ]
-    
-    for pattern in cnpj_patterns:
-        match = re.search(pattern, description)
-        if match:
-            cnpj = ''.join(filter(str.isdigit, match.group(1)))
-            if len(cnpj) == 15 and cnpj.startswith('0'):
-                return cnpj[1:]
-            elif len(cnpj) == 14:
-                return cnpj
-    return None
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def save_upload(file, filename):
+    """Save an upload to a temporary file, hashing it on the way.
+
+    Returns (path, sha256, size); the path keeps the file extension so
+    the readers can detect the layout.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    extension = os.path.splitext(filename)[1].lower()
+    tmp_path = os.path.join(app.config['UPLOAD_FOLDER'], f'.upload-{uuid.uuid4().hex}{extension}')
+    with open(tmp_path, 'wb') as out:
+        while True:
+            chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    return tmp_path, digest.hexdigest(), size
+
+def duplicate_upload_response(known):
+    """Upload answer pointing at the job of a file uploaded before"""
+    if known['status'] == 'completed':
+        message = f"Este arquivo já foi importado em {known['finished_at']}: {known['message']}"
+    else:
+        message = 'Este arquivo já está sendo processado'
+    return jsonify({
+        'success': True,
+        'process_id': known['job_id'],
+        'duplicate': True,
+        'message': message
+    })
 
-def process_file_with_progress(filepath, process_id):
+# Write a cProfile dump for every import, not only when the upload asks for it
+CPROFILE_IMPORTS = os.getenv('INGEST_CPROFILE') == '1'
+PROFILES_FOLDER = os.path.join(os.path.dirname(db.DATABASE_PATH) or '.', 'profiles')
+
+active_profiles = {}  # process_id -> IngestProfile of the imports running
+running_imports = {}  # process_id -> owner token of the imports running in this process
+finished_imports = {}  # process_id -> time.monotonic() when the import ended
+
+def run_import(reader, filepath, process_id, owner, cprofile=False, sha256=None):
+    """Import a file in this thread, profiling it, and record the job result"""
+    import ingest
+
+    profile_path = os.path.join(PROFILES_FOLDER, f'{process_id}.prof') if cprofile else None
+    profile = profiling.IngestProfile(cprofile_path=profile_path)
+    active_profiles[process_id] = profile
+    running_imports[process_id] = owner
+    profiling.activate(profile)
+    superseded = False
+    rows = None
     try:
-        print(f"Iniciando processamento do arquivo: {filepath}")
-        
-        # First read without header
-        df_init = pd.read_excel(filepath, header=None)
-        header_row = None
-        
-        # Find header row
-        for idx, row in df_init.iterrows():
-            row_values = [str(x).strip() for x in row if pd.notna(x)]
-            if not row_values:
-                continue
-            if 'Data' in row_values and 'Histórico' in row_values:
-                header_row = idx
-                break
-        
-        if header_row is None:
-            raise Exception("Header 'Data' não encontrado")
-        
-        # Re-read with header
-        df = pd.read_excel(filepath, skiprows=header_row)
-        df.columns = [str(col).strip() for col in df.columns]
-        
-        # Initialize progress
-        total_rows = len(df)
-        upload_progress[process_id] = {
-            'total': total_rows,
-            'current': 0,
-            'status': 'processing',
-            'message': 'Lendo arquivo...'
-        }
-        
-        # Find required columns
-        data_col = find_matching_column(df, ['Data'])
-        desc_col = find_matching_column(df, ['Histórico'])
-        valor_col = find_matching_column(df, ['Valor (R$)', 'Valor'])
-        
-        if not all([data_col, desc_col, valor_col]):
-            raise Exception(f"Colunas necessárias não encontradas. Colunas disponíveis: {df.columns.tolist()}")
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        processed_rows = 0
-        for index, row in df.iterrows():
-            try:
-                # Process date
-                date = process_date(row[data_col])
-                if date is None:
-                    continue
-                    
-                # Process description and value
-                description = str(row[desc_col]).strip()
-                value = process_value(row[valor_col])
-                
-                if not description or value is None:
-                    continue
-                
-                # Detect transaction type and get CNPJ info
-                transaction_type = detect_transaction_type(description, value)
-                enriched_description = extract_and_enrich_cnpj(description, transaction_type)
-                cnpj = extract_cnpj(description)
-                
-                # Insert transaction
-                cursor.execute('''
-                    INSERT INTO transactions (date, description, value, type, transaction_type, document)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (
-                    date.strftime('%Y-%m-%d'),
-                    enriched_description,
-                    value,
-                    transaction_type,
-                    'receita' if value > 0 else 'despesa',
-                    cnpj
-                ))
-                
-                processed_rows += 1
-                upload_progress[process_id]['current'] = index + 1
-                
-            except Exception as e:
-                print(f"Error processing row {index}: {str(e)}")
-                continue
-        
-        # Cleanup paired transactions
-        deleted_count = cleanup_paired_transactions(conn)
-        
-        conn.commit()
-        conn.close()
-        os.remove(filepath)
-        
+        rows = ingest.import_statement(reader, filepath, upload_progress[process_id], process_id, owner)
+    except jobs.ImportSuperseded:
+        # Taken as dead and resumed elsewhere: the other run records the result
+        superseded = True
+        logger.warning("Importação %s retomada por outro processo", process_id)
         upload_progress[process_id].update({
-            'status': 'completed',
-            'message': f'Processamento concluído! {processed_rows} transações importadas, {deleted_count} transações duplicadas removidas.'
+            'status': 'processing',
+            'message': 'Importação retomada por outro processo'
         })
-        
     except Exception as e:
-        print(f"General processing error: {str(e)}")
+        logger.error("Erro na importação %s: %s", process_id, e)
         upload_progress[process_id].update({
             'status': 'error',
             'message': f'Error: {str(e)}'
         })
-
-def detect_transaction_type(description, value):
-    """Detect transaction type from description and value"""
-    description_upper = description.upper()
-    
-    # Check for PAGAMENTO first
-    if 'PAGAMENTO' in description_upper:
-        return 'PAGAMENTO'
-        
-    # Check PIX and TED
-    if 'PIX' in description_upper:
-        return 'PIX RECEBIDO' if value > 0 else 'PIX ENVIADO'
-    elif 'TED' in description_upper:
-        return 'TED RECEBIDA' if value > 0 else 'TED ENVIADA'
-        
-    # Secondary types
-    for tipo, keywords in {
-        'TARIFA': ['TARIFA', 'TAR'],
-        'IOF': ['IOF'],
-        'RESGATE': ['RESGATE'],
-        'APLICACAO': ['APLICACAO', 'APLICAÇÃO'],
-        'COMPRA': ['COMPRA'],
-        'COMPENSACAO': ['COMPENSACAO', 'COMPENSAÇÃO'],
-        'CHEQUE': ['CHEQUE'],
-        'JUROS': ['JUROS'],
-        'MULTA': ['MULTA']
-    }.items():
-        if any(keyword in description_upper for keyword in keywords):
-            return tipo
-            
-    return 'DIVERSOS' if value > 0 else 'DEBITO'
+    finally:
+        profiling.deactivate()
+        breakdown = profile.as_dict()
+        progress = upload_progress.setdefault(process_id, {})
+        progress['profile'] = breakdown
+        active_profiles.pop(process_id, None)
+        running_imports.pop(process_id, None)
+        finished_imports[process_id] = time.monotonic()
+
+        if rows is None:
+            rows = next((stage['rows'] for stage in breakdown['stages'] if stage['name'] == 'insert'), 0)
+        try:
+            if not superseded and jobs.finish_job(
+                    process_id, progress.get('status', 'error'), progress.get('message'),
+                    rows=rows, profile=breakdown, profile_path=profile_path,
+                    rejected_count=reader.rejected_count, rejected=reader.rejected,
+                    balance_mismatches=reader.balance_mismatches,
+                    balance_checked=reader.balance_checked, owner=owner):
+                if sha256 is not None:
+                    jobs.finish_statement_file(sha256, progress.get('status', 'error'),
+                                               progress.get('message'), rows=rows)
+        except Exception:
+            logger.exception("Erro ao registrar importação %s", process_id)
+        finally:
+            db.close_connection()
+
+@scheduler.periodic('heartbeat_imports', 30, local=True)
+def heartbeat_imports():
+    """Show the imports of this process are alive (see jobs.RESUME_AFTER)"""
+    running = dict(running_imports)
+    if running:
+        jobs.heartbeat(running)
+    return len(running)
+
+# Times an import is resumed before being given up
+MAX_RESUMES = 3
+
+@scheduler.periodic('resume_imports', 60)
+def resume_imports():
+    """Continue, from their checkpoint, the imports whose worker died"""
+    resumed = 0
+    for job in jobs.stale_imports():
+        owner = jobs.new_owner()
+        if not jobs.claim_import(job, owner):
+            continue
+        filepath = job['filepath']
+        reader = None
+        if filepath and os.path.exists(filepath) and job['resumes'] < MAX_RESUMES:
+            import readers
+            reader = readers.detect_reader(filepath) or readers.get_reader(job['bank'], filepath)
+        if reader is None:
+            logger.warning("Importação %s não pode ser retomada; lançamentos gravados removidos", job['id'])
+            jobs.abandon_import(job['id'], owner, 'Importação interrompida: o processo foi encerrado antes de concluí-la')
+            continue
+
+        logger.info("Retomando importação %s (%s) do registro %s", job['id'], job['filename'], job['checkpoint'])
+        upload_progress[job['id']] = {
+            'status': 'processing',
+            'current': job['checkpoint'],
+            'total': 0,
+            'message': 'Retomando importação...'
+        }
+        threading.Thread(
+            target=run_import,
+            args=(reader, filepath, job['id'], owner),
+            kwargs={'sha256': job['sha256']}
+        ).start()
+        resumed += 1
+    return resumed
 
 @app.route('/upload_progress/<process_id>')
 @login_required
 def get_upload_progress(process_id):
     """Retorna o progresso atual do upload"""
     if process_id not in upload_progress:
-        return jsonify({'error': 'Process ID not found'}), 404
+        # Finished imports are kept in the job history
+        job = jobs.get_job(process_id)
+        if job is None:
+            return jsonify({'error': 'Process ID not found'}), 404
+        return jsonify({
+            'status': job['status'],
+            'message': job['message'],
+            'current': job['rows'],
+            'total': job['rows'],
+            'rejected': job['rejected'],
+            'balance_mismatches': job['balance_mismatches'],
+            'balance_checked': job['balance_checked'],
+            'profile': job['profile']
+        })
     
     progress_data = upload_progress[process_id]
     
-    # Se o processamento foi concluído ou teve erro, remove do dicionário após alguns segundos
-    if progress_data['status'] in ['completed', 'error']:
-        def cleanup():
-            time.sleep(30)  # Mantém o resultado por 30 segundos
-            upload_progress.pop(process_id, None)
-        threading.Thread(target=cleanup).start()
+    # Live stage breakdown while the import runs
+    profile = active_profiles.get(process_id)
+    if profile is not None:
+        progress_data = dict(progress_data, profile=profile.as_dict())
     
     return jsonify(progress_data)
 
+# Seconds a finished import stays in upload_progress; the job history has it afterwards
+PROGRESS_KEEP = 30
+
+@scheduler.periodic('sweep_progress', PROGRESS_KEEP, local=True)
+def sweep_progress():
+    """Drop the progress of the imports finished more than PROGRESS_KEEP seconds ago"""
+    now = time.monotonic()
+    expired = [process_id for process_id, finished in finished_imports.items()
+               if now - finished >= PROGRESS_KEEP]
+    for process_id in expired:
+        upload_progress.pop(process_id, None)
+        finished_imports.pop(process_id, None)
+    return len(expired)
+
+@scheduler.periodic('clean_uploads', 3600)
+def clean_uploads():
+    """Remove the uploads left behind by failed or abandoned imports"""
+    cutoff = time.time() - jobs.STALE_IMPORT.total_seconds()
+    # Files of unfinished imports are kept: they may still be resumed
+    active = {os.path.abspath(path) for path in jobs.active_upload_paths()}
+    removed = 0
+    for entry in os.scandir(app.config['UPLOAD_FOLDER']):
+        if (entry.is_file() and entry.stat().st_mtime < cutoff
+                and os.path.abspath(entry.path) not in active):
+            os.remove(entry.path)
+            removed += 1
+    if removed:
+        logger.info("%s arquivos antigos removidos de %s", removed, app.config['UPLOAD_FOLDER'])
+    return removed
+
+@app.route('/api/scheduler')
+@login_required
+def api_scheduler():
+    """Maintenance tasks with their last run and duration"""
+    return jsonify(scheduler.status())
+
+@app.route('/api/import-jobs')
+@login_required
+def api_import_jobs():
+    """Recent imports with their result and stage profile"""
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 200)
+    except ValueError:
+        return jsonify({'error': 'Parâmetro limit inválido'}), 400
+    return jsonify({'jobs': jobs.list_jobs(limit)})
+
+@app.route('/api/import-jobs/<job_id>/cprofile')
+@login_required
+def download_import_cprofile(job_id):
+    """cProfile dump of an import (open with pstats or snakeviz)"""
+    path = jobs.get_profile_path(job_id)
+    if not path or not os.path.exists(path):
+        abort(404)
+    return send_file(os.path.abspath(path), mimetype='application/octet-stream',
+                     as_attachment=True, download_name=f'{job_id}.prof')
+
+REJECTS_HEADER = ['Linha', 'Coluna', 'Motivo', 'Valor']
+
+@app.route('/api/import-jobs/<job_id>/rejected')
+@login_required
+def download_import_rejects(job_id):
+    """Rows an import left out or where the statement balance diverged
+    (row, column, reason), as CSV or JSON"""
+    job = jobs.get_job(job_id)
+    if job is None:
+        abort(404)
+    rejects = jobs.iter_rejects(job_id)
+
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'job_id': job_id,
+            'rejected': job['rejected'] or 0,
+            'balance_mismatches': job['balance_mismatches'] or 0,
+            'rows': [{'row': row, 'column': field, 'reason': reason, 'value': value}
+                     for row, field, reason, value in rejects]
+        })
+
+    buffer = io.StringIO()
+    # BOM so Excel detects UTF-8
+    buffer.write('\ufeff')
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(REJECTS_HEADER)
+    writer.writerows(rejects)
+    response = Response(buffer.getvalue(), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename="rejeitadas_{job_id}.csv"'
+    return response
+
+@app.route('/api/balances')
+@login_required
+def api_balances():
+    """Latest balance of each account, from the statements' saldo; checked
+    when it was compared with an earlier printed balance"""
+    conn = get_db_connection()
+    # One pass over the primary key; balance_cents comes from the MAX(day) row
+    rows = conn.execute('''
+        SELECT bank, account, MAX(day) AS day, balance_cents, checked
+        FROM balance_snapshots
+        GROUP BY bank, account
+    ''').fetchall()
+    conn.close()
+    return jsonify({'accounts': [
+        {
+            'bank': row['bank'],
+            'account': row['account'],
+            'date': db.day_to_iso(row['day']),
+            'balance': db.from_cents(row['balance_cents']),
+            'checked': bool(row['checked'])
+        }
+        for row in rows
+    ]})
+
 @app.route('/health')
 def health_check():
     return jsonify({
@@ -517,456 +550,614 @@ def health_check():
         'app_name': os.getenv('APP_NAME')
     })
 
-def create_companies_table():
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint; requires a bearer token when METRICS_TOKEN is set"""
+    token = os.getenv('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+LEDGER_DIRECTIONS = ['recebidos', 'enviados', 'internas']
+
+def get_ledger_filters():
+    """Read the ledger view filters from the query string"""
+    return {
+        'tipo_filtro': request.args.get('tipo', 'todos'),
+        'cnpj_filtro': request.args.get('cnpj', 'todos'),
+        'start_date': request.args.get('start_date', ''),
+        'end_date': request.args.get('end_date', ''),
+        'q': request.args.get('q', '').strip()
+    }
+
+def build_ledger_query(direction=None, tipo_filtro='todos', cnpj_filtro='todos',
+                       start_date='', end_date='', q='', order=True):
+    """Build the query behind the recebidos, enviados and internal views.
+
+    Returns (query, params). Every row has the columns id, day, description,
+    amount_cents, original_type, displayed_type and document; the internal
+    view adds transfer_leg.
+    """
+    params = []
+
+    if direction == 'internas':
+        # transfer_leg: 'saida' or 'entrada' for the legs of a matched transfer
+        internal, internal_params = internal_match()
+        query = f'''
+            SELECT MIN(t.id) AS id, t.day, t.description, t.amount_cents,
+                t.type AS original_type,
+                c.name AS displayed_type,
+                t.document,
+                MAX(CASE WHEN md.id IS NOT NULL THEN 'saida'
+                         WHEN mc.id IS NOT NULL THEN 'entrada' END) AS transfer_leg
+            FROM ledger t
+            JOIN categories c ON c.id = t.category
+            LEFT JOIN transfer_matches md ON md.debit_id = t.id
+            LEFT JOIN transfer_matches mc ON mc.credit_id = t.id
+            WHERE {internal}
+        '''
+        params.extend(internal_params)
+
+        if cnpj_filtro != 'todos':
+            company_name = AF_COMPANIES.get(cnpj_filtro)
+            if company_name:
+                name_match, name_params = description_match([company_name])
+                query += f" AND (t.document = ? OR {name_match})"
+                params.append(cnpj_filtro)
+                params.extend(name_params)
+            else:
+                query += " AND t.document = ?"
+                params.append(cnpj_filtro)
+    else:
+        query = '''
+            SELECT t.id, t.day, t.description, t.amount_cents,
+                t.type AS original_type,
+                c.name AS displayed_type,
+                t.document
+            FROM ledger t
+            JOIN categories c ON c.id = t.category
+            WHERE 1=1
+        '''
+
+        if direction is not None:
+            query += " AND t.amount_cents {} 0".format('>' if direction == 'recebidos' else '<')
+            query += '''
+                AND (
+                    t.document NOT IN ({af_companies})
+                    OR t.document IS NULL
+                )
+            '''.format(af_companies=','.join(['?' for _ in AF_COMPANIES]))
+            params.extend(AF_COMPANIES.keys())
+            exclusion, exclusion_params = description_match(AF_DESCRIPTION_EXCLUSIONS, negate=True)
+            query += f" AND {exclusion}"
+            params.extend(exclusion_params)
+
+        if cnpj_filtro != 'todos':
+            query += " AND t.document = ?"
+            params.append(cnpj_filtro)
+
+    if tipo_filtro != 'todos':
+        category_ids = filter_category_ids(direction, tipo_filtro)
+        query += " AND t.category IN ({})".format(','.join('?' * len(category_ids)))
+        params.extend(category_ids)
+
+    start_day = db.parse_day(start_date)
+    if start_day:
+        query += " AND t.day >= ?"
+        params.append(start_day)
+
+    end_day = db.parse_day(end_date)
+    if end_day:
+        query += " AND t.day <= ?"
+        params.append(end_day)
+
+    if q:
+        search, search_params = description_match([q])
+        query += f" AND {search}"
+        params.extend(search_params)
+
+    if direction == 'internas':
+        # Collapse rows imported more than once
+        query += " GROUP BY t.day, t.description, t.amount_cents, t.type, t.document"
+
+    if order:
+        query += " ORDER BY t.day DESC, {} DESC".format(
+            'MIN(t.id)' if direction == 'internas' else 't.id')
+
+    return query, params
+
+# direction -> (data generation, dropdown options)
+cnpj_options_cache = {}
+
+def get_external_cnpjs(direction):
+    """CNPJs in the rows of an external view, with the company names, for its dropdown.
+
+    Recomputed only when the data generation changes (new entries or
+    company names); every worker reads the same table, so they agree.
+    """
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS companies (
-            document TEXT PRIMARY KEY,
-            nome_fantasia TEXT,
-            razao_social TEXT
-        )
-    ''')
-    conn.commit()
+    generation = get_data_generation(conn)
+    cached = cnpj_options_cache.get(direction)
+    hit = cached is not None and cached[0] == generation
+    metrics.record_cache('cnpj_options', hit)
+    if hit:
+        conn.close()
+        return cached[1]
+
+    query, params = build_ledger_query(direction, order=False)
+    rows = conn.execute(f'''
+        SELECT v.document,
+            (SELECT COALESCE(NULLIF(c.nome_fantasia, ''), c.razao_social)
+             FROM companies c WHERE c.document = v.document) AS name
+        FROM ({query}) v
+        WHERE v.document IS NOT NULL
+        GROUP BY v.document
+    ''', params).fetchall()
     conn.close()
 
-def cleanup_paired_transactions(conn):
-    """Clean up paired transactions during upload"""
-    cursor = conn.cursor()
-    total_deleted = 0
-    
+    # Companies by name, then the CNPJs not looked up yet
+    rows = sorted(rows, key=lambda row: (row['name'] is None, (row['name'] or row['document']).upper()))
+    options = [{'cnpj': row['document'], 'name': row['name'] or row['document']} for row in rows]
+    cnpj_options_cache[direction] = (generation, options)
+    return options
+
+# Template chunks buffered before each write of a streamed page
+STREAM_BUFFER = 20
+VIEW_FETCH_SIZE = 500
+
+def stream_template(template_name, **context):
+    """Response rendering a template chunk by chunk as it is sent.
+
+    Same as flask.stream_template (Flask 2.2+): generators in the context
+    are consumed while the page goes out, so the page never has to fit
+    in memory.
+    """
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER)
+    return Response(stream_with_context(stream))
+
+def iter_ledger_rows(query, params):
+    """Yield the rows of a ledger query, fetched in batches"""
+    conn = get_db_connection()
     try:
-        print("\n=== Starting CONTAMAX Cleanup ===")
-        # First find CONTAMAX pairs
-        cursor.execute('''
-        WITH contamax_pairs AS (
-            SELECT t1.id as id1, t1.description as desc1, t1.value as val1,
-                   t2.id as id2, t2.description as desc2, t2.value as val2
-            FROM transactions t1
-            JOIN transactions t2 ON t1.date = t2.date 
-            AND ABS(t1.value) = ABS(t2.value)
-            AND t1.id != t2.id
-            WHERE 
-                ((t1.description LIKE '%RESGATE CONTAMAX%' AND t2.description LIKE '%CANCELAMENTO RESGATE%')
-                OR (t2.description LIKE '%RESGATE CONTAMAX%' AND t1.description LIKE '%CANCELAMENTO RESGATE%'))
-                AND t1.value = -t2.value
-        )
-        SELECT * FROM contamax_pairs''')
-        
-        contamax_pairs = cursor.fetchall()
-        print(f"Found {len(contamax_pairs)} CONTAMAX pairs to delete:")
-        for pair in contamax_pairs:
-            print("CONTAMAX Pair:")
-            print(f"  1. {pair[1]} (R$ {pair[2]})")
-            print(f"  2. {pair[4]} (R$ {pair[5]})")
-            
-        if contamax_pairs:
-            contamax_ids = []
-            for pair in contamax_pairs:
-                contamax_ids.extend([pair[0], pair[3]])
-            
-            placeholders = ','.join(['?' for _ in contamax_ids])
-            cursor.execute(f'DELETE FROM transactions WHERE id IN ({placeholders})', contamax_ids)
-            contamax_deleted = cursor.rowcount
-            total_deleted += contamax_deleted
-            print(f"Deleted {contamax_deleted} CONTAMAX transactions")
-        
-        print("\n=== Starting CHEQUE Cleanup ===")
-        # Then find CHEQUE pairs
-        cursor.execute('''
-        WITH cheque_pairs AS (
-            SELECT t1.id as id1, t1.description as desc1, t1.value as val1,
-                   t2.id as id2, t2.description as desc2, t2.value as val2
-            FROM transactions t1
-            JOIN transactions t2 ON t1.date = t2.date 
-            AND ABS(t1.value) = ABS(t2.value)
-            AND t1.id != t2.id
-            WHERE 
-                ((t1.description LIKE '%CHEQUE EMITIDO/DEBITADO%' OR t1.description LIKE '%COMPENSACAO INTERNA%')
-                AND t2.description LIKE '%CHEQUE DEVOLVIDO%'
-                AND t1.value < 0 AND t2.value > 0)
-        )
-        SELECT * FROM cheque_pairs''')
-        
-        cheque_pairs = cursor.fetchall()
-        print(f"Found {len(cheque_pairs)} CHEQUE pairs to delete:")
-        for pair in cheque_pairs:
-            print("CHEQUE Pair:")
-            print(f"  1. {pair[1]} (R$ {pair[2]})")
-            print(f"  2. {pair[4]} (R$ {pair[5]})")
-            
-        if cheque_pairs:
-            cheque_ids = []
-            for pair in cheque_pairs:
-                cheque_ids.extend([pair[0], pair[3]])
-            
-            placeholders = ','.join(['?' for _ in cheque_ids])
-            cursor.execute(f'DELETE FROM transactions WHERE id IN ({placeholders})', cheque_ids)
-            cheque_deleted = cursor.rowcount
-            total_deleted += cheque_deleted
-            print(f"Deleted {cheque_deleted} CHEQUE transactions")
-        
-        conn.commit()
-        return total_deleted
-        
-    except Exception as e:
-        print(f"Error cleaning up transactions: {str(e)}")
-        return 0
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(VIEW_FETCH_SIZE)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
 
-@app.route('/recebidos')
-@login_required
-def recebidos():
-    # Get database connection
+def ledger_type_totals(direction, filters):
+    """(displayed type, transfer leg, absolute centavos) of the rows of a view.
+
+    Computed in SQL before the rows are streamed, so the totals header
+    can go out first.
+    """
+    query, params = build_ledger_query(direction, order=False, **filters)
+    transfer_leg = 'transfer_leg' if direction == 'internas' else 'NULL'
     conn = get_db_connection()
-    cursor = conn.cursor()
+    rows = conn.execute(f'''
+        SELECT displayed_type, {transfer_leg}, SUM(ABS(amount_cents))
+        FROM ({query})
+        GROUP BY 1, 2
+    ''', params).fetchall()
+    conn.close()
+    return rows
 
-    # Get filters
-    tipo_filtro = request.args.get('tipo', 'todos')
-    cnpj_filtro = request.args.get('cnpj', 'todos')
-    start_date = request.args.get('start_date', '')
-    end_date = request.args.get('end_date', '')
+def ledger_view_data(direction, filters):
+    """(type totals, rows) of the recebidos, enviados or internal view.
 
-    # Initialize totals
-    totals = {
-        'pix_recebido': 0.0,
-        'ted_recebida': 0.0,
-        'pagamento': 0.0,
-        'cheque': 0.0,
-        'contamax': 0.0,
-        'despesas_operacionais': 0.0,
-        'diversos': 0.0
+    From the columnar cache when it is enabled, else from SQL; either way
+    the rows are fetched while the page streams.
+    """
+    if ledger_cache is None:
+        query, params = build_ledger_query(direction, **filters)
+        return ledger_type_totals(direction, filters), iter_ledger_rows(query, params)
+
+    internal = direction == 'internas'
+    conn = get_db_connection()
+    snapshot = ledger_cache.get_snapshot(conn, *build_ledger_query('internas', order=False))
+    positions = ledger_cache.select(conn, snapshot, direction, **filters)
+    conn.close()
+    return (ledger_cache.type_totals(snapshot, positions, with_legs=internal),
+            ledger_cache.iter_rows(snapshot, positions, with_legs=internal))
+
+def total_key(direction, displayed_type):
+    """Key of the totals of a ledger view a displayed type is summed under"""
+    return view_category(direction, displayed_type).lower().replace(' ', '_')
+
+def ledger_view_row(row, has_company_info=False):
+    """Row of the recebidos, enviados and internal tables"""
+    return {
+        'date': db.day_to_iso(row['day']),
+        'description': row['description'],
+        'value': db.from_cents(row['amount_cents']),
+        'type': row['displayed_type'],
+        'original_type': row['original_type'],
+        'document': row['document'],
+        'has_company_info': has_company_info
     }
 
-    # Base query
-    query = '''
-        SELECT t.id, t.date, t.description, t.value,
-            t.type AS original_type,
-            CASE
-                WHEN t.type IN ('APLICACAO', 'RESGATE') THEN 'CONTAMAX'
-                WHEN t.type IN ('COMPENSACAO', 'CHEQUE') THEN 'CHEQUE'
-                WHEN t.type IN ('TAXA', 'TARIFA', 'IOF', 'MULTA', 'DEBITO') THEN 'DESPESAS OPERACIONAIS'
-                WHEN t.type IN ('PIX RECEBIDO', 'TED RECEBIDA', 'PAGAMENTO') THEN t.type
-                ELSE 'DIVERSOS'
-            END AS displayed_type,
-            t.document
-        FROM transactions t
-        WHERE t.value > 0
-        AND (
-            t.document NOT IN ('50389827000107','43077430000114','53720093000195','55072511000100','17814862000150')
-            OR t.document IS NULL
-        )
-        AND t.description NOT LIKE '%AF ENERGY SOLAR 360%'
-        AND t.description NOT LIKE '%AF 360 CORRETORA DE SEGUROS%'
-        AND t.description NOT LIKE '%AF CREDITO BANK%'
-        AND t.description NOT LIKE '%AF COMERCIO DE CALCADOS%'
-        AND t.description NOT LIKE '%AF 360 FRANQUIAS%'
-        AND t.description NOT LIKE '%AF 360 CORRETORA%'
-    '''
+@app.route('/recebidos')
+@login_required
+def recebidos():
+    # Get filters
+    filters = get_ledger_filters()
 
-    # Apply filters
-    params = []
-    if tipo_filtro != 'todos':
-        if tipo_filtro == 'DIVERSOS':
-            query += " AND t.type NOT IN ('PIX RECEBIDO', 'TED RECEBIDA', 'PAGAMENTO')"
-        elif tipo_filtro == 'CHEQUE':
-            query += " AND t.type IN ('CHEQUE', 'COMPENSACAO')"
-        elif tipo_filtro == 'CONTAMAX':
-            query += " AND t.type IN ('APLICACAO', 'RESGATE')"
-        elif tipo_filtro == 'DESPESAS OPERACIONAIS':
-            query += " AND t.type IN ('TAXA', 'TARIFA', 'IOF', 'MULTA', 'DEBITO')"
-        else:
-            query += " AND t.type = ?"
-            params.append(tipo_filtro)
-
-    if cnpj_filtro != 'todos':
-        query += " AND document = ?"
-        params.append(cnpj_filtro)
-
-    if start_date:
-        query += " AND date >= ?"
-        params.append(start_date)
-
-    if end_date:
-        query += " AND date <= ?"
-        params.append(end_date)
-
-    query += " ORDER BY date DESC"
-
-    # Execute query
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
+    # Initialize totals
+    totals = {total_key('recebidos', name): 0 for name in VIEW_CATEGORIES['recebidos']}
 
-    # Process transactions
-    transactions = []
-    for row in rows:
-        value = float(row[3])
-        displayed_type = row[5]
-        transaction = {
-            'date': row[1],
-            'description': row[2],
-            'value': value,
-            'type': displayed_type,
-            'original_type': row[4],
-            'document': row[6],
-            'has_company_info': False
-        }
+    type_totals, rows = ledger_view_data('recebidos', filters)
 
-        # Update totals based on displayed type
-        type_key = displayed_type.lower().replace(' ', '_')
-        if type_key in totals:
-            totals[type_key] += value
+    # Totals based on displayed type (summed in centavos)
+    for displayed_type, _, cents in type_totals:
+        totals[total_key('recebidos', displayed_type)] += cents
 
-        transactions.append(transaction)
+    totals = {key: db.from_cents(cents) for key, cents in totals.items()}
 
-    # Get CNPJs for dropdown
-    cnpjs = [
-        {'cnpj': cnpj, 'name': info.get('nome_fantasia') or info.get('razao_social', '')} 
-        for cnpj, info in cnpj_cache.items() 
-        if cnpj not in AF_COMPANIES
-    ]
+    # Rows streamed after the totals
+    transactions = (ledger_view_row(row) for row in rows)
 
-    conn.close()
-    return render_template('recebidos.html',
+    return stream_template('recebidos.html',
                          transactions=transactions,
                          totals=totals,
-                         tipo_filtro=tipo_filtro,
-                         cnpj_filtro=cnpj_filtro,
-                         start_date=start_date,
-                         end_date=end_date,
-                         cnpjs=cnpjs,
-                         failed_cnpjs=len(failed_cnpjs))
+                         cnpjs=get_external_cnpjs('recebidos'),
+                         failed_cnpjs=len(failed_cnpjs),
+                         **filters)
 
 @app.route('/enviados')
 @login_required
 def enviados():
-    # Get database connection
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     # Get filters
-    tipo_filtro = request.args.get('tipo', 'todos')
-    cnpj_filtro = request.args.get('cnpj', 'todos')
-    start_date = request.args.get('start_date', '')
-    end_date = request.args.get('end_date', '')
+    filters = get_ledger_filters()
 
     # Initialize totals
-    totals = {
-        'pix_enviado': 0.0,
-        'ted_enviada': 0.0,
-        'pagamento': 0.0,
-        'cheque': 0.0,
-        'contamax': 0.0,
-        'despesas_operacionais': 0.0,
-        'diversos': 0.0
-    }
+    totals = {total_key('enviados', name): 0 for name in VIEW_CATEGORIES['enviados']}
 
-    # Base query
-    query = '''
-        SELECT t.id, t.date, t.description, ABS(t.value) as value,
-            t.type AS original_type,
-            CASE
-                WHEN t.type IN ('APLICACAO', 'RESGATE') THEN 'CONTAMAX'
-                WHEN t.type IN ('COMPENSACAO', 'CHEQUE') THEN 'CHEQUE'
-                WHEN t.type IN ('TAXA', 'TARIFA', 'IOF', 'MULTA', 'DEBITO') THEN 'DESPESAS OPERACIONAIS'
-                WHEN t.type IN ('PIX ENVIADO', 'TED ENVIADA', 'PAGAMENTO') THEN t.type
-                ELSE 'DIVERSOS'
-            END AS displayed_type,
-            t.document
-        FROM transactions t
-        WHERE t.value < 0
-        AND (
-            t.document NOT IN ('50389827000107','43077430000114','53720093000195','55072511000100','17814862000150')
-            OR t.document IS NULL
-        )
-        AND t.description NOT LIKE '%AF ENERGY SOLAR 360%'
-        AND t.description NOT LIKE '%AF 360 CORRETORA DE SEGUROS%'
-        AND t.description NOT LIKE '%AF CREDITO BANK%'
-        AND t.description NOT LIKE '%AF COMERCIO DE CALCADOS%'
-        AND t.description NOT LIKE '%AF 360 FRANQUIAS%'
-        AND t.description NOT LIKE '%AF 360 CORRETORA%'
-    '''
+    type_totals, rows = ledger_view_data('enviados', filters)
 
-    # Apply filters
-    params = []
-    if tipo_filtro != 'todos':
-        if tipo_filtro == 'DIVERSOS':
-            query += " AND t.type NOT IN ('PIX ENVIADO', 'TED ENVIADA', 'PAGAMENTO')"
-        elif tipo_filtro == 'CHEQUE':
-            query += " AND t.type IN ('CHEQUE', 'COMPENSACAO')"
-        elif tipo_filtro == 'CONTAMAX':
-            query += " AND t.type IN ('APLICACAO', 'RESGATE')"
-        elif tipo_filtro == 'DESPESAS OPERACIONAIS':
-            query += " AND t.type IN ('TAXA', 'TARIFA', 'IOF', 'MULTA', 'DEBITO')"
-        else:
-            query += " AND t.type = ?"
-            params.append(tipo_filtro)
-
-    if cnpj_filtro != 'todos':
-        query += " AND document = ?"
-        params.append(cnpj_filtro)
-
-    if start_date:
-        query += " AND date >= ?"
-        params.append(start_date)
-
-    if end_date:
-        query += " AND date <= ?"
-        params.append(end_date)
-
-    query += " ORDER BY date DESC"
-
-    # Execute query
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
-
-    # Process transactions
-    transactions = []
-    for row in rows:
-        value = float(row[3])
-        displayed_type = row[5]
-        transaction = {
-            'date': row[1],
-            'description': row[2],
-            'value': value,
-            'type': displayed_type,
-            'original_type': row[4],
-            'document': row[6],
-            'has_company_info': False
-        }
-
-        # Update totals based on displayed type
-        type_key = displayed_type.lower().replace(' ', '_')
-        if type_key in totals:
-            totals[type_key] += value
+    # Totals based on displayed type (summed in centavos)
+    for displayed_type, _, cents in type_totals:
+        totals[total_key('enviados', displayed_type)] += cents
 
-        transactions.append(transaction)
+    totals = {key: db.from_cents(cents) for key, cents in totals.items()}
 
-    # Get CNPJs for dropdown
-    cnpjs = [
-        {'cnpj': cnpj, 'name': info.get('nome_fantasia') or info.get('razao_social', '')} 
-        for cnpj, info in cnpj_cache.items() 
-        if cnpj not in AF_COMPANIES
-    ]
+    # Rows streamed after the totals; values shown as positive amounts
+    transactions = (dict(ledger_view_row(row), value=db.from_cents(abs(row['amount_cents'])))
+                    for row in rows)
 
-    conn.close()
-    return render_template('enviados.html',
+    return stream_template('enviados.html',
                          transactions=transactions,
                          totals=totals,
-                         tipo_filtro=tipo_filtro,
-                         cnpj_filtro=cnpj_filtro,
-                         start_date=start_date,
-                         end_date=end_date,
-                         cnpjs=cnpjs,
-                         failed_cnpjs=len(failed_cnpjs))
+                         cnpjs=get_external_cnpjs('enviados'),
+                         failed_cnpjs=len(failed_cnpjs),
+                         **filters)
 
 @app.route('/transacoes_internas')
 @login_required
 def transacoes_internas():
     if not session.get('authenticated'):
         return redirect('https://af360bank.onrender.com/login')
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
 
     # Get filters
-    tipo_filtro = request.args.get('tipo', 'todos')
-    cnpj_filtro = request.args.get('cnpj', 'todos')
-    start_date = request.args.get('start_date', '')
-    end_date = request.args.get('end_date', '')
+    filters = get_ledger_filters()
 
     # Initialize totals
-    totals = {
-        'juros': 0.0,
-        'iof': 0.0,
-        'pix_enviado': 0.0,
-        'ted_enviada': 0.0,
-        'pagamento': 0.0,
-        'diversos': 0.0
+    totals = {total_key('internas', name): 0 for name in VIEW_CATEGORIES['internas']}
+    totals['transferencias_conciliadas'] = 0
+
+    type_totals, rows = ledger_view_data('internas', filters)
+
+    # Totals based on type (summed in centavos)
+    for displayed_type, transfer_leg, cents in type_totals:
+        # A matched transfer is counted once, by its outgoing leg
+        if transfer_leg == 'entrada':
+            continue
+        if transfer_leg == 'saida':
+            totals['transferencias_conciliadas'] += cents
+        totals[total_key('internas', displayed_type)] += cents
+
+    totals = {key: db.from_cents(cents) for key, cents in totals.items()}
+
+    # Rows streamed after the totals
+    transactions = (dict(ledger_view_row(row, has_company_info=True), transfer_leg=row['transfer_leg'])
+                    for row in rows)
+
+    # Get CNPJs for dropdown (AF companies only)
+    cnpjs = [{'cnpj': cnpj, 'name': name} for cnpj, name in AF_COMPANIES.items()]
+
+    return stream_template('transacoes_internas.html',
+                         transactions=transactions,
+                         totals=totals,
+                         cnpjs=cnpjs,
+                         failed_cnpjs=0,
+                         **filters)
+
+API_FETCH_SIZE = 500
+
+def get_api_filters():
+    """Read the API filters; same names as the HTML views plus direction"""
+    direction = request.args.get('direction') or None
+    if direction is not None and direction not in LEDGER_DIRECTIONS:
+        abort(400, description=f"direction deve ser um de: {', '.join(LEDGER_DIRECTIONS)}")
+    return direction, get_ledger_filters()
+
+def api_etag(conn, *parts):
+    """ETag for an API response: data generation plus the request parameters"""
+    key = '|'.join([str(get_data_generation(conn))] + [str(part) for part in parts])
+    key += '|' + '&'.join(f'{k}={v}' for k, v in sorted(request.args.items(multi=True)))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def not_modified(etag):
+    """Return a 304 response if the client already has this ETag"""
+    # Weak comparison: compressed responses carry the ETag as weak
+    hit = request.if_none_match.contains_weak(etag)
+    metrics.record_cache('http_etag', hit)
+    if hit:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+def serialize_ledger_row(row):
+    value = db.from_cents(row['amount_cents'])
+    return {
+        'id': row['id'],
+        'date': db.day_to_iso(row['day']),
+        'description': row['description'],
+        'value': value,
+        'type': 'receita' if value > 0 else 'despesa',
+        'category': row['displayed_type'],
+        'original_type': row['original_type'],
+        'document': row['document']
     }
 
-    # Base query for internal transactions
-    query = '''
-        SELECT DISTINCT t1.date, t1.description, t1.value, t1.type, t1.document
-        FROM transactions t1
-        WHERE (
-            t1.document IN ({af_companies})
-            OR {conditions}
-            OR t1.description LIKE '%AF 360%'
-            OR t1.description LIKE '%AF ENERGY%'
-            OR t1.description LIKE '%AF CREDITO%'
-            OR t1.description LIKE '%AF COMERCIO%'
-            OR t1.description LIKE '%AF 360 CORRETORA%'
-        )
-    '''.format(
-        af_companies=','.join(['?' for _ in AF_COMPANIES]),
-        conditions=' OR '.join([
-            "t1.description LIKE ?"
-            for _ in AF_COMPANIES.values()
-        ])
-    )
-
-    # Add parameters
-    params = list(AF_COMPANIES.keys())
-    params.extend(['%' + name + '%' for name in AF_COMPANIES.values()])
-
-    # Apply filters
-    if tipo_filtro != 'todos':
-        query += " AND t1.type = ?"
-        params.append(tipo_filtro)
+def stream_ledger_rows(query, params, ndjson):
+    """Yield the query rows as NDJSON lines or as a chunked JSON array"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        separator = '\n' if ndjson else ','
+        first = True
+        if not ndjson:
+            yield '['
+        while True:
+            rows = cursor.fetchmany(API_FETCH_SIZE)
+            if not rows:
+                break
+            chunk = [json.dumps(serialize_ledger_row(row), ensure_ascii=False) for row in rows]
+            prefix = '' if first or ndjson else separator
+            first = False
+            yield prefix + separator.join(chunk) + ('\n' if ndjson else '')
+        if not ndjson:
+            yield ']'
+    finally:
+        conn.close()
 
-    if cnpj_filtro != 'todos':
-        query += " AND (t1.document = ? OR t1.description LIKE ?)"
-        params.extend([cnpj_filtro, '%' + AF_COMPANIES.get(cnpj_filtro, '') + '%'])
+@app.route('/api/transactions')
+@login_required
+def api_transactions():
+    """Stream the filtered ledger as JSON (default) or NDJSON"""
+    direction, filters = get_api_filters()
+    ndjson = (request.args.get('format') == 'ndjson' or
+              request.accept_mimetypes.best == 'application/x-ndjson')
 
-    if start_date:
-        query += " AND t1.date >= ?"
-        params.append(start_date)
+    conn = get_db_connection()
+    etag = api_etag(conn, 'transactions', ndjson)
+    conn.close()
 
-    if end_date:
-        query += " AND t1.date <= ?"
-        params.append(end_date)
+    cached = not_modified(etag)
+    if cached:
+        return cached
 
-    query += " ORDER BY t1.date DESC"
+    query, params = build_ledger_query(direction, **filters)
+    response = Response(stream_ledger_rows(query, params, ndjson),
+                        mimetype='application/x-ndjson' if ndjson else 'application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Vary'] = 'Accept, Cookie'
+    return response
 
-    # Execute query
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
+@app.route('/api/summary')
+@login_required
+def api_summary():
+    """Totals of the filtered ledger"""
+    direction, filters = get_api_filters()
 
-    # Process transactions
-    transactions = []
-    for row in rows:
-        value = float(row[2])
-        transaction = {
-            'date': row[0],
-            'description': row[1],
-            'value': value,
-            'type': row[3] if row[3] else 'DIVERSOS',
-            'document': row[4],
-            'has_company_info': True
+    conn = get_db_connection()
+    etag = api_etag(conn, 'summary')
+    cached = not_modified(etag)
+    if cached:
+        conn.close()
+        return cached
+
+    query, params = build_ledger_query(direction, order=False, **filters)
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT displayed_type,
+            COUNT(*) as count,
+            COALESCE(SUM(CASE WHEN amount_cents > 0 THEN amount_cents ELSE 0 END), 0) as receitas,
+            COALESCE(SUM(CASE WHEN amount_cents < 0 THEN -amount_cents ELSE 0 END), 0) as despesas
+        FROM ({query})
+        GROUP BY displayed_type
+    ''', params)
+
+    # Summed in centavos, converted once at the end
+    receitas = 0
+    despesas = 0
+    count = 0
+    by_category = {}
+    for row in cursor.fetchall():
+        count += row['count']
+        receitas += row['receitas']
+        despesas += row['despesas']
+        by_category[row['displayed_type']] = {
+            'count': row['count'],
+            'total': db.from_cents(row['receitas'] - row['despesas'])
         }
 
-        # Update totals based on type
-        type_key = transaction['type'].lower().replace(' ', '_')
-        if type_key in totals:
-            totals[type_key] += abs(value)
-        else:
-            totals['diversos'] += abs(value)
+    summary = {
+        'receitas': db.from_cents(receitas),
+        'despesas': db.from_cents(despesas),
+        'saldo': db.from_cents(receitas - despesas),
+        'count': count,
+        'categories': by_category
+    }
+    if direction == 'internas':
+        # Transfers between the group accounts, each counted once
+        cursor.execute(f'''
+            SELECT COUNT(*), COALESCE(SUM(-amount_cents), 0)
+            FROM ({query})
+            WHERE transfer_leg = 'saida'
+        ''', params)
+        transfer_count, transfer_cents = cursor.fetchone()
+        summary['transferencias'] = {'count': transfer_count, 'total': db.from_cents(transfer_cents)}
+    conn.close()
 
-        transactions.append(transaction)
+    response = jsonify(summary)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
-    # Get CNPJs for dropdown (AF companies only)
-    cnpjs = [{'cnpj': cnpj, 'name': name} for cnpj, name in AF_COMPANIES.items()]
+SEARCH_LIMIT = 50
+
+@app.route('/api/search')
+@login_required
+def api_search():
+    """Full-text search over transaction descriptions (payee, CNPJ, history)"""
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({'error': 'Parâmetro q é obrigatório'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', SEARCH_LIMIT)), 1), 500)
+    except ValueError:
+        return jsonify({'error': 'Parâmetro limit inválido'}), 400
 
+    direction, filters = get_api_filters()
+    query, params = build_ledger_query(direction, **filters)
+    query += " LIMIT ?"
+    params.append(limit)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    results = [serialize_ledger_row(row) for row in cursor.fetchall()]
     conn.close()
-    return render_template('transacoes_internas.html',
-                         transactions=transactions,
-                         totals=totals,
-                         tipo_filtro=tipo_filtro,
-                         cnpj_filtro=cnpj_filtro,
-                         start_date=start_date,
-                         end_date=end_date,
-                         cnpjs=cnpjs,
-                         failed_cnpjs=0)
+
+    return jsonify({'q': q, 'count': len(results), 'transactions': results})
+
+EXPORT_FORMATS = ['csv', 'xlsx']
+EXPORT_HEADER = ['Data', 'Tipo', 'Descrição', 'Documento', 'Valor']
+
+def export_rows(direction, filters):
+    """Yield batches of export rows straight from the database cursor"""
+    query, params = build_ledger_query(direction, **filters)
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(API_FETCH_SIZE)
+            if not rows:
+                break
+            yield [
+                (
+                    db.day_to_date(row['day']),
+                    row['displayed_type'],
+                    row['description'],
+                    row['document'] or '',
+                    # Same sign convention as the HTML views
+                    db.from_cents(abs(row['amount_cents']) if direction == 'enviados'
+                                  else row['amount_cents'])
+                )
+                for row in rows
+            ]
+    finally:
+        conn.close()
+
+def stream_csv_export(direction, filters):
+    """Stream the export as CSV formatted for Excel in pt-BR"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+
+    # BOM so Excel detects UTF-8
+    buffer.write('\ufeff')
+    writer.writerow(EXPORT_HEADER)
+    yield buffer.getvalue()
+
+    for batch in export_rows(direction, filters):
+        buffer.seek(0)
+        buffer.truncate()
+        for date, tipo, description, document, value in batch:
+            writer.writerow([
+                date.strftime('%d/%m/%Y'),
+                tipo,
+                description,
+                document,
+                f'{value:.2f}'.replace('.', ',')
+            ])
+        yield buffer.getvalue()
+
+# Size up to which an XLSX export is assembled in memory, not in a temporary file
+XLSX_SPOOL_BYTES = 8 * 1024 * 1024
+
+def xlsx_export(direction, filters):
+    """The export as XLSX, sent in chunks once it is complete.
+
+    Unlike the CSV, the XLSX is not streamed: openpyxl only writes the
+    sheet into the zip when the workbook is saved, so the first byte goes
+    out after the last row was read. Write-only mode keeps the rows in a
+    temporary file instead of memory, and the zip is assembled in a
+    spooled temporary file (on disk past XLSX_SPOOL_BYTES).
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=direction.capitalize())
+    sheet.append(EXPORT_HEADER)
+    for batch in export_rows(direction, filters):
+        for row in batch:
+            sheet.append(row)
+
+    with tempfile.SpooledTemporaryFile(max_size=XLSX_SPOOL_BYTES) as f:
+        workbook.save(f)
+        f.seek(0)
+        while True:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
+
+@app.route('/export/<direction>')
+@login_required
+def export_ledger(direction):
+    """Export a ledger view, with the same filters, as CSV or XLSX"""
+    if direction not in LEDGER_DIRECTIONS:
+        abort(404)
+
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        abort(400, description=f"format deve ser um de: {', '.join(EXPORT_FORMATS)}")
+
+    filters = get_ledger_filters()
+    filename = f"{direction}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+
+    if export_format == 'csv':
+        body = stream_csv_export(direction, filters)
+        mimetype = 'text/csv'
+    else:
+        # Buffered until complete (see xlsx_export)
+        body = xlsx_export(direction, filters)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
 @app.route('/dashboard')
 @login_required
@@ -978,62 +1169,61 @@ def dashboard():
     cursor = conn.cursor()
     
     # Base exclusion clause
-    base_exclusion = '''
+    exclusion, base_params = description_match(AF_DESCRIPTION_EXCLUSIONS, negate=True)
+    base_exclusion = f'''
         AND (
             t.document NOT IN ('50389827000107','43077430000114','53720093000195','55072511000100','17814862000150')
             OR t.document IS NULL
         )
-        AND t.description NOT LIKE '%AF ENERGY SOLAR 360%'
-        AND t.description NOT LIKE '%AF 360 CORRETORA DE SEGUROS%'
-        AND t.description NOT LIKE '%AF CREDITO BANK%'
-        AND t.description NOT LIKE '%AF COMERCIO DE CALCADOS%'
-        AND t.description NOT LIKE '%AF 360 FRANQUIAS%'
-        AND t.description NOT LIKE '%AF 360 CORRETORA%'
+        AND {exclusion}
     '''
 
     # Main totals query
     cursor.execute(f'''
         SELECT 
-            COALESCE(SUM(CASE WHEN value > 0 THEN value ELSE 0 END), 0) as total_received,
-            COALESCE(SUM(CASE WHEN value < 0 THEN ABS(value) ELSE 0 END), 0) as total_sent,
-            COALESCE(SUM(CASE WHEN type = 'JUROS' THEN ABS(value) ELSE 0 END), 0) as juros,
-            COALESCE(SUM(CASE WHEN type = 'IOF' THEN ABS(value) ELSE 0 END), 0) as iof,
-            COALESCE(SUM(CASE WHEN type IN ('TARIFA', 'TAR', 'TAXA') THEN ABS(value) ELSE 0 END), 0) as tarifa,
-            COALESCE(SUM(CASE WHEN type = 'MULTA' THEN ABS(value) ELSE 0 END), 0) as multa,
-            COALESCE(SUM(CASE WHEN type = 'PIX RECEBIDO' THEN value ELSE 0 END), 0) as pix_recebido,
-            COALESCE(SUM(CASE WHEN type = 'TED RECEBIDA' THEN value ELSE 0 END), 0) as ted_recebida,
-            COALESCE(SUM(CASE WHEN type = 'PIX ENVIADO' THEN ABS(value) ELSE 0 END), 0) as pix_enviado,
-            COALESCE(SUM(CASE WHEN type = 'TED ENVIADA' THEN ABS(value) ELSE 0 END), 0) as ted_enviada
-        FROM transactions t
+            COALESCE(SUM(CASE WHEN amount_cents > 0 THEN amount_cents ELSE 0 END), 0) as total_received,
+            COALESCE(SUM(CASE WHEN amount_cents < 0 THEN ABS(amount_cents) ELSE 0 END), 0) as total_sent,
+            COALESCE(SUM(CASE WHEN type = 'JUROS' THEN ABS(amount_cents) ELSE 0 END), 0) as juros,
+            COALESCE(SUM(CASE WHEN type = 'IOF' THEN ABS(amount_cents) ELSE 0 END), 0) as iof,
+            COALESCE(SUM(CASE WHEN type IN ('TARIFA', 'TAR', 'TAXA') THEN ABS(amount_cents) ELSE 0 END), 0) as tarifa,
+            COALESCE(SUM(CASE WHEN type = 'MULTA' THEN ABS(amount_cents) ELSE 0 END), 0) as multa,
+            COALESCE(SUM(CASE WHEN type = 'PIX RECEBIDO' THEN amount_cents ELSE 0 END), 0) as pix_recebido,
+            COALESCE(SUM(CASE WHEN type = 'TED RECEBIDA' THEN amount_cents ELSE 0 END), 0) as ted_recebida,
+            COALESCE(SUM(CASE WHEN type = 'PIX ENVIADO' THEN ABS(amount_cents) ELSE 0 END), 0) as pix_enviado,
+            COALESCE(SUM(CASE WHEN type = 'TED ENVIADA' THEN ABS(amount_cents) ELSE 0 END), 0) as ted_enviada
+        FROM ledger t
         WHERE 1=1 {base_exclusion}
-    ''')
+    ''', base_params)
     
     row = cursor.fetchone()
     totals = {
-        'recebidos': float(row[0] or 0),
-        'enviados': float(row[1] or 0),
-        'juros': float(row[2] or 0),
-        'iof': float(row[3] or 0),
-        'tarifa': float(row[4] or 0),
-        'multa': float(row[5] or 0),
-        'pix_recebido': float(row[6] or 0),
-        'ted_recebida': float(row[7] or 0),
-        'pix_enviado': float(row[8] or 0),
-        'ted_enviada': float(row[9] or 0)
+        'recebidos': db.from_cents(row[0]),
+        'enviados': db.from_cents(row[1]),
+        'juros': db.from_cents(row[2]),
+        'iof': db.from_cents(row[3]),
+        'tarifa': db.from_cents(row[4]),
+        'multa': db.from_cents(row[5]),
+        'pix_recebido': db.from_cents(row[6]),
+        'ted_recebida': db.from_cents(row[7]),
+        'pix_enviado': db.from_cents(row[8]),
+        'ted_enviada': db.from_cents(row[9])
     }
 
     # Monthly data query
     cursor.execute(f'''
         SELECT 
             date || ' - ' || date(date, '+10 days') as period,
-            COALESCE(SUM(CASE WHEN value > 0 THEN value ELSE 0 END), 0) as received,
-            COALESCE(SUM(CASE WHEN value < 0 THEN ABS(value) ELSE 0 END), 0) as sent
-        FROM transactions t
-        WHERE 1=1 {base_exclusion}
+            COALESCE(SUM(CASE WHEN amount_cents > 0 THEN amount_cents ELSE 0 END), 0) as received,
+            COALESCE(SUM(CASE WHEN amount_cents < 0 THEN ABS(amount_cents) ELSE 0 END), 0) as sent
+        FROM (
+            SELECT {db.iso_date_sql('t.day')} AS date, t.amount_cents
+            FROM ledger t
+            WHERE 1=1 {base_exclusion}
+        )
         GROUP BY (julianday(date) - julianday('2024-01-01')) / 10
         ORDER BY date DESC
         LIMIT 12
-    ''')
+    ''', base_params)
     
     monthly_data = cursor.fetchall()
     months = []
@@ -1041,55 +1231,40 @@ def dashboard():
     sent = []
     for row in monthly_data:
         months.insert(0, row[0])
-        received.insert(0, float(row[1]))
-        sent.insert(0, float(row[2]))
+        received.insert(0, db.from_cents(row[1]))
+        sent.insert(0, db.from_cents(row[2]))
 
     # Expenses distribution query
     cursor.execute(f'''
         SELECT 
-            CASE
-                WHEN type IN ('TAXA', 'TARIFA', 'IOF', 'MULTA', 'DEBITO') THEN 'DESPESAS OPERACIONAIS'
-                WHEN type IN ('APLICACAO', 'RESGATE') THEN 'CONTAMAX'
-                WHEN type IN ('COMPENSACAO', 'CHEQUE') THEN 'CHEQUE'
-                WHEN type = 'PIX ENVIADO' THEN 'PIX'
-                WHEN type = 'TED ENVIADA' THEN 'TED'
-                WHEN type = 'PAGAMENTO' THEN 'PAGAMENTO'
-                ELSE 'DIVERSOS'
-            END as category,
-            COALESCE(SUM(ABS(value)), 0) as total_value
-        FROM transactions t
-        WHERE value < 0 {base_exclusion}
-        GROUP BY CASE
-                WHEN type IN ('TAXA', 'TARIFA', 'IOF', 'MULTA', 'DEBITO') THEN 'DESPESAS OPERACIONAIS'
-                WHEN type IN ('APLICACAO', 'RESGATE') THEN 'CONTAMAX'
-                WHEN type IN ('COMPENSACAO', 'CHEQUE') THEN 'CHEQUE'
-                WHEN type = 'PIX ENVIADO' THEN 'PIX'
-                WHEN type = 'TED ENVIADA' THEN 'TED'
-                WHEN type = 'PAGAMENTO' THEN 'PAGAMENTO'
-                ELSE 'DIVERSOS'
-            END
+            c.name as category,
+            COALESCE(SUM(ABS(t.amount_cents)), 0) as total_value
+        FROM ledger t
+        JOIN categories c ON c.id = t.category
+        WHERE t.amount_cents < 0 {base_exclusion}
+        GROUP BY t.category
         ORDER BY total_value DESC
-    ''')
+    ''', base_params)
     
     expense_data = cursor.fetchall()
     expense_types = []
     expense_values = []
     for row in expense_data:
-        if float(row[1]) > 0:
+        if row[1] > 0:
             expense_types.append(row[0])
-            expense_values.append(float(row[1]))
+            expense_values.append(db.from_cents(row[1]))
 
     # Top CNPJs query
     cursor.execute(f'''
         SELECT 
             document,
-            COALESCE(SUM(ABS(value)), 0) as total
-        FROM transactions t
+            COALESCE(SUM(ABS(amount_cents)), 0) as total
+        FROM ledger t
         WHERE document IS NOT NULL {base_exclusion}
         GROUP BY document
         ORDER BY total DESC
         LIMIT 5
-    ''')
+    ''', base_params)
     
     top_cnpjs = []
     for row in cursor.fetchall():
@@ -1099,7 +1274,7 @@ def dashboard():
             name = company_info.get('nome_fantasia') or company_info.get('razao_social', cnpj)
             top_cnpjs.append({
                 'name': name,
-                'value': float(row[1])
+                'value': db.from_cents(row[1])
             })
 
     conn.close()
@@ -1123,59 +1298,8 @@ def retry_failed_cnpjs():
 @login_required
 def retry_failed_cnpjs_post():
     # POST request - retry failed CNPJs
-    success_count = 0
-    still_failed = set()
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
-        for cnpj in failed_cnpjs.copy():
-            try:
-                # Handle 15-digit CNPJ
-                api_cnpj = cnpj
-                if len(cnpj) == 15 and cnpj.startswith('0'):
-                    api_cnpj = cnpj[1:]  # Remove first zero only if 15 digits
-                
-                response = requests.get(f'https://brasilapi.com.br/api/cnpj/v1/{api_cnpj}', timeout=5)
-                if response.status_code == 200:
-                    data = response.json()
-                    cnpj_cache[cnpj] = data
-                    
-                    # Atualiza as descrições no banco de dados
-                    cursor.execute('''
-                        SELECT id, description FROM transactions 
-                        WHERE description LIKE ?
-                    ''', (f'%{cnpj}%',))
-                    
-                    rows = cursor.fetchall()
-                    for row in rows:
-                        transaction_id, description = row
-                        new_description = description.replace(cnpj, f"{data['razao_social']} (CNPJ: {cnpj})")
-                        cursor.execute('''
-                            UPDATE transactions 
-                            SET description = ? 
-                            WHERE id = ?
-                        ''', (new_description, transaction_id))
-                    
-                    success_count += 1
-                else:
-                    still_failed.add(cnpj)
-                    print(f"Falha ao buscar CNPJ {api_cnpj}: Status {response.status_code}")
-            except Exception as e:
-                still_failed.add(cnpj)
-                print(f"Erro ao processar CNPJ {api_cnpj}: {str(e)}")
-            
-            # Pequena pausa entre requisições para evitar rate limit
-            time.sleep(0.5)
-        
-        # Commit as alterações
-        conn.commit()
-        
-        # Atualiza o conjunto de CNPJs que falharam
-        failed_cnpjs.clear()
-        failed_cnpjs.update(still_failed)
-        
+        success_count, still_failed = retry_cnpj_lookups()
         return jsonify({
             'success': True,
             'message': f'Retry concluído. {success_count} CNPJs recuperados. {len(still_failed)} ainda com falha.',
@@ -1183,14 +1307,13 @@ def retry_failed_cnpjs_post():
         })
     
     except Exception as e:
-        print(f"Erro geral no retry: {str(e)}")
+        logger.exception("Erro geral no retry")
         return jsonify({
             'success': False,
             'message': f'Erro ao processar retry: {str(e)}'
         }), 500
-    
-    finally:
-        conn.close()
+
+SUMMARY_PAGE_SIZE = 50
 
 @app.route('/transactions-summary')
 @login_required
@@ -1200,47 +1323,72 @@ def transactions_summary():
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Updated query to include all transaction types
+    # Only counts and totals; the transactions of each category are loaded on demand
     cursor.execute("""
         SELECT 
-            CASE
-                WHEN type IN ('APLICACAO', 'RESGATE') THEN 'CONTAMAX'
-                WHEN type = 'COMPENSACAO' OR type = 'CHEQUE' THEN 'CHEQUE'
-                WHEN type IN ('TAXA', 'TARIFA', 'IOF', 'MULTA', 'DEBITO') THEN 'DESPESAS OPERACIONAIS'
-                ELSE type
-            END as type,
+            c.name as type,
             COUNT(*) as count,
-            SUM(value) as total,
-            GROUP_CONCAT(description || ' (' || value || ')') as details
-        FROM transactions 
-        GROUP BY 
-            CASE
-                WHEN type IN ('APLICACAO', 'RESGATE') THEN 'CONTAMAX'
-                WHEN type = 'COMPENSACAO' OR type = 'CHEQUE' THEN 'CHEQUE'
-                WHEN type IN ('TAXA', 'TARIFA', 'IOF', 'MULTA', 'DEBITO') THEN 'DESPESAS OPERACIONAIS'
-                ELSE type
-            END
+            SUM(t.amount_cents) as total
+        FROM ledger t
+        JOIN categories c ON c.id = t.category
+        GROUP BY t.category
         ORDER BY 
             CASE 
-                WHEN type IN ('PIX RECEBIDO', 'TED RECEBIDA', 'PAGAMENTO') THEN 1
+                WHEN c.name IN ('PIX RECEBIDO', 'TED RECEBIDA', 'PAGAMENTO') THEN 1
                 ELSE 2
             END,
-            ABS(SUM(value)) DESC
+            ABS(SUM(t.amount_cents)) DESC
     """)
     
     summary = {}
     for row in cursor.fetchall():
         summary[row[0]] = {
             'count': row[1],
-            'total': row[2],
-            'details': row[3].split(',') if row[3] else []
+            'total': db.from_cents(row[2])
         }
     
     conn.close()
     
     return render_template('transactions_summary.html', 
                          active_page='transactions_summary',
-                         summary=summary)
+                         summary=summary,
+                         page_size=SUMMARY_PAGE_SIZE)
+
+@app.route('/transactions-summary/details')
+@login_required
+def transactions_summary_details():
+    """Return one page of the transactions of a summary category"""
+    tipo = request.args.get('type', '')
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', SUMMARY_PAGE_SIZE)), 1), 500)
+    except ValueError:
+        return jsonify({'error': 'Parâmetros de paginação inválidos'}), 400
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    # Fetch one extra row to know whether there is a next page
+    cursor.execute("""
+        SELECT day, description, amount_cents
+        FROM ledger
+        WHERE category = ?
+        ORDER BY day DESC, id DESC
+        LIMIT ? OFFSET ?
+    """, (CATEGORY_IDS.get(tipo, 0), per_page + 1, (page - 1) * per_page))
+    rows = cursor.fetchall()
+    conn.close()
+
+    return jsonify({
+        'type': tipo,
+        'page': page,
+        'per_page': per_page,
+        'has_more': len(rows) > per_page,
+        'transactions': [
+            {'date': db.day_to_iso(row[0]), 'description': row[1], 'value': db.from_cents(row[2])}
+            for row in rows[:per_page]
+        ]
+    })
 
 @app.route('/verify-cnpj', methods=['GET', 'POST'])
 @login_required
@@ -1263,7 +1411,7 @@ def verify_cnpj(cnpj):
                 'cnpj': cnpj
             })
     except Exception as e:
-        print(f"Erro ao verificar CNPJ {cnpj}: {e}")
+        logger.warning("Erro ao verificar CNPJ %s: %s", cnpj, e)
         return jsonify({'valid': False, 'error': str(e), 'cnpj': cnpj})
     
     return jsonify({'valid': False, 'cnpj': cnpj})
@@ -1275,75 +1423,6 @@ def cnpj_verification_page():
         return redirect('https://af360bank.onrender.com/login')
     return render_template('cnpj_verification.html', active_page='cnpj_verification')
 
-def extract_and_enrich_cnpj(description, transaction_type):
-    """Extract and enrich CNPJ information in description"""
-    import re
-    import requests
-    from requests.adapters import HTTPAdapter
-    from requests.packages.urllib3.util.retry import Retry
-    
-    # Check if description is already enriched
-    if '(CNPJ:' in description:
-        return description
-        
-    cnpj_patterns = [
-        r'CNPJ[:\s]*(\d{14,15})',
-        r'CNPJ[:\s]*(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})',
-        r'\b(\d{14,15})\b',
-        r'\b(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})\b'
-    ]
-    
-    # Setup session with retries
-    session = requests.Session()
-    retries = Retry(total=3, backoff_factor=0.5)
-    session.mount('https://', HTTPAdapter(max_retries=retries))
-    
-    for pattern in cnpj_patterns:
-        match = re.search(pattern, description)
-        if match:
-            cnpj = ''.join(filter(str.isdigit, match.group(1)))
-            if len(cnpj) == 15 and cnpj.startswith('0'):
-                cnpj = cnpj[1:]
-            elif len(cnpj) != 14:
-                continue
-                
-            try:
-                if cnpj in cnpj_cache:
-                    company_info = cnpj_cache[cnpj]
-                else:
-                    response = session.get(f'https://brasilapi.com.br/api/cnpj/v1/{cnpj}', timeout=10)
-                    if response.status_code == 200:
-                        company_info = response.json()
-                        cnpj_cache[cnpj] = company_info
-                        if cnpj in failed_cnpjs:
-                            failed_cnpjs.remove(cnpj)
-                    else:
-                        failed_cnpjs.add(cnpj)
-                        return description
-                
-                razao_social = company_info.get('razao_social', '')
-                
-                if razao_social:
-                    # Handle different transaction types
-                    if 'PIX RECEBIDO' in description or 'TED RECEBIDA' in description:
-                        prefix = 'PIX RECEBIDO' if 'PIX RECEBIDO' in description else 'TED RECEBIDA'
-                        return f"{prefix} {razao_social} (CNPJ: {cnpj})"
-                    elif 'PAGAMENTO' in description:
-                        prefix = re.sub(r'\s*CNPJ\s*\d+.*$', '', description)
-                        prefix = re.sub(r'\s+0\s+', ' ', prefix)
-                        return f"{prefix} {razao_social} (CNPJ: {cnpj})"
-                    
-                    parts = description.split(cnpj, 1)
-                    prefix = parts[0].strip()
-                    prefix = re.sub(r'\s*CNPJ\s*$', '', prefix)
-                    return f"{prefix} {razao_social} (CNPJ: {cnpj})"
-                    
-            except Exception as e:
-                print(f"Erro ao indentificar CNPJ {cnpj}: {str(e)}")
-                failed_cnpjs.add(cnpj)
-                
-    return description
-
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5002))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,92 @@
+"""Static assets: fingerprinted names, precompressed variants, long caching.
+
+url_for('static', filename='css/style.css') gives
+/static/css/style.<hash>.css, hash being the start of the SHA-256 of the
+file. Such a URL always has the same content, so it is cached by the
+browser for a year without revalidation; a changed file gets a new URL.
+The manifest is built on the first use in each process: every file is
+read once and the compressible ones are compressed then (gzip, and
+brotli when installed), so requests only pick the variant the client
+accepts. Names without the hash are still served, with the default short
+cache. In debug mode the URLs are left alone so edits show up on reload.
+"""
+import hashlib
+import mimetypes
+import os
+import threading
+from collections import namedtuple
+from flask import Response, current_app, request
+import compression
+
+# Hex digits of the content hash put in the file names
+FINGERPRINT_LENGTH = 10
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+
+# Content of an asset in each encoding ('identity' included)
+Asset = namedtuple('Asset', ['mimetype', 'digest', 'variants'])
+
+_manifest = None
+_lock = threading.Lock()
+
+def fingerprinted_name(filename, digest):
+    stem, extension = os.path.splitext(filename)
+    return f'{stem}.{digest}{extension}'
+
+def load_asset(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    variants = {'identity': data}
+    if compression.is_compressible(mimetype):
+        for encoding in compression.available_encodings():
+            compressed = compression.compress(data, encoding)
+            if len(compressed) < len(data):
+                variants[encoding] = compressed
+    return Asset(mimetype, hashlib.sha256(data).hexdigest()[:FINGERPRINT_LENGTH], variants)
+
+def build_manifest(static_folder):
+    """({name: fingerprinted name}, {fingerprinted name: Asset}) of the static folder"""
+    names = {}
+    assets = {}
+    for directory, _, files in os.walk(static_folder):
+        for file in files:
+            path = os.path.join(directory, file)
+            filename = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            asset = load_asset(path)
+            names[filename] = fingerprinted_name(filename, asset.digest)
+            assets[names[filename]] = asset
+    return names, assets
+
+def manifest():
+    global _manifest
+    if _manifest is None:
+        with _lock:
+            if _manifest is None:
+                _manifest = build_manifest(current_app.static_folder)
+    return _manifest
+
+def fingerprint_url(endpoint, values):
+    """url_defaults: point url_for('static') at the fingerprinted name"""
+    if endpoint == 'static' and 'filename' in values and not current_app.debug:
+        names, _ = manifest()
+        values['filename'] = names.get(values['filename'], values['filename'])
+
+def serve_static(filename):
+    """The static endpoint: fingerprinted names from memory, others from disk"""
+    asset = manifest()[1].get(filename)
+    if asset is None:
+        return current_app.send_static_file(filename)
+
+    encoding = compression.accepted_encoding([e for e in asset.variants if e != 'identity'])
+    response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    if len(asset.variants) > 1:
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE
+    response.set_etag(f'{asset.digest}-{encoding}')
+    return response.make_conditional(request)
+
+def init_app(app):
+    app.view_functions['static'] = serve_static
+    app.url_defaults(fingerprint_url)
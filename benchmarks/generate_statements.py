@@ -0,0 +1,265 @@
+"""Synthetic Santander and Itaú statements for benchmarks.
+
+The files follow the layout of the real exports: a preamble with the
+account, the header row, one row per entry with a running balance,
+PIX/TED descriptions carrying CNPJs, transfers between the AF companies
+and the CONTAMAX and cheque pairs removed by cleanup_paired_transactions.
+The extension of the output file picks the format (xlsx, csv or ofx).
+
+    python -m benchmarks.generate_statements santander 100000 santander.xlsx
+"""
+import csv
+import os
+import random
+import sys
+from datetime import date, datetime, timedelta
+
+from openpyxl import Workbook
+
+BANKS = ['santander', 'itau']
+
+ROWS_PER_DAY = 40
+START_DATE = date(2023, 1, 2)
+OPENING_BALANCE = 100000.0
+
+NAMES = [
+    'COMERCIAL SAO JORGE', 'DISTRIBUIDORA NORTE SUL', 'MERCADO BOM PRECO', 'TRANSPORTES RAPIDO',
+    'CONSTRUTORA HORIZONTE', 'PADARIA PAO DOURADO', 'AUTO PECAS CENTRAL', 'FARMACIA VIDA',
+    'TECNOLOGIA AVANCADA', 'ESCRITORIO CONTABIL SILVA', 'POSTO ESTRELA', 'GRAFICA MODERNA',
+    'LOGISTICA INTEGRADA', 'ALIMENTOS DA TERRA', 'METALURGICA PAULISTA', 'CLINICA SAUDE TOTAL'
+]
+
+AF_COMPANIES = {
+    '50389827000107': 'AF ENERGY SOLAR 360',
+    '43077430000114': 'AF 360 CORRETORA DE SEGUROS LTDA',
+    '53720093000195': 'AF CREDITO BANK',
+    '55072511000100': 'AF COMERCIO DE CALCADOS LTDA',
+    '17814862000150': 'AF 360 FRANQUIAS LTDA'
+}
+
+def make_counterparties(count=200, seed=0):
+    """CNPJ -> company name of the external counterparties"""
+    rnd = random.Random(seed)
+    counterparties = {}
+    while len(counterparties) < count:
+        cnpj = f'{rnd.randrange(10**7, 10**8)}0001{rnd.randrange(10, 100)}'
+        counterparties[cnpj] = f'{rnd.choice(NAMES)} {len(counterparties) + 1} LTDA'
+    return counterparties
+
+COUNTERPARTIES = make_counterparties()
+
+def format_cnpj(cnpj):
+    return f'{cnpj[:2]}.{cnpj[2:5]}.{cnpj[5:8]}/{cnpj[8:12]}-{cnpj[12:]}'
+
+# Entry kinds and their weights: (kind, weight)
+KINDS = [
+    ('pix_in', 20), ('pix_out', 18), ('ted_in', 8), ('ted_out', 7), ('boleto', 10),
+    ('tarifa', 6), ('iof', 3), ('juros', 2), ('compra', 6), ('aplicacao', 3),
+    ('internal_in', 3), ('internal_out', 3), ('diversos', 4),
+    ('contamax_pair', 2), ('cheque_pair', 2)
+]
+
+def entries(rows, seed=0):
+    """Yield (date, kind, value, cnpj, name) tuples, pairs on the same day"""
+    rnd = random.Random(seed)
+    kinds = [kind for kind, _ in KINDS]
+    weights = [weight for _, weight in KINDS]
+    external = list(COUNTERPARTIES.items())
+    internal = list(AF_COMPANIES.items())
+
+    produced = 0
+    while produced < rows:
+        day = START_DATE + timedelta(days=produced // ROWS_PER_DAY)
+        kind = rnd.choices(kinds, weights)[0]
+        value = round(rnd.lognormvariate(6, 1.5), 2) + 0.01
+        cnpj, name = rnd.choice(internal if kind.startswith('internal') else external)
+
+        if kind == 'contamax_pair' and produced + 2 <= rows:
+            yield day, 'resgate_contamax', value, None, None
+            yield day, 'cancelamento_resgate', -value, None, None
+            produced += 2
+        elif kind == 'cheque_pair' and produced + 2 <= rows:
+            yield day, 'cheque_emitido', -value, None, None
+            yield day, 'cheque_devolvido', value, None, None
+            produced += 2
+        elif not kind.endswith('_pair'):
+            sign = 1 if kind in ('pix_in', 'ted_in', 'internal_in', 'diversos') else -1
+            yield day, kind, sign * value, cnpj, name
+            produced += 1
+
+# Descriptions of the entries without a counterparty
+SANTANDER_FIXED = {
+    'tarifa': 'TARIFA BANCARIA PACOTE SERVICOS',
+    'iof': 'IOF IMPOSTO OPERACOES FINANCEIRAS',
+    'juros': 'JUROS SALDO DEVEDOR',
+    'aplicacao': 'APLICACAO CONTAMAX EMPRESARIAL',
+    'diversos': 'ESTORNO DE LANCAMENTO',
+    'resgate_contamax': 'RESGATE CONTAMAX AUTOMATICO',
+    'cancelamento_resgate': 'CANCELAMENTO RESGATE CONTAMAX',
+    'cheque_emitido': 'CHEQUE EMITIDO/DEBITADO',
+    'cheque_devolvido': 'CHEQUE DEVOLVIDO MOTIVO 11'
+}
+
+ITAU_FIXED = {
+    'tarifa': 'TAR PACOTE ITAU',
+    'iof': 'IOF',
+    'juros': 'JUROS LIMITE DA CONTA',
+    'aplicacao': 'APLICACAO AUTOMATICA',
+    'diversos': 'DEVOLUCAO',
+    'resgate_contamax': 'RESGATE CONTAMAX',
+    'cancelamento_resgate': 'CANCELAMENTO RESGATE',
+    'cheque_emitido': 'CHEQUE COMPENSADO',
+    'cheque_devolvido': 'CHEQUE DEVOLVIDO'
+}
+
+def santander_description(kind, cnpj, name, rnd):
+    if kind in SANTANDER_FIXED:
+        return SANTANDER_FIXED[kind]
+    if kind == 'pix_in':
+        return f'PIX RECEBIDO {cnpj} {name}'
+    if kind == 'pix_out':
+        return f'PIX ENVIADO {format_cnpj(cnpj)} {name}'
+    if kind == 'ted_in':
+        return f'TED RECEBIDA CNPJ {cnpj} {name}'
+    if kind == 'ted_out':
+        return f'TED ENVIADA CNPJ {cnpj} {name}'
+    if kind == 'internal_in':
+        return f'TED RECEBIDA {name} CNPJ {cnpj}'
+    if kind == 'internal_out':
+        return f'PIX ENVIADO {name} CNPJ {cnpj}'
+    if kind == 'boleto':
+        return f'PAGAMENTO DE BOLETO {name}'
+    return f'COMPRA CARTAO DEB {name}'
+
+def itau_description(kind, cnpj, name, rnd):
+    if kind in ITAU_FIXED:
+        return ITAU_FIXED[kind]
+    if kind in ('ted_in', 'ted_out'):
+        return f'TED {rnd.randrange(1, 999):03d}.{rnd.randrange(1000, 9999)} {name[:20]}'
+    if kind == 'boleto':
+        return f'SISPAG FORNECEDORES {name[:15]}'
+    if kind == 'compra':
+        return f'COMPRA CARTAO {name[:15]}'
+    return f'PIX TRANSF {name[:20]}'
+
+def brl(value):
+    """Format a value as Itaú exports it: 1.234,56"""
+    return f'{value:,.2f}'.replace(',', 'X').replace('.', ',').replace('X', '.')
+
+SANTANDER_PREAMBLE = [
+    ['Extrato de Conta Corrente'],
+    ['Agência: 0715  Conta: 13001234-5'],
+    [f'Período: {START_DATE.strftime("%d/%m/%Y")} a {date.today().strftime("%d/%m/%Y")}'],
+    []
+]
+SANTANDER_HEADER = ['Data', 'Histórico', 'Docto.', 'Valor (R$)', 'Saldo (R$)']
+
+ITAU_PREAMBLE = [['Extrato Conta Corrente'], ['agência 1234 conta 56789-0']]
+ITAU_HEADER = ['data', 'lançamento', 'ag./origem', 'valor (R$)', 'saldo (R$)']
+
+def santander_rows(rows, seed=0):
+    """Rows below the header of a Santander statement with rows entries"""
+    rnd = random.Random(seed + 1)
+    balance = OPENING_BALANCE
+    for index, (day, kind, value, cnpj, name) in enumerate(entries(rows, seed)):
+        balance = round(balance + value, 2)
+        yield [
+            day.strftime('%d/%m/%Y'),
+            santander_description(kind, cnpj, name, rnd),
+            f'{index % 1000000:06d}',
+            value,
+            balance
+        ]
+
+def itau_rows(rows, seed=0):
+    """Rows below the header of an Itaú statement, plus daily balance lines"""
+    rnd = random.Random(seed + 2)
+    balance = OPENING_BALANCE
+    current_day = None
+    for day, kind, value, cnpj, name in entries(rows, seed):
+        if current_day is not None and day != current_day:
+            yield [current_day.strftime('%d/%m/%Y'), 'SALDO DO DIA', None, None, brl(balance)]
+        current_day = day
+        balance = round(balance + value, 2)
+        origin = f'{rnd.randrange(1000, 9999)}' if kind in ('ted_in', 'ted_out') else None
+        yield [day.strftime('%d/%m/%Y'), itau_description(kind, cnpj, name, rnd), origin, brl(value), None]
+    if current_day is not None:
+        yield [current_day.strftime('%d/%m/%Y'), 'SALDO DO DIA', None, None, brl(balance)]
+
+# bank -> (sheet title, preamble, header, rows function, BANKID)
+LAYOUTS = {
+    'santander': ('Extrato', SANTANDER_PREAMBLE, SANTANDER_HEADER, santander_rows, '033'),
+    'itau': ('Lançamentos', ITAU_PREAMBLE, ITAU_HEADER, itau_rows, '0341')
+}
+
+def write_xlsx(bank, path, rows, seed=0):
+    title, preamble, header, body, _ = LAYOUTS[bank]
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title)
+    for line in preamble + [header]:
+        sheet.append(line)
+    for line in body(rows, seed):
+        sheet.append(line)
+    workbook.save(path)
+
+def write_csv(bank, path, rows, seed=0):
+    """Same layout as the spreadsheet, ; separated, values as 1.234,56"""
+    _, preamble, header, body, _ = LAYOUTS[bank]
+    with open(path, 'w', encoding='cp1252', newline='') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerows(preamble + [header])
+        for line in body(rows, seed):
+            writer.writerow([brl(cell) if isinstance(cell, float) else cell for cell in line])
+
+def write_ofx(bank, path, rows, seed=0):
+    """OFX 1.x (SGML) statement with the entries of the spreadsheet"""
+    _, _, _, body, bank_id = LAYOUTS[bank]
+    date_col, desc_col, value_col = 0, 1, 3
+    with open(path, 'w', encoding='cp1252', newline='\r\n') as f:
+        f.write('OFXHEADER:100\nDATA:OFXSGML\nVERSION:102\nSECURITY:NONE\nENCODING:USASCII\n'
+                'CHARSET:1252\nCOMPRESSION:NONE\nOLDFILEUID:NONE\nNEWFILEUID:NONE\n\n')
+        f.write('<OFX>\n<SIGNONMSGSRSV1>\n<SONRS>\n<STATUS>\n<CODE>0\n<SEVERITY>INFO\n</STATUS>\n'
+                f'<DTSERVER>{date.today().strftime("%Y%m%d")}120000[-3:BRT]\n<LANGUAGE>POR\n</SONRS>\n</SIGNONMSGSRSV1>\n'
+                '<BANKMSGSRSV1>\n<STMTTRNRS>\n<TRNUID>1\n<STATUS>\n<CODE>0\n<SEVERITY>INFO\n</STATUS>\n'
+                '<STMTRS>\n<CURDEF>BRL\n<BANKACCTFROM>\n'
+                f'<BANKID>{bank_id}\n<ACCTID>130012345\n<ACCTTYPE>CHECKING\n</BANKACCTFROM>\n<BANKTRANLIST>\n')
+        balance = OPENING_BALANCE
+        day = datetime.combine(START_DATE, datetime.min.time())
+        for index, line in enumerate(body(rows, seed)):
+            value = line[value_col]
+            if value is None:
+                continue  # daily balance lines
+            if isinstance(value, str):
+                value = float(value.replace('.', '').replace(',', '.'))
+            balance = round(balance + value, 2)
+            day = datetime.strptime(line[date_col], '%d/%m/%Y')
+            f.write(f'<STMTTRN>\n<TRNTYPE>{"CREDIT" if value > 0 else "DEBIT"}\n'
+                    f'<DTPOSTED>{day.strftime("%Y%m%d")}000000[-3:BRT]\n<TRNAMT>{value:.2f}\n'
+                    f'<FITID>{index}\n<MEMO>{line[desc_col]}\n</STMTTRN>\n')
+        f.write(f'</BANKTRANLIST>\n<LEDGERBAL>\n<BALAMT>{balance:.2f}\n'
+                f'<DTASOF>{day.strftime("%Y%m%d")}\n</LEDGERBAL>\n</STMTRS>\n</STMTTRNRS>\n</BANKMSGSRSV1>\n</OFX>\n')
+
+WRITERS = {'xlsx': write_xlsx, 'csv': write_csv, 'ofx': write_ofx}
+FORMATS = list(WRITERS)
+
+def write_statement(bank, path, rows, seed=0):
+    """Write a statement in the format given by the extension of path"""
+    WRITERS[os.path.splitext(path)[1].lstrip('.').lower()](bank, path, rows, seed)
+
+def write_santander(path, rows, seed=0):
+    write_statement('santander', path, rows, seed)
+
+def write_itau(path, rows, seed=0):
+    write_statement('itau', path, rows, seed)
+
+def main():
+    if (len(sys.argv) != 4 or sys.argv[1] not in BANKS
+            or os.path.splitext(sys.argv[3])[1].lstrip('.').lower() not in WRITERS):
+        print(f'uso: python -m benchmarks.generate_statements {{{"|".join(BANKS)}}} LINHAS '
+              f'ARQUIVO.{{{"|".join(FORMATS)}}}')
+        return 2
+    write_statement(sys.argv[1], sys.argv[3], int(sys.argv[2]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
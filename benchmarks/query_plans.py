@@ -0,0 +1,124 @@
+"""Query plan regression check for the ledger routes.
+
+Seeds a temporary database, requests every route with the Flask test
+client, runs EXPLAIN QUERY PLAN on each SELECT the route executed and
+exits with status 1 when a plan reads a table without an index or sorts
+with a temp B-tree where that was not expected.
+
+    python -m benchmarks.query_plans [rows]
+"""
+import random
+import re
+import sys
+
+from benchmarks.support import load_app
+
+SEED_ROWS = 20000
+
+# Small lookup tables that may be scanned (c is the categories alias)
+LOOKUP_TABLES = {'categories', 'c', 'ledger_state'}
+
+GROUP_SORT = 'USE TEMP B-TREE FOR GROUP BY'
+ORDER_SORT = 'USE TEMP B-TREE FOR ORDER BY'
+
+# Route and the temp B-trees it is allowed to use
+ROUTES = [
+    ('/recebidos', set()),
+    ('/recebidos?tipo=PIX%20RECEBIDO', set()),
+    ('/recebidos?start_date=2024-03-01&end_date=2024-04-30', set()),
+    ('/recebidos?cnpj=11222333000181', set()),
+    ('/enviados', set()),
+    ('/enviados?tipo=DESPESAS%20OPERACIONAIS&start_date=2024-02-01', set()),
+    ('/enviados?cnpj=11222333000181&start_date=2024-03-01', set()),
+    # Rows driven by the FTS match list are sorted (and grouped for the
+    # totals) afterwards
+    ('/recebidos?q=FULANO', {GROUP_SORT, ORDER_SORT}),
+    ('/api/search?q=FULANO', {ORDER_SORT}),
+    # Duplicates are collapsed with GROUP BY and ordered by MIN(id)
+    ('/transacoes_internas', {GROUP_SORT, ORDER_SORT}),
+    ('/transacoes_internas?cnpj=53720093000195', {GROUP_SORT, ORDER_SORT}),
+    # 10-day periods and totals ordered by value
+    ('/dashboard', {GROUP_SORT, ORDER_SORT}),
+    ('/transactions-summary', {ORDER_SORT}),
+    ('/transactions-summary/details?type=PIX%20RECEBIDO&page=2', set()),
+    ('/api/transactions', set()),
+    ('/api/transactions?direction=enviados&tipo=CHEQUE', set()),
+    ('/api/summary?direction=recebidos', set()),
+    ('/export/recebidos?format=csv', set()),
+]
+
+TYPES = [
+    ('PIX RECEBIDO', 1), ('TED RECEBIDA', 1), ('PAGAMENTO', 1), ('DIVERSOS', 1), ('RESGATE', 1),
+    ('PIX ENVIADO', -1), ('TED ENVIADA', -1), ('TARIFA', -1), ('IOF', -1), ('COMPRA', -1),
+    ('APLICACAO', -1), ('COMPENSACAO', -1), ('JUROS', -1), ('DEBITO', -1)
+]
+DOCUMENTS = [None, '11222333000181', '99888777000166', '50389827000107', '53720093000195']
+
+def seed(conn, rows):
+    """Fill the ledger with reproducible random transactions"""
+    from categories import category_id_for_type
+
+    rnd = random.Random(0)
+    batch = []
+    for i in range(rows):
+        tipo, sign = rnd.choice(TYPES)
+        cents = sign * rnd.randint(100, 500000)
+        day = 20240000 + rnd.randint(1, 12) * 100 + rnd.randint(1, 28)
+        batch.append((day, f'{tipo} FULANO DE TAL {i}', cents, tipo,
+                      'receita' if cents > 0 else 'despesa',
+                      rnd.choice(DOCUMENTS), category_id_for_type(tipo)))
+    conn.executemany('''
+        INSERT INTO ledger (day, description, amount_cents, type, transaction_type, document, category)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', batch)
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.commit()
+
+def plan_problems(conn, sql, allowed):
+    """Plan lines of sql that are full scans or unexpected sorts"""
+    problems = []
+    for row in conn.execute('EXPLAIN QUERY PLAN ' + sql):
+        detail = row[3]
+        scan = re.match(r'SCAN (\w+)$', detail)
+        if scan and scan.group(1) not in LOOKUP_TABLES:
+            problems.append(detail)
+        elif detail.startswith('USE TEMP B-TREE') and detail not in allowed:
+            problems.append(detail)
+    return problems
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else SEED_ROWS
+
+    appmod, client = load_app()
+    conn = appmod.get_db_connection()
+    seed(conn, rows)
+
+    failures = 0
+    for url, allowed in ROUTES:
+        statements = []
+        conn.set_trace_callback(statements.append)
+        response = client.get(url)
+        response.get_data()
+        conn.set_trace_callback(None)
+
+        queries = [sql for sql in statements
+                   if sql.lstrip().upper().startswith(('SELECT', 'WITH'))]
+        problems = [(sql, plan_problems(conn, sql, allowed)) for sql in queries]
+        problems = [(sql, details) for sql, details in problems if details]
+
+        if response.status_code != 200 or problems:
+            failures += 1
+            print(f'FAIL {url} ({response.status_code}, {len(queries)} queries)')
+            for sql, details in problems:
+                print('    ' + ' '.join(sql.split())[:160])
+                for detail in details:
+                    print(f'        {detail}')
+        else:
+            print(f'ok   {url} ({len(queries)} queries)')
+
+    print(f'{len(ROUTES) - failures}/{len(ROUTES)} routes without plan regressions')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""Check of the CSV reader on malformed lines.
+
+Writes a Santander CSV statement with a description split by a stray
+delimiter, a description quoted over two lines and a bad date after
+them, parses it and exits with status 1 unless the malformed line and
+the bad date are rejected with their line numbers in the file and the
+other entries are read.
+
+    python -m benchmarks.reader_check
+"""
+import os
+import sys
+import tempfile
+
+from benchmarks.generate_statements import write_statement
+from benchmarks.support import ROOT
+
+ROWS = 20
+
+def write_malformed(path):
+    """The statement with its lines changed; (line of the malformed entry,
+    line of the bad date) in the file"""
+    write_statement('santander', path, ROWS)
+    with open(path, encoding='cp1252', newline='') as f:
+        lines = f.read().split('\r\n')
+    header = next(index for index, line in enumerate(lines) if line.startswith('Data;'))
+
+    # Second entry: description over two lines (one record, two lines)
+    fields = lines[header + 2].split(';')
+    fields[1] = f'"{fields[1]}\r\nCONTINUACAO"'
+    lines[header + 2] = ';'.join(fields)
+    # Fourth entry: a ; inside the description shifts the columns
+    fields = lines[header + 4].split(';')
+    fields[1] = 'PIX RECEBIDO; FULANO'
+    lines[header + 4] = ';'.join(fields)
+    # Sixth entry: a date that does not exist
+    fields = lines[header + 6].split(';')
+    fields[0] = '32/01/2023'
+    lines[header + 6] = ';'.join(fields)
+
+    with open(path, 'w', encoding='cp1252', newline='') as f:
+        f.write('\r\n'.join(lines))
+    # Line numbers start at 1, plus the extra line of the quoted description
+    return header + 4 + 2, header + 6 + 2
+
+def main():
+    sys.path.insert(0, ROOT)
+    import readers
+
+    path = os.path.join(tempfile.mkdtemp(), 'malformado.csv')
+    malformed_line, bad_date_line = write_malformed(path)
+    reader = readers.detect_reader(path)
+    records = list(reader.parse(path))
+
+    rejected = {(item.row, item.column) for item in reader.rejected}
+    expected = {(malformed_line, 'linha'), (bad_date_line, 'data')}
+    problems = []
+    if rejected != expected:
+        problems.append(f'rejeitadas {sorted(rejected)}, esperadas {sorted(expected)}')
+    if len(records) != ROWS - 2:
+        problems.append(f'{len(records)} lançamentos lidos, esperados {ROWS - 2}')
+
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    if not problems:
+        print(f'ok: linha {malformed_line} e data da linha {bad_date_line} rejeitadas, {len(records)} lançamentos')
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
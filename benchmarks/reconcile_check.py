@@ -0,0 +1,84 @@
+"""Check of the hourly transfer reconciliation (maintenance.reconcile_transfers).
+
+Uploads two Santander CSV statements: the first has both legs of a
+transfer of R$ 1.000,00 between AF companies (a refund in the same
+account) and the debit of a transfer of R$ 500,00, the second the
+credit of that one. The matches made at import are then deleted and the
+maintenance task run; exits with status 1 unless it pairs the R$ 500,00
+legs again and leaves the two legs of the first statement unpaired.
+
+    python -m benchmarks.reconcile_check
+"""
+import os
+import sys
+import time
+
+from benchmarks.support import load_app
+
+PREAMBLE = [
+    'Extrato de Conta Corrente',
+    'Agência: 0715  Conta: 13001234-5',
+    'Período: 02/01/2023 a 31/01/2023',
+    '',
+    'Data;Histórico;Docto.;Valor (R$);Saldo (R$)'
+]
+
+FIRST = [
+    '02/01/2023;TED ENVIADA AF CREDITO BANK;000001;-1.000,00;',
+    '02/01/2023;TED RECEBIDA AF CREDITO BANK;000002;1.000,00;',
+    '03/01/2023;PIX ENVIADO AF 360 FRANQUIAS LTDA;000003;-500,00;'
+]
+SECOND = [
+    '04/01/2023;PIX RECEBIDO AF ENERGY SOLAR 360;000001;500,00;'
+]
+
+def write_csv(path, rows):
+    with open(path, 'w', encoding='cp1252', newline='') as f:
+        f.write('\r\n'.join(PREAMBLE + rows) + '\r\n')
+
+def upload(client, path):
+    """Upload a statement and wait for its import; the final progress"""
+    with open(path, 'rb') as f:
+        response = client.post('/upload', data={'file': (f, os.path.basename(path))},
+                               content_type='multipart/form-data').get_json()
+    while True:
+        progress = client.get(f"/upload_progress/{response['process_id']}").get_json()
+        if progress['status'] != 'processing':
+            return progress
+        time.sleep(0.05)
+
+def main():
+    appmod, client = load_app()
+    import maintenance
+    os.makedirs(appmod.app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    write_csv('primeiro.csv', FIRST)
+    write_csv('segundo.csv', SECOND)
+    problems = [f"{name}: {progress['message']}" for name, progress in
+                [(name, upload(client, name)) for name in ['primeiro.csv', 'segundo.csv']]
+                if progress['status'] != 'completed']
+
+    conn = appmod.get_db_connection()
+    conn.execute('DELETE FROM transfer_matches')
+    conn.commit()
+    matched = maintenance.reconcile_transfers()
+    pairs = conn.execute('''
+        SELECT d.description, c.description FROM transfer_matches m
+        JOIN ledger d ON d.id = m.debit_id
+        JOIN ledger c ON c.id = m.credit_id
+    ''').fetchall()
+    conn.close()
+
+    expected = [('PIX ENVIADO AF 360 FRANQUIAS LTDA', 'PIX RECEBIDO AF ENERGY SOLAR 360')]
+    if [tuple(pair) for pair in pairs] != expected:
+        problems.append(f'{matched} transferências conciliadas: {[tuple(pair) for pair in pairs]}, '
+                        f'esperada {expected}')
+
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    if not problems:
+        print('ok: só as pontas de extratos diferentes conciliadas')
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""End-to-end benchmark: statement ingestion and view latency.
+
+For each size, generates Santander and Itaú statements in each format,
+imports them with ingest.import_statement into a fresh database per
+format, then requests every view against the database of the first
+format. Results are written as JSON so runs can be compared over time.
+
+    python -m benchmarks.run --rows 1000 10000 --formats xlsx csv ofx --output results.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+from benchmarks.generate_statements import AF_COMPANIES, BANKS, COUNTERPARTIES, FORMATS, write_statement
+from benchmarks.support import load_app, use_database
+
+VIEWS = [
+    '/recebidos',
+    '/recebidos?tipo=PIX%20RECEBIDO',
+    '/enviados',
+    '/enviados?start_date=2023-02-01&end_date=2023-03-31',
+    '/transacoes_internas',
+    '/dashboard',
+    '/transactions-summary',
+    '/api/transactions?direction=recebidos',
+    '/api/summary',
+    '/api/search?q=CONTAMAX',
+    '/export/enviados?format=csv'
+]
+
+def peak_rss_mb():
+    """Peak resident set size of the process so far (monotonic)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile"""
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+def measure_ingest(appmod, bank, source, rows, quiet):
+    """Import a copy of source (the importers delete their input)"""
+    import ingest
+    import jobs
+    import profiling
+    import readers
+
+    filepath = os.path.join(appmod.app.config['UPLOAD_FOLDER'], os.path.basename(source))
+    shutil.copy(source, filepath)
+    progress = {'status': 'processing'}
+    job_id = str(uuid.uuid4())
+    owner = jobs.new_owner()
+    jobs.create_job(job_id, bank, os.path.basename(source), owner=owner)
+
+    # Stage timings only; tracemalloc would distort the throughput
+    profile = profiling.IngestProfile(trace_memory=False)
+
+    output = io.StringIO() if quiet else sys.stderr
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        profiling.activate(profile)
+        try:
+            ingest.import_statement(readers.get_reader(bank, filepath), filepath, progress, job_id, owner)
+        except Exception as e:
+            progress.update({'status': 'error', 'message': str(e)})
+        finally:
+            profiling.deactivate()
+    seconds = time.perf_counter() - start
+
+    return {
+        'rows': rows,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(rows / seconds, 1) if seconds else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'status': progress.get('status'),
+        'message': progress.get('message'),
+        'stages': {stage['name']: stage['seconds'] for stage in profile.as_dict()['stages']}
+    }
+
+def database_bytes(conn, database):
+    """Size of the database with the WAL checkpointed into the main file
+    (plus what could not be, if a reader kept it)"""
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    wal = database + '-wal'
+    return os.path.getsize(database) + (os.path.getsize(wal) if os.path.exists(wal) else 0)
+
+def measure_views(client, runs):
+    results = {}
+    for url in VIEWS:
+        samples = []
+        status = None
+        for _ in range(runs):
+            start = time.perf_counter()
+            response = client.get(url)
+            response.get_data()
+            samples.append((time.perf_counter() - start) * 1000)
+            status = response.status_code
+        results[url] = {
+            'status': status,
+            'runs': runs,
+            'p50_ms': round(percentile(samples, 0.50), 2),
+            'p95_ms': round(percentile(samples, 0.95), 2),
+            'max_ms': round(max(samples), 2)
+        }
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000],
+                        help='statement sizes (rows per bank)')
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=FORMATS,
+                        help='statement formats to import (views use the first)')
+    parser.add_argument('--runs', type=int, default=20, help='requests per view')
+    parser.add_argument('--output', help='JSON file (default: stdout)')
+    parser.add_argument('--verbose', action='store_true', help='show the importers output')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp()
+    # Keep stdout for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        appmod, client = load_app(workdir)
+
+    # Known companies, so the importers never call the CNPJ API
+    for cnpj, name in {**COUNTERPARTIES, **AF_COMPANIES}.items():
+        appmod.cnpj_cache[cnpj] = {'razao_social': name, 'nome_fantasia': ''}
+
+    results = {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'sizes': []
+    }
+
+    for rows in args.rows:
+        ingest = {}
+        # Reversed so the database of the first format is the one left in use
+        for statement_format in reversed(args.formats):
+            database = os.path.join(workdir, f'bench_{rows}_{statement_format}.db')
+            with contextlib.redirect_stdout(sys.stderr):
+                use_database(appmod, database)
+
+            ingest[statement_format] = {}
+            for bank in BANKS:
+                path = os.path.join(workdir, f'{bank}_{rows}.{statement_format}')
+                write_statement(bank, path, rows)
+                ingest[statement_format][bank] = measure_ingest(appmod, bank, path, rows, not args.verbose)
+
+        conn = appmod.get_db_connection()
+        ledger_rows = conn.execute('SELECT COUNT(*) FROM ledger').fetchone()[0]
+        size = database_bytes(conn, database)
+        conn.close()
+
+        # Views timed on a database the importers failed to fill would look fine
+        failures = [f"{statement_format}/{bank}: {result['message']}"
+                    for statement_format, banks in ingest.items()
+                    for bank, result in banks.items() if result['status'] == 'error']
+        if failures or not ledger_rows:
+            for failure in failures:
+                print(f"importação falhou: {failure}", file=sys.stderr)
+            print(f"{rows} linhas: {ledger_rows} lançamentos no banco, views não medidas", file=sys.stderr)
+            shutil.rmtree(workdir, ignore_errors=True)
+            return 1
+
+        results['sizes'].append({
+            'rows': rows,
+            'ledger_rows': ledger_rows,
+            'database_bytes': size,
+            'ingest': {statement_format: ingest[statement_format] for statement_format in args.formats},
+            'views': measure_views(client, args.runs)
+        })
+
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    report = json.dumps(results, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""Startup benchmark: time and memory to import app in a fresh process.
+
+Each scenario runs in new interpreters against a database in a temporary
+directory:
+
+    migrate   first boot, the database is created and migrated
+    worker    a gunicorn worker: database migrated by the master (SCHEMA_READY=1)
+    upload    a worker that then imports what the first upload needs
+
+Exits with status 1 when a worker loads pandas or numpy at import: the
+web tier must start without them.
+
+    python -m benchmarks.startup [--runs 5] [--output startup.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+from benchmarks.support import ROOT
+
+# Modules only the ingestion path may load
+HEAVY_MODULES = ['pandas', 'numpy']
+
+SCENARIOS = ['migrate', 'worker', 'upload']
+
+PROBE = '''
+import json, resource, sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import app
+imported = time.perf_counter() - start
+loaded = [name for name in {heavy!r} if name in sys.modules]
+if {upload!r}:
+    start = time.perf_counter()
+    import ingest, readers
+    upload = time.perf_counter() - start
+else:
+    upload = None
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{
+    'import_seconds': imported,
+    'upload_import_seconds': upload,
+    'peak_rss_mb': round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+    'heavy_modules': loaded
+}}))
+'''
+
+def probe(scenario, workdir):
+    """Import app in a new interpreter; the measurements it printed"""
+    env = dict(os.environ, DATABASE_PATH=os.path.join(workdir, 'financas.db'), SCHEDULER_ENABLED='0')
+    env.pop('SCHEMA_READY', None)
+    if scenario != 'migrate':
+        env['SCHEMA_READY'] = '1'
+    code = PROBE.format(root=ROOT, heavy=HEAVY_MODULES, upload=scenario == 'upload')
+    output = subprocess.run([sys.executable, '-c', code], cwd=workdir, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def migrated_database():
+    """Directory with a database migrated by a first boot"""
+    workdir = tempfile.mkdtemp()
+    probe('migrate', workdir)
+    return workdir
+
+def measure(scenario, runs):
+    samples = []
+    workdir = migrated_database() if scenario != 'migrate' else None
+    for _ in range(runs):
+        samples.append(probe(scenario, workdir or tempfile.mkdtemp()))
+
+    result = {
+        'import_ms': round(statistics.median(s['import_seconds'] for s in samples) * 1000, 1),
+        'peak_rss_mb': statistics.median(s['peak_rss_mb'] for s in samples),
+        'heavy_modules': samples[0]['heavy_modules']
+    }
+    if scenario == 'upload':
+        result['upload_import_ms'] = round(
+            statistics.median(s['upload_import_seconds'] for s in samples) * 1000, 1)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='processes per scenario')
+    parser.add_argument('--output', help='JSON file (default: stdout)')
+    args = parser.parse_args()
+
+    results = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'runs': args.runs,
+        'scenarios': {scenario: measure(scenario, args.runs) for scenario in SCENARIOS}
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    loaded = results['scenarios']['worker']['heavy_modules']
+    if loaded:
+        print(f"worker importou {', '.join(loaded)} na inicialização", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""Display categories of transactions, computed at ingest into ledger.category"""
+
+# Display categories and the transaction types they group, in display order
+CATEGORIES = [
+    ('PIX RECEBIDO', ['PIX RECEBIDO']),
+    ('TED RECEBIDA', ['TED RECEBIDA']),
+    ('PIX ENVIADO', ['PIX ENVIADO']),
+    ('TED ENVIADA', ['TED ENVIADA']),
+    ('PAGAMENTO', ['PAGAMENTO']),
+    ('CONTAMAX', ['APLICACAO', 'RESGATE']),
+    ('CHEQUE', ['COMPENSACAO', 'CHEQUE']),
+    ('CARTAO', ['COMPRA']),
+    ('DESPESAS OPERACIONAIS', ['TAXA', 'TARIFA', 'IOF', 'MULTA', 'DEBITO']),
+    ('JUROS', ['JUROS']),
+    ('DIVERSOS', [])
+]
+
+DEFAULT_CATEGORY = 'DIVERSOS'
+
+# Category ids are their position in CATEGORIES, starting at 1
+CATEGORY_IDS = {name: index for index, (name, _) in enumerate(CATEGORIES, start=1)}
+CATEGORY_NAMES = {index: name for name, index in CATEGORY_IDS.items()}
+
+TYPE_CATEGORIES = {tipo: name for name, types in CATEGORIES for tipo in types}
+
+# Categories with a total of their own in each ledger view; the others
+# are counted, and filtered, as DIVERSOS there
+VIEW_CATEGORIES = {
+    'recebidos': ['PIX RECEBIDO', 'TED RECEBIDA', 'PAGAMENTO', 'CHEQUE', 'CONTAMAX',
+                  'DESPESAS OPERACIONAIS', 'DIVERSOS', 'JUROS'],
+    'enviados': ['PIX ENVIADO', 'TED ENVIADA', 'PAGAMENTO', 'CHEQUE', 'CONTAMAX', 'CARTAO', 'JUROS',
+                 'DESPESAS OPERACIONAIS', 'DIVERSOS'],
+    'internas': ['JUROS', 'DESPESAS OPERACIONAIS', 'PIX ENVIADO', 'TED ENVIADA', 'PAGAMENTO', 'DIVERSOS']
+}
+
+def category_for_type(tipo):
+    """Display category name of a transaction type"""
+    return TYPE_CATEGORIES.get(tipo, DEFAULT_CATEGORY)
+
+def category_id_for_type(tipo):
+    """Category id stored in ledger.category for a transaction type"""
+    return CATEGORY_IDS[category_for_type(tipo)]
+
+def view_category(direction, name):
+    """Category a row of category name is counted under in a ledger view"""
+    return name if name in VIEW_CATEGORIES[direction] else DEFAULT_CATEGORY
+
+def filter_category_ids(direction, name):
+    """Category ids the tipo filter name selects in a ledger view (None for
+    any other query): DIVERSOS also takes the categories without a total"""
+    ids = {CATEGORY_IDS[name]} if name in CATEGORY_IDS else set()
+    if direction in VIEW_CATEGORIES:
+        ids.update(CATEGORY_IDS[category] for category in CATEGORY_IDS
+                   if view_category(direction, category) == name)
+    return sorted(ids) or [0]
+
+def seed_categories(cursor):
+    """Create and fill the lookup tables; return whether the type mapping changed"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS category_types (
+            type TEXT PRIMARY KEY,
+            category_id INTEGER NOT NULL REFERENCES categories(id)
+        )
+    ''')
+
+    cursor.execute('SELECT type, category_id FROM category_types')
+    stored_types = dict(cursor.fetchall())
+    expected_types = {tipo: CATEGORY_IDS[name] for tipo, name in TYPE_CATEGORIES.items()}
+    mapping_changed = stored_types != expected_types
+
+    cursor.executemany('INSERT OR REPLACE INTO categories (id, name) VALUES (?, ?)',
+                       [(index, name) for name, index in CATEGORY_IDS.items()])
+    if mapping_changed:
+        cursor.execute('DELETE FROM category_types')
+        cursor.executemany('INSERT INTO category_types (type, category_id) VALUES (?, ?)',
+                           list(expected_types.items()))
+    return mapping_changed
+
+def backfill_categories(cursor, table, everything=False):
+    """Set the category of rows without one, or of every row"""
+    cursor.execute(f'''
+        UPDATE {table}
+        SET category = COALESCE(
+            (SELECT category_id FROM category_types WHERE category_types.type = {table}.type),
+            {CATEGORY_IDS[DEFAULT_CATEGORY]}
+        )
+        {'' if everything else 'WHERE category IS NULL'}
+    ''')
+
+def init_categories(cursor):
+    """Sync the lookup tables with CATEGORIES and backfill ledger.category"""
+    mapping_changed = seed_categories(cursor)
+    backfill_categories(cursor, 'ledger', everything=mapping_changed)
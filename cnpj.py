@@ -0,0 +1,226 @@
+"""CNPJ extraction from descriptions and company lookups on BrasilAPI.
+
+The caches live in this process; the app and the import pipeline share
+them. The names fetched also go to the companies table, read by the CNPJ
+dropdowns of every worker.
+"""
+import re
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import metrics
+import writer
+from fts import description_match
+from logs import get_logger
+
+logger = get_logger('cnpj')
+
+cnpj_cache = {}  # Cache for storing company information
+failed_cnpjs = set()  # Set for storing failed CNPJs
+
+CNPJ_PATTERNS = [
+    r'CNPJ[:\s]*(\d{14,15})',
+    r'CNPJ[:\s]*(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})',
+    r'\b(\d{14,15})\b',
+    r'\b(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})\b'
+]
+
+def extract_cnpj(description):
+    """Extract CNPJ from description"""
+    for pattern in CNPJ_PATTERNS:
+        match = re.search(pattern, description)
+        if match:
+            cnpj = ''.join(filter(str.isdigit, match.group(1)))
+            if len(cnpj) == 15 and cnpj.startswith('0'):
+                return cnpj[1:]
+            elif len(cnpj) == 14:
+                return cnpj
+    return None
+
+def retrying_session():
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.5)
+    session.mount('https://', HTTPAdapter(max_retries=retries))
+    return session
+
+def fetch_cnpj(http, cnpj, timeout):
+    """GET a CNPJ from BrasilAPI, recording the call latency"""
+    start = time.perf_counter()
+    status = 'error'
+    try:
+        response = http.get(f'https://brasilapi.com.br/api/cnpj/v1/{cnpj}', timeout=timeout)
+        status = response.status_code
+        return response
+    finally:
+        metrics.CNPJ_API_DURATION.observe(time.perf_counter() - start, status=status)
+
+def store_company(conn, cnpj, nome_fantasia, razao_social):
+    """Writer command: keep the names of a company"""
+    conn.execute('''
+        INSERT INTO companies (document, nome_fantasia, razao_social) VALUES (?, ?, ?)
+        ON CONFLICT(document) DO UPDATE SET
+            nome_fantasia = excluded.nome_fantasia, razao_social = excluded.razao_social
+        WHERE nome_fantasia IS NOT excluded.nome_fantasia OR razao_social IS NOT excluded.razao_social
+    ''', (cnpj, nome_fantasia, razao_social))
+
+def remember_company(cnpj, company_info):
+    """Cache a company fetched from BrasilAPI and store its names (not waited for)"""
+    cnpj_cache[cnpj] = company_info
+    writer.submit(store_company, cnpj, company_info.get('nome_fantasia'), company_info.get('razao_social'))
+
+def get_company_info(cnpj):
+    """Fetch company information using cache if available"""
+    # Normalize CNPJ
+    cnpj = ''.join(filter(str.isdigit, cnpj))
+    if len(cnpj) == 15 and cnpj.startswith('0'):
+        cnpj = cnpj[1:]
+
+    # Check cache first
+    metrics.record_cache('cnpj', cnpj in cnpj_cache)
+    if cnpj in cnpj_cache:
+        return cnpj_cache[cnpj]
+
+    try:
+        response = fetch_cnpj(retrying_session(), cnpj, timeout=10)
+        if response.status_code == 200:
+            company_info = response.json()
+            remember_company(cnpj, company_info)
+            if cnpj in failed_cnpjs:
+                failed_cnpjs.remove(cnpj)
+            return company_info
+        else:
+            failed_cnpjs.add(cnpj)
+            logger.warning("Failed to fetch CNPJ %s: Status %s", cnpj, response.status_code)
+    except Exception as e:
+        logger.warning("Error fetching company information for %s: %s", cnpj, e)
+        failed_cnpjs.add(cnpj)
+    return None
+
+def format_company_info(company_info, cnpj):
+    """Format company info for display"""
+    return {
+        'cnpj': cnpj,
+        'nome_fantasia': company_info.get('nome_fantasia', ''),
+        'razao_social': company_info.get('razao_social', ''),
+        'formatted_name': (
+            company_info.get('nome_fantasia') or
+            company_info.get('razao_social', '')
+        ) + f" (CNPJ: {cnpj})"
+    }
+
+def extract_and_enrich_cnpj(description, transaction_type):
+    """Extract and enrich CNPJ information in description"""
+    # Check if description is already enriched
+    if '(CNPJ:' in description:
+        return description
+
+    session = None
+    for pattern in CNPJ_PATTERNS:
+        match = re.search(pattern, description)
+        if match:
+            cnpj = ''.join(filter(str.isdigit, match.group(1)))
+            if len(cnpj) == 15 and cnpj.startswith('0'):
+                cnpj = cnpj[1:]
+            elif len(cnpj) != 14:
+                continue
+
+            try:
+                metrics.record_cache('cnpj', cnpj in cnpj_cache)
+                if cnpj in cnpj_cache:
+                    company_info = cnpj_cache[cnpj]
+                else:
+                    # Session with retries, only once the API is needed
+                    if session is None:
+                        session = retrying_session()
+                    response = fetch_cnpj(session, cnpj, timeout=10)
+                    if response.status_code == 200:
+                        company_info = response.json()
+                        remember_company(cnpj, company_info)
+                        if cnpj in failed_cnpjs:
+                            failed_cnpjs.remove(cnpj)
+                    else:
+                        failed_cnpjs.add(cnpj)
+                        return description
+
+                razao_social = company_info.get('razao_social', '')
+
+                if razao_social:
+                    # Handle different transaction types
+                    if 'PIX RECEBIDO' in description or 'TED RECEBIDA' in description:
+                        prefix = 'PIX RECEBIDO' if 'PIX RECEBIDO' in description else 'TED RECEBIDA'
+                        return f"{prefix} {razao_social} (CNPJ: {cnpj})"
+                    elif 'PAGAMENTO' in description:
+                        prefix = re.sub(r'\s*CNPJ\s*\d+.*$', '', description)
+                        prefix = re.sub(r'\s+0\s+', ' ', prefix)
+                        return f"{prefix} {razao_social} (CNPJ: {cnpj})"
+
+                    parts = description.split(cnpj, 1)
+                    prefix = parts[0].strip()
+                    prefix = re.sub(r'\s*CNPJ\s*$', '', prefix)
+                    return f"{prefix} {razao_social} (CNPJ: {cnpj})"
+
+            except Exception as e:
+                logger.warning("Erro ao indentificar CNPJ %s: %s", cnpj, e)
+                failed_cnpjs.add(cnpj)
+
+    return description
+
+def replace_cnpj_descriptions(conn, cnpj, razao_social):
+    """Writer command: put the company name next to cnpj in the descriptions"""
+    cnpj_match, cnpj_params = description_match([cnpj])
+    rows = conn.execute(f'''
+        SELECT t.id, t.description FROM ledger t
+        WHERE {cnpj_match}
+    ''', cnpj_params).fetchall()
+    conn.executemany('''
+        UPDATE ledger 
+        SET description = ? 
+        WHERE id = ?
+    ''', [(description.replace(cnpj, f"{razao_social} (CNPJ: {cnpj})"), transaction_id)
+          for transaction_id, description in rows])
+    return len(rows)
+
+def retry_failed_cnpjs(pause=0.5):
+    """Look up the failed CNPJs again, naming them in the descriptions.
+
+    Returns (recovered count, CNPJs still failing). Descriptions are
+    updated by the database writer while the next CNPJs are fetched; no
+    write lock is held across the API calls.
+    """
+    recovered = set()
+    still_failed = set()
+    updates = []
+
+    for cnpj in failed_cnpjs.copy():
+        try:
+            # Handle 15-digit CNPJ
+            api_cnpj = cnpj
+            if len(cnpj) == 15 and cnpj.startswith('0'):
+                api_cnpj = cnpj[1:]  # Remove first zero only if 15 digits
+
+            response = fetch_cnpj(requests, api_cnpj, timeout=5)
+            if response.status_code == 200:
+                data = response.json()
+                remember_company(cnpj, data)
+
+                # Atualiza as descrições no banco de dados
+                updates.append(writer.submit(replace_cnpj_descriptions, cnpj, data['razao_social']))
+                recovered.add(cnpj)
+            else:
+                still_failed.add(cnpj)
+                logger.warning("Falha ao buscar CNPJ %s: Status %s", api_cnpj, response.status_code)
+        except Exception as e:
+            still_failed.add(cnpj)
+            logger.warning("Erro ao processar CNPJ %s: %s", api_cnpj, e)
+
+        # Pequena pausa entre requisições para evitar rate limit
+        time.sleep(pause)
+
+    # Espera a gravação das alterações
+    for update in updates:
+        update.result()
+
+    # CNPJs that failed during the retry (a running import) stay in the set
+    failed_cnpjs.difference_update(recovered)
+    return len(recovered), still_failed
@@ -0,0 +1,90 @@
+"""Response compression.
+
+HTML, JSON, NDJSON and CSV responses above MIN_COMPRESS_SIZE are sent
+gzip-compressed to the clients that accept it. Streamed responses (the
+ledger pages, the API and the exports) are compressed chunk by chunk,
+with a sync flush after each one so the client still gets the first rows
+right away. Brotli, when the module is installed, is only used for the
+static assets, compressed once (assets.py).
+"""
+import gzip
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # optional: static assets are then served gzip only
+    brotli = None
+
+# Bodies smaller than this are sent as they are (they fit a few packets)
+MIN_COMPRESS_SIZE = 1024
+# zlib level of the responses compressed per request
+GZIP_LEVEL = 6
+
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/css', 'text/csv', 'text/plain', 'text/javascript',
+    'application/javascript', 'application/json', 'application/x-ndjson', 'image/svg+xml'
+}
+
+def is_compressible(mimetype):
+    return mimetype in COMPRESSIBLE_TYPES
+
+def compress(data, encoding):
+    """data compressed as much as possible, for content compressed once"""
+    if encoding == 'br':
+        return brotli.compress(data)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+def available_encodings():
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+def accepted_encoding(encodings):
+    """The first of encodings the client accepts, or 'identity'"""
+    for encoding in encodings:
+        if request.accept_encodings.quality(encoding) > 0:
+            return encoding
+    return 'identity'
+
+def gzip_stream(chunks, body):
+    """Compress the chunks of a streamed body, flushing after each one"""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        # Close the original body too when the client goes away mid-stream
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+
+def compress_response(response):
+    """after_request: gzip the compressible responses the client accepts"""
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or not is_compressible(response.mimetype)):
+        return response
+    response.vary.add('Accept-Encoding')
+    if accepted_encoding(['gzip']) != 'gzip':
+        return response
+
+    if response.is_streamed:
+        response.response = gzip_stream(response.iter_encoded(), response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return response
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+
+    # Another representation of the same content: the ETag becomes weak
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+def init_app(app):
+    app.after_request(compress_response)
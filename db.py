@@ -0,0 +1,136 @@
+import os
+import sqlite3
+import threading
+from datetime import date, datetime
+from decimal import Decimal, ROUND_HALF_UP
+import metrics
+from logs import get_logger
+
+logger = get_logger('db')
+
+DATABASE_PATH = os.getenv('DATABASE_PATH', os.path.join('instance', 'financas.db'))
+
+BUSY_TIMEOUT = 30  # seconds a writer waits for the lock (held by another process)
+CACHE_SIZE_KB = 20000  # page cache per connection
+MMAP_SIZE = 256 * 1024 * 1024  # bytes of the database file memory-mapped
+
+_local = threading.local()
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor recording the execution time of every statement"""
+
+    def execute(self, sql, parameters=()):
+        with metrics.SQL_DURATION.time(operation=metrics.sql_operation(sql)):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with metrics.SQL_DURATION.time(operation=metrics.sql_operation(sql)):
+            return super().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        with metrics.SQL_DURATION.time(operation='SCRIPT'):
+            return super().executescript(sql_script)
+
+class ManagedConnection(sqlite3.Connection):
+    """Connection owned by one thread and reused across requests.
+
+    close() only ends the open transaction, so existing
+    "conn = get_db_connection() ... conn.close()" code keeps working while
+    the underlying connection (and its page cache) is kept for the next
+    request of the same thread.
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # The shortcut methods go through cursor() so they are timed too
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+    def release(self):
+        """Really close the connection"""
+        super().close()
+
+def connect(path=None):
+    """Open a new connection with the performance pragmas applied"""
+    path = path or DATABASE_PATH
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, factory=ManagedConnection)
+    conn.row_factory = sqlite3.Row
+
+    # Only takes effect on a new database (maintenance.py converts old ones)
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    # WAL lets readers run while an import is writing
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT * 1000}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+def get_connection():
+    """Return the connection of the current thread, opening it if needed"""
+    conn = getattr(_local, 'connection', None)
+    if conn is None:
+        conn = connect()
+        _local.connection = conn
+    return conn
+
+def close_connection():
+    """Close the connection of the current thread (end of a worker thread)"""
+    conn = getattr(_local, 'connection', None)
+    if conn is None:
+        return
+    _local.connection = None
+    try:
+        conn.close()
+        conn.execute('PRAGMA optimize')
+    except sqlite3.Error as e:
+        logger.warning("Erro ao otimizar banco de dados: %s", e)
+    finally:
+        conn.release()
+
+# Storage format of the ledger: days as YYYYMMDD integers, amounts in centavos
+
+def iso_date_sql(column):
+    """SQL expression formatting a YYYYMMDD integer column as YYYY-MM-DD"""
+    return f"printf('%04d-%02d-%02d', {column} / 10000, {column} / 100 % 100, {column} % 100)"
+
+def date_to_day(value):
+    """Compact YYYYMMDD integer of a date, datetime or 'YYYY-MM-DD' string"""
+    if isinstance(value, str):
+        value = datetime.strptime(value[:10], '%Y-%m-%d')
+    return value.year * 10000 + value.month * 100 + value.day
+
+def parse_day(value):
+    """date_to_day() for user input; None when empty or invalid"""
+    try:
+        return date_to_day(value) if value else None
+    except ValueError:
+        return None
+
+def day_to_iso(day):
+    """YYYY-MM-DD string of a YYYYMMDD integer"""
+    return f'{day // 10000:04d}-{day // 100 % 100:02d}-{day % 100:02d}'
+
+def day_to_date(day):
+    return date(day // 10000, day // 100 % 100, day % 100)
+
+def to_cents(value):
+    """Integer centavos of a monetary value, rounding half up"""
+    return int((Decimal(str(value)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def from_cents(cents):
+    return (cents or 0) / 100
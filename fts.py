@@ -0,0 +1,45 @@
+"""Description matching on the ledger_fts full-text index."""
+
+# Whether ledger_fts uses the trigram tokenizer (substring matching)
+FTS_TRIGRAM = False
+
+def detect_fts(cursor):
+    """Check which tokenizer the full-text index was created with.
+
+    Without trigram (SQLite older than 3.34) description_match() keeps
+    using LIKE.
+    """
+    global FTS_TRIGRAM
+
+    cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'ledger_fts'")
+    row = cursor.fetchone()
+    FTS_TRIGRAM = row is not None and 'trigram' in row[0]
+
+def fts_phrase(term):
+    """Quote a term as an FTS5 phrase"""
+    return '"' + term.replace('"', '""') + '"'
+
+def like_pattern(term):
+    """Substring LIKE pattern with % and _ escaped"""
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%' + escaped + '%'
+
+def description_match(terms, alias='t', negate=False):
+    """SQL condition (and params) for descriptions containing any of terms.
+
+    Uses the trigram full-text index when available; trigram needs at
+    least 3 characters per term, shorter terms fall back to LIKE.
+    """
+    if FTS_TRIGRAM and all(len(term) >= 3 for term in terms):
+        operator = 'NOT IN' if negate else 'IN'
+        condition = (f"{alias}.id {operator} "
+                     "(SELECT rowid FROM ledger_fts WHERE ledger_fts MATCH ?)")
+        return condition, [' OR '.join(fts_phrase(term) for term in terms)]
+
+    if negate:
+        clauses = [f"{alias}.description NOT LIKE ? ESCAPE '\\'" for _ in terms]
+        condition = '(' + ' AND '.join(clauses) + ')'
+    else:
+        clauses = [f"{alias}.description LIKE ? ESCAPE '\\'" for _ in terms]
+        condition = '(' + ' OR '.join(clauses) + ')'
+    return condition, [like_pattern(term) for term in terms]
@@ -0,0 +1,18 @@
+"""gunicorn settings, read from the working directory by `gunicorn app:app`.
+
+The database is migrated once, in the master, before the workers are
+forked; the workers inherit SCHEMA_READY and skip the migrations when
+they import app.
+"""
+import os
+
+def on_starting(server):
+    import db
+    from migrations import setup_schema
+
+    conn = db.connect()
+    try:
+        setup_schema(conn)
+    finally:
+        conn.release()
+    os.environ['SCHEMA_READY'] = '1'
@@ -0,0 +1,294 @@
+"""Import pipeline: stores the records yielded by a statement reader.
+
+Runs in the importing thread. The reader parses; this module classifies,
+enriches descriptions with the CNPJ company names and hands the entries
+to the database writer, which inserts them, removes the paired entries
+that cancel each other out and matches the transfers between the AF
+group accounts (reconcile.py).
+
+Each batch is committed with the checkpoint of the job (jobs.py), so an
+import cut short by a dead worker continues where it stopped.
+"""
+import logging
+import os
+import time
+from array import array
+from datetime import datetime
+import db
+import jobs
+import profiling
+import reconcile
+import writer
+from categories import category_id_for_type
+from cnpj import extract_and_enrich_cnpj
+from fts import description_match
+from logs import get_logger
+
+logger = get_logger('ingest')
+
+# Rows per INSERT batch and progress update
+INSERT_BATCH = 500
+
+INSERT_SQL = '''
+    INSERT INTO ledger (day, description, amount_cents, type, transaction_type, document, category)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+def import_statement(reader, filepath, progress, job_id, owner=None):
+    """Import a statement file with reader for job_id, updating the progress dict.
+
+    Removes the file once imported and returns the number of entries
+    inserted; errors propagate to the caller. Rows the reader rejected
+    are left in reader.rejected, and the rows where the statement balance
+    stops matching the entries in reader.balance_mismatches, for the job
+    report. The daily closing balances go to balance_snapshots, checked only
+    when the statement prints more than one (reader.balance_checked).
+
+    The batches are written by the database writer while the next one is
+    parsed, so they are committed as they go, each with the checkpoint of
+    the job. If the job already has a checkpoint (a resumed import), the
+    records up to it are read again but not inserted. If the import
+    fails, the entries written for the job are deleted again.
+    """
+    done_records = (jobs.get_job(job_id) or {}).get('checkpoint') or 0
+    if done_records:
+        logger.info("Retomando importação de %s a partir do registro %s", filepath, done_records)
+    else:
+        logger.info("Iniciando processamento do arquivo: %s", filepath)
+    progress.update({
+        'status': 'processing',
+        'current': done_records,
+        'total': 0,
+        'message': 'Lendo arquivo...'
+    })
+
+    amounts = array('q')  # centavos of every record, for the balance check
+    pending = None  # batch being written
+    try:
+        records = iter(reader.parse(filepath))
+        progress['total'] = reader.total_rows
+
+        processed_rows = 0
+        batch = []
+        # Per-row stages, added to the profile once per batch
+        timings = profiling.StageTimings()
+        while True:
+            start = time.perf_counter()
+            record = next(records, None)
+            timings.add('parse', time.perf_counter() - start, rows=int(record is not None))
+            if record is None:
+                break
+
+            cents = db.to_cents(record.value)
+            amounts.append(cents)
+            if len(amounts) <= done_records:
+                # Committed before the import was interrupted
+                processed_rows += 1
+                continue
+
+            start = time.perf_counter()
+            transaction_type = reader.classify(record.description, record.value)
+            classified = time.perf_counter()
+            description = extract_and_enrich_cnpj(record.description, transaction_type)
+            timings.add('classify', classified - start)
+            timings.add('enrich', time.perf_counter() - classified)
+
+            batch.append((
+                db.date_to_day(record.date),
+                description,
+                cents,
+                transaction_type,
+                'receita' if record.value > 0 else 'despesa',
+                record.document,
+                category_id_for_type(transaction_type)
+            ))
+            if len(batch) >= INSERT_BATCH:
+                timings.flush()
+                processed_rows += len(batch)
+                pending = insert_batch(batch, pending, job_id, owner, processed_rows)
+                batch = []
+                # Streaming readers (OFX) only know the total at the end
+                total = reader.total_rows
+                progress.update({
+                    'current': processed_rows,
+                    'total': total,
+                    'message': f'Processando... {processed_rows}/{total}' if total else f'Processando... {processed_rows}'
+                })
+        timings.flush()
+        if batch:
+            processed_rows += len(batch)
+            pending = insert_batch(batch, pending, job_id, owner, processed_rows)
+        with profiling.stage('commit'):
+            if pending is not None:
+                pending.result()
+                pending = None
+        progress.update({'current': processed_rows, 'total': reader.total_rows or processed_rows})
+
+        # Cleanup paired transactions
+        with profiling.stage('pair_cleanup') as stage:
+            deleted_count = writer.run(cleanup_paired_transactions)
+            stage.rows = deleted_count
+
+        with profiling.stage('reconcile') as stage:
+            matched_count = writer.run(reconcile.match_transfers, jobs.get_batches(job_id))
+            stage.rows = matched_count
+
+        with profiling.stage('balance_check', rows=len(amounts)):
+            closing = reader.check_balances(amounts)
+            if closing and reader.account:
+                writer.run(store_balance_snapshots, reader.bank, reader.account, closing)
+    except jobs.ImportSuperseded:
+        # Another run took over the job: what was written is now its own
+        raise
+    except Exception:
+        discard_batches(pending, job_id)
+        raise
+    os.remove(filepath)
+
+    message = f'Processamento concluído! {processed_rows} transações importadas, {deleted_count} transações duplicadas removidas'
+    if matched_count:
+        message += f', {matched_count} transferências internas conciliadas'
+    if reader.balance_mismatches:
+        message += f', saldo divergente do extrato em {len(reader.balance_mismatches)} linhas'
+        logger.warning("Saldo divergente em %s: linhas %s", filepath,
+                       [mismatch.row for mismatch in reader.balance_mismatches])
+    elif reader.balance_checked is False:
+        message += ', saldo do extrato não conferido (um só saldo impresso)'
+    if reader.rejected_count:
+        message += f', {reader.rejected_count} linhas rejeitadas'
+        logger.info("%s linhas rejeitadas em %s", reader.rejected_count, filepath)
+    progress.update({
+        'status': 'completed',
+        'rejected': reader.rejected_count,
+        'balance_mismatches': len(reader.balance_mismatches),
+        'balance_checked': reader.balance_checked,
+        'message': message + '.'
+    })
+    return processed_rows
+
+def insert_batch(batch, pending, job_id, owner, checkpoint):
+    """Hand batch to the writer once the previous one is written; returns its future"""
+    with profiling.stage('insert', rows=len(batch)):
+        if pending is not None:
+            pending.result()
+        return writer.submit(insert_rows, batch, job_id, owner, checkpoint)
+
+def store_balance_snapshots(conn, bank, account, closing):
+    """Writer command: keep the closing balance of each day, flagged checked
+    when it was compared with an earlier printed balance. An unchecked
+    balance does not replace a checked one."""
+    conn.executemany('''
+        INSERT INTO balance_snapshots (bank, account, day, balance_cents, updated_at, checked)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(bank, account, day) DO UPDATE SET
+            balance_cents = excluded.balance_cents, updated_at = excluded.updated_at,
+            checked = excluded.checked
+        WHERE excluded.checked >= balance_snapshots.checked
+    ''', [(bank, account, db.date_to_day(day), cents, datetime.now().isoformat(timespec='seconds'),
+           int(checked))
+          for day, (cents, checked) in closing.items()])
+
+def ledger_sequence(conn):
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'ledger'").fetchone()
+    return row[0] if row else 0
+
+def insert_rows(conn, rows, job_id, owner, checkpoint):
+    """Writer command: insert ledger rows with the job checkpoint (checkpoint
+    records of the file done); returns the (first, last) ids given"""
+    first = ledger_sequence(conn) + 1
+    conn.executemany(INSERT_SQL, rows)
+    # Nobody else inserts inside the write transaction: the ids are contiguous
+    last = ledger_sequence(conn)
+    jobs.record_batch(conn, job_id, owner, first, last, checkpoint)
+    return first, last
+
+def discard_batches(pending, job_id):
+    """Delete the entries a failed import already wrote"""
+    if pending is not None:
+        try:
+            pending.result()
+        except Exception:
+            pass  # that batch was rolled back
+    discarded = writer.run(jobs.delete_batches, job_id)
+    if discarded:
+        logger.info("Importação interrompida: %s lotes já gravados removidos", discarded)
+
+def cleanup_paired_transactions(conn):
+    """Clean up paired transactions during upload (writer command)"""
+    cursor = conn.cursor()
+    total_deleted = 0
+    
+    try:
+        # First find CONTAMAX pairs
+        resgate, resgate_params = description_match(['RESGATE CONTAMAX'], alias='t1')
+        cancelamento, cancelamento_params = description_match(['CANCELAMENTO RESGATE'], alias='t2')
+        cursor.execute(f'''
+        WITH contamax_pairs AS (
+            SELECT t1.id as id1, t1.description as desc1, t1.amount_cents as val1,
+                   t2.id as id2, t2.description as desc2, t2.amount_cents as val2
+            FROM ledger t1
+            JOIN ledger t2 ON t1.day = t2.day 
+            AND t1.amount_cents = -t2.amount_cents
+            AND t1.id != t2.id
+            WHERE {resgate} AND {cancelamento}
+        )
+        SELECT * FROM contamax_pairs''', resgate_params + cancelamento_params)
+        
+        contamax_pairs = cursor.fetchall()
+        if logger.isEnabledFor(logging.DEBUG):
+            for pair in contamax_pairs:
+                logger.debug("Par CONTAMAX: %s (R$ %s) / %s (R$ %s)",
+                             pair[1], db.from_cents(pair[2]), pair[4], db.from_cents(pair[5]))
+            
+        if contamax_pairs:
+            contamax_ids = []
+            for pair in contamax_pairs:
+                contamax_ids.extend([pair[0], pair[3]])
+            
+            placeholders = ','.join(['?' for _ in contamax_ids])
+            cursor.execute(f'DELETE FROM ledger WHERE id IN ({placeholders})', contamax_ids)
+            contamax_deleted = cursor.rowcount
+            total_deleted += contamax_deleted
+            logger.info("%s transações CONTAMAX removidas", contamax_deleted)
+        
+        # Then find CHEQUE pairs
+        emitido, emitido_params = description_match(
+            ['CHEQUE EMITIDO/DEBITADO', 'COMPENSACAO INTERNA'], alias='t1')
+        devolvido, devolvido_params = description_match(['CHEQUE DEVOLVIDO'], alias='t2')
+        cursor.execute(f'''
+        WITH cheque_pairs AS (
+            SELECT t1.id as id1, t1.description as desc1, t1.amount_cents as val1,
+                   t2.id as id2, t2.description as desc2, t2.amount_cents as val2
+            FROM ledger t1
+            JOIN ledger t2 ON t1.day = t2.day 
+            AND ABS(t1.amount_cents) = ABS(t2.amount_cents)
+            AND t1.id != t2.id
+            WHERE 
+                {emitido}
+                AND {devolvido}
+                AND t1.amount_cents < 0 AND t2.amount_cents > 0
+        )
+        SELECT * FROM cheque_pairs''', emitido_params + devolvido_params)
+        
+        cheque_pairs = cursor.fetchall()
+        if logger.isEnabledFor(logging.DEBUG):
+            for pair in cheque_pairs:
+                logger.debug("Par CHEQUE: %s (R$ %s) / %s (R$ %s)",
+                             pair[1], db.from_cents(pair[2]), pair[4], db.from_cents(pair[5]))
+            
+        if cheque_pairs:
+            cheque_ids = []
+            for pair in cheque_pairs:
+                cheque_ids.extend([pair[0], pair[3]])
+            
+            placeholders = ','.join(['?' for _ in cheque_ids])
+            cursor.execute(f'DELETE FROM ledger WHERE id IN ({placeholders})', cheque_ids)
+            cheque_deleted = cursor.rowcount
+            total_deleted += cheque_deleted
+            logger.info("%s transações CHEQUE removidas", cheque_deleted)
+        
+        return total_deleted
+        
+    except Exception:
+        logger.exception("Erro ao remover transações pareadas")
+        return 0
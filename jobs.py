@@ -0,0 +1,276 @@
+"""Import job records: status, result and stage profile of each upload,
+and the uploaded statement files by content hash.
+
+An import runs under an owner token and commits its entries batch by
+batch, each batch with the checkpoint of the job: the id range written
+(import_batches, kept once the job finishes to tell which import each
+entry came from) and the number of records of the file done. The owner
+refreshes heartbeat_at while it runs; a job without a heartbeat for
+RESUME_AFTER seconds, or whose owner was a process of this host that is
+gone (a restart), is taken by another run (app.resume_imports), which
+continues from the checkpoint. A run whose job was taken over can no
+longer write to it (ImportSuperseded).
+"""
+import json
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+import db
+import writer
+
+# A file still 'processing' without a heartbeat for this long belongs to an
+# import that could not be resumed; it may be uploaded again
+STALE_IMPORT = timedelta(hours=1)
+# Seconds without a heartbeat after which an import is taken as dead
+RESUME_AFTER = 600
+
+class ImportSuperseded(Exception):
+    """The job was taken over by another run (this one was taken as dead)"""
+
+def new_owner():
+    """Token of one run of an import: host, process and a random part"""
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+def owner_is_gone(owner):
+    """Whether owner ran in a process of this host that no longer exists"""
+    try:
+        host, pid, _ = owner.split(':')
+        pid = int(pid)
+    except (AttributeError, ValueError):
+        return False
+    if host != socket.gethostname() or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass  # exists, owned by another user
+    return False
+
+def create_job(job_id, bank, filename, sha256=None, filepath=None, owner=None):
+    writer.run(insert_job, job_id, bank, filename, sha256, filepath, owner)
+
+def insert_job(conn, job_id, bank, filename, sha256, filepath, owner):
+    conn.execute('''
+        INSERT INTO import_jobs (id, bank, filename, status, started_at, sha256, filepath, owner, heartbeat_at)
+        VALUES (?, ?, ?, 'processing', ?, ?, ?, ?, ?)
+    ''', (job_id, bank, filename, datetime.now().isoformat(timespec='seconds'),
+          sha256, filepath, owner, time.time()))
+
+def finish_job(job_id, status, message, rows=None, profile=None, profile_path=None,
+               rejected_count=None, rejected=(), balance_mismatches=(), balance_checked=None, owner=None):
+    """Record the result of a job, the rows it rejected and those where the
+    statement balance diverged (Rejected tuples). balance_checked tells
+    whether printed balances were compared (None: the statement has none).
+
+    Returns False, writing nothing, if owner no longer runs the job.
+    """
+    result = (
+        status,
+        message,
+        rows,
+        datetime.now().isoformat(timespec='seconds'),
+        json.dumps(profile) if profile is not None else None,
+        profile_path,
+        rejected_count,
+        len(balance_mismatches),
+        None if balance_checked is None else int(balance_checked),
+        job_id,
+        owner
+    )
+    rejects = [(job_id, item.row, item.column, item.reason, item.value)
+               for item in list(rejected) + list(balance_mismatches)]
+    return writer.run(write_job_result, result, rejects)
+
+def write_job_result(conn, result, rejects):
+    updated = conn.execute('''
+        UPDATE import_jobs
+        SET status = ?, message = ?, rows = ?, finished_at = ?, profile = ?, profile_path = ?,
+            rejected = ?, balance_mismatches = ?, balance_checked = ?
+        WHERE id = ? AND owner IS ?
+    ''', result).rowcount
+    if not updated:
+        return False
+    conn.executemany('''
+        INSERT INTO import_rejects (job_id, row, field, reason, value) VALUES (?, ?, ?, ?, ?)
+    ''', rejects)
+    # The batches stay: reconcile.match_all reads the import of each entry
+    return True
+
+def job_to_dict(row):
+    return {
+        'id': row['id'],
+        'bank': row['bank'],
+        'filename': row['filename'],
+        'status': row['status'],
+        'message': row['message'],
+        'rows': row['rows'],
+        'started_at': row['started_at'],
+        'finished_at': row['finished_at'],
+        'profile': json.loads(row['profile']) if row['profile'] else None,
+        'has_cprofile': bool(row['profile_path']),
+        'rejected': row['rejected'],
+        'balance_mismatches': row['balance_mismatches'],
+        'balance_checked': None if row['balance_checked'] is None else bool(row['balance_checked']),
+        'checkpoint': row['checkpoint'],
+        'resumes': row['resumes']
+    }
+
+def get_job(job_id):
+    conn = db.get_connection()
+    row = conn.execute('SELECT * FROM import_jobs WHERE id = ?', (job_id,)).fetchone()
+    return job_to_dict(row) if row else None
+
+def get_profile_path(job_id):
+    conn = db.get_connection()
+    row = conn.execute('SELECT profile_path FROM import_jobs WHERE id = ?', (job_id,)).fetchone()
+    return row['profile_path'] if row else None
+
+def list_jobs(limit=20):
+    conn = db.get_connection()
+    rows = conn.execute('''
+        SELECT * FROM import_jobs ORDER BY started_at DESC, rowid DESC LIMIT ?
+    ''', (limit,)).fetchall()
+    return [job_to_dict(row) for row in rows]
+
+def iter_rejects(job_id):
+    """Rows rejected by a job, in file order"""
+    conn = db.get_connection()
+    return conn.execute('''
+        SELECT row, field, reason, value FROM import_rejects WHERE job_id = ? ORDER BY row
+    ''', (job_id,))
+
+def get_statement_file(sha256):
+    """The record of an uploaded file, with the heartbeat of its job"""
+    conn = db.get_connection()
+    row = conn.execute('''
+        SELECT f.*, j.heartbeat_at FROM statement_files f
+        LEFT JOIN import_jobs j ON j.id = f.job_id
+        WHERE f.sha256 = ?
+    ''', (sha256,)).fetchone()
+    return dict(row) if row else None
+
+def stale_cutoff():
+    return time.time() - STALE_IMPORT.total_seconds()
+
+def can_reimport(record):
+    """Whether a known file may be imported again (failed or abandoned)"""
+    return record['status'] == 'error' or (
+        record['status'] == 'processing' and (record['heartbeat_at'] or 0) < stale_cutoff())
+
+def claim_statement_file(sha256, bank, filename, size, job_id, filepath, owner):
+    """Record that job_id imports the file with this hash, creating the job
+    in the same transaction: from the claim on, the heartbeat of the job
+    keeps the file from being claimed again.
+
+    Returns None when claimed, or the existing record when the file was
+    already imported or is being imported by another job. Files whose
+    import failed or was abandoned can be claimed again.
+    """
+    if writer.run(write_statement_claim, sha256, bank, filename, size, job_id, filepath, owner):
+        return None
+    return get_statement_file(sha256)
+
+def write_statement_claim(conn, sha256, bank, filename, size, job_id, filepath, owner):
+    claimed = conn.execute('''
+        INSERT INTO statement_files (sha256, bank, filename, size, job_id, status, uploaded_at)
+        VALUES (?, ?, ?, ?, ?, 'processing', ?)
+        ON CONFLICT(sha256) DO UPDATE SET
+            bank = excluded.bank, filename = excluded.filename, job_id = excluded.job_id,
+            status = 'processing', message = NULL, rows = NULL,
+            uploaded_at = excluded.uploaded_at, finished_at = NULL
+        WHERE statement_files.status = 'error'
+           OR (statement_files.status = 'processing' AND NOT EXISTS (
+                SELECT 1 FROM import_jobs j
+                WHERE j.id = statement_files.job_id AND j.heartbeat_at >= ?))
+    ''', (sha256, bank, filename, size, job_id, datetime.now().isoformat(timespec='seconds'),
+          stale_cutoff())).rowcount
+    if claimed:
+        insert_job(conn, job_id, bank, filename, sha256, filepath, owner)
+    return claimed
+
+def finish_statement_file(sha256, status, message, rows=None):
+    writer.execute('''
+        UPDATE statement_files SET status = ?, message = ?, rows = ?, finished_at = ?
+        WHERE sha256 = ?
+    ''', (status, message, rows, datetime.now().isoformat(timespec='seconds'), sha256)).result()
+
+def record_batch(conn, job_id, owner, first_id, last_id, checkpoint):
+    """Within the transaction of a batch: its ids and the checkpoint of the job.
+
+    Raises ImportSuperseded, rolling the batch back, if owner no longer
+    runs the job.
+    """
+    updated = conn.execute('''
+        UPDATE import_jobs SET checkpoint = ?, heartbeat_at = ? WHERE id = ? AND owner IS ?
+    ''', (checkpoint, time.time(), job_id, owner)).rowcount
+    if not updated:
+        raise ImportSuperseded(job_id)
+    conn.execute('INSERT INTO import_batches (job_id, first_id, last_id) VALUES (?, ?, ?)',
+                 (job_id, first_id, last_id))
+
+def get_batches(job_id):
+    """(first id, last id) of the batches an unfinished job committed"""
+    conn = db.get_connection()
+    rows = conn.execute('''
+        SELECT first_id, last_id FROM import_batches WHERE job_id = ? ORDER BY first_id
+    ''', (job_id,)).fetchall()
+    return [tuple(row) for row in rows]
+
+def delete_batches(conn, job_id):
+    """Writer command: delete the entries an unfinished job wrote"""
+    ranges = conn.execute('SELECT first_id, last_id FROM import_batches WHERE job_id = ?',
+                          (job_id,)).fetchall()
+    for first_id, last_id in ranges:
+        conn.execute('DELETE FROM ledger WHERE id BETWEEN ? AND ?', (first_id, last_id))
+    conn.execute('DELETE FROM import_batches WHERE job_id = ?', (job_id,))
+    conn.execute('UPDATE import_jobs SET checkpoint = 0 WHERE id = ?', (job_id,))
+    return len(ranges)
+
+def heartbeat(running):
+    """Refresh the jobs running in this process, given as {job id: owner}"""
+    now = time.time()
+    writer.executemany('UPDATE import_jobs SET heartbeat_at = ? WHERE id = ? AND owner IS ?',
+                       [(now, job_id, owner) for job_id, owner in running.items()]).result()
+
+def stale_imports():
+    """Jobs still 'processing' whose run stopped sending heartbeats or is gone"""
+    conn = db.get_connection()
+    rows = conn.execute("SELECT * FROM import_jobs WHERE status = 'processing'").fetchall()
+    cutoff = time.time() - RESUME_AFTER
+    return [dict(row) for row in rows
+            if (row['heartbeat_at'] or 0) < cutoff or owner_is_gone(row['owner'])]
+
+def claim_import(job, owner):
+    """Take over a stale job (as returned by stale_imports); whether it was taken"""
+    return writer.execute('''
+        UPDATE import_jobs SET owner = ?, heartbeat_at = ?, resumes = resumes + 1
+        WHERE id = ? AND status = 'processing' AND heartbeat_at IS ?
+    ''', (owner, time.time(), job['id'], job['heartbeat_at'])).result() == 1
+
+def abandon_import(job_id, owner, message):
+    """Give up a job that cannot be resumed, deleting what it wrote"""
+    writer.run(write_abandoned_import, job_id, owner, message,
+               datetime.now().isoformat(timespec='seconds'))
+
+def write_abandoned_import(conn, job_id, owner, message, now):
+    delete_batches(conn, job_id)
+    conn.execute('''
+        UPDATE import_jobs SET status = 'error', message = ?, finished_at = ?
+        WHERE id = ? AND owner IS ?
+    ''', (message, now, job_id, owner))
+    conn.execute('''
+        UPDATE statement_files SET status = 'error', message = ?, finished_at = ?
+        WHERE job_id = ? AND status = 'processing'
+    ''', (message, now, job_id))
+
+def active_upload_paths():
+    """Files of the imports not finished yet (running or to be resumed)"""
+    conn = db.get_connection()
+    rows = conn.execute('''
+        SELECT filepath FROM import_jobs WHERE status = 'processing' AND filepath IS NOT NULL
+    ''').fetchall()
+    return {row['filepath'] for row in rows}
@@ -0,0 +1,229 @@
+"""Columnar read cache of the recebidos, enviados and internal views.
+
+Enabled with LEDGER_CACHE=1. Each process keeps the ledger as NumPy
+arrays, one entry per row in the order of the views: day (YYYYMMDD,
+ordered like the dates), centavos, category id and a code of the
+document. The filters and totals of a view are computed with boolean
+masks over these columns; the rows of the page are then read from SQLite
+by id, a chunk at a time while the page streams.
+
+The cache follows the data generation (ledger_state). Ids are never
+reused (AUTOINCREMENT) and the day, amount, category and document of an
+entry do not change, so a new generation only reads the rows past the
+last cached id, or everything again when rows were deleted. What depends
+on the descriptions, which the CNPJ lookups rewrite, or on the transfer
+matches is read again at every generation: the rows excluded from the
+external views, the mentions of each AF company and the deduplicated rows
+of the internal view with their transfer legs, small sets found through
+the full-text index.
+"""
+import threading
+from collections import namedtuple
+import numpy as np
+import db
+import metrics
+from categories import CATEGORY_NAMES, filter_category_ids
+from fts import description_match
+from reconcile import AF_COMPANIES, AF_DESCRIPTION_EXCLUSIONS
+
+# Transfer leg of the internal view rows, by code
+LEGS = [None, 'saida', 'entrada']
+LEG_CODES = {leg: code for code, leg in enumerate(LEGS)}
+
+# Rows read from SQLite at a time while a view streams
+ROW_CHUNK = 500
+
+ROW_QUERY = '''
+    SELECT t.id, t.day, t.description, t.amount_cents,
+        t.type AS original_type,
+        c.name AS displayed_type,
+        t.document
+    FROM ledger t
+    JOIN categories c ON c.id = t.category
+    WHERE t.id IN ({})
+'''
+
+# Per-row columns; documents are codes of document_codes (-1 for none)
+Columns = namedtuple('Columns', ['ids', 'days', 'cents', 'categories', 'documents'])
+# columns: in id order, extended at each generation; view: the same in the
+# order of the views (day, then id, descending), with rank mapping the
+# first to the second. The masks are in view order: rows of the external
+# views, rows of the internal view (one per duplicate group) and
+# {AF CNPJ: descriptions naming the company}; legs is the LEGS code of the
+# internal rows. group_keys and abs_cents, in view order too, are the
+# inputs of type_totals.
+Snapshot = namedtuple('Snapshot', ['generation', 'columns', 'document_codes', 'view', 'rank',
+                                   'external', 'internal', 'legs', 'mentions',
+                                   'group_keys', 'abs_cents'])
+
+_snapshot = None
+_lock = threading.Lock()
+
+def empty_columns():
+    return Columns(np.zeros(0, np.int64), np.zeros(0, np.int32), np.zeros(0, np.int64),
+                   np.zeros(0, np.int16), np.zeros(0, np.int32))
+
+def load_columns(conn, columns, document_codes):
+    """columns with the rows past its last id appended"""
+    last_id = int(columns.ids[-1]) if len(columns.ids) else 0
+    rows = conn.execute('''
+        SELECT id, day, amount_cents, category, document FROM ledger WHERE id > ? ORDER BY id
+    ''', (last_id,)).fetchall()
+    if not rows:
+        return columns
+    ids, days, cents, categories, documents = zip(*rows)
+    codes = [-1 if document is None else document_codes.setdefault(document, len(document_codes))
+             for document in documents]
+    added = Columns(np.array(ids, np.int64), np.array(days, np.int32), np.array(cents, np.int64),
+                    np.array(categories, np.int16), np.array(codes, np.int32))
+    return Columns(*(np.concatenate(pair) for pair in zip(columns, added)))
+
+def locate(columns, ids):
+    """(positions in columns, mask of the ids found) of an id array"""
+    positions = np.searchsorted(columns.ids, ids)
+    found = positions < len(columns.ids)
+    found[found] = columns.ids[positions[found]] == ids[found]
+    return positions, found
+
+def id_mask(columns, rank, ids):
+    """Mask, in view order, of the rows with these ids"""
+    positions, found = locate(columns, np.array(ids, np.int64))
+    mask = np.zeros(len(columns.ids), bool)
+    mask[rank[positions[found]]] = True
+    return mask
+
+def matching_ids(conn, terms):
+    """Ids of the entries whose description contains any of terms"""
+    condition, params = description_match(terms)
+    rows = conn.execute(f'SELECT t.id FROM ledger t WHERE {condition}', params).fetchall()
+    return [row[0] for row in rows]
+
+def document_mask(snapshot, document):
+    code = snapshot.document_codes.get(document)
+    if code is None:
+        return np.zeros(len(snapshot.columns.ids), bool)
+    return snapshot.view.documents == code
+
+def build_snapshot(conn, generation, previous, internal_query, internal_params):
+    if previous is None:
+        columns, document_codes = empty_columns(), {}
+    else:
+        columns, document_codes = previous.columns, previous.document_codes
+        last_id = int(columns.ids[-1]) if len(columns.ids) else 0
+        kept = conn.execute('SELECT COUNT(*) FROM ledger WHERE id <= ?', (last_id,)).fetchone()[0]
+        if kept != len(columns.ids):
+            # Entries were deleted (an abandoned import): read everything again
+            columns, document_codes = empty_columns(), {}
+    columns = load_columns(conn, columns, document_codes)
+
+    # Selections then come out in view order without a gather per request
+    order = np.lexsort((columns.ids, columns.days))[::-1]
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    view = Columns(*(column[order] for column in columns))
+
+    af_codes = [document_codes[cnpj] for cnpj in AF_COMPANIES if cnpj in document_codes]
+    external = ~np.isin(view.documents, af_codes)
+    external &= ~id_mask(columns, rank, matching_ids(conn, AF_DESCRIPTION_EXCLUSIONS))
+
+    internal = np.zeros(len(columns.ids), bool)
+    legs = np.zeros(len(columns.ids), np.int8)
+    rows = conn.execute(f'SELECT id, transfer_leg FROM ({internal_query})', internal_params).fetchall()
+    if rows:
+        ids = np.array([row[0] for row in rows], np.int64)
+        leg_codes = np.array([LEG_CODES[row[1]] for row in rows], np.int8)
+        # Entries written after the columns were read wait for the next generation
+        positions, found = locate(columns, ids)
+        internal[rank[positions[found]]] = True
+        legs[rank[positions[found]]] = leg_codes[found]
+
+    mentions = {cnpj: id_mask(columns, rank, matching_ids(conn, [name]))
+                for cnpj, name in AF_COMPANIES.items()}
+    group_keys = view.categories.astype(np.int64) * len(LEGS)
+    # Float sums are exact below 2**53 centavos
+    abs_cents = np.abs(view.cents).astype(np.float64)
+    return Snapshot(generation, columns, document_codes, view, rank, external, internal, legs, mentions,
+                    group_keys, abs_cents)
+
+def get_snapshot(conn, internal_query, internal_params):
+    """The cache at the current data generation, refreshed if needed.
+
+    internal_query is the query of the internal view without filters; it
+    gives the rows of that view and their transfer legs.
+    """
+    global _snapshot
+    row = conn.execute('SELECT generation FROM ledger_state WHERE id = 1').fetchone()
+    # Read before the rows: a write in the meantime only causes another refresh
+    generation = row[0] if row else 0
+    snapshot = _snapshot
+    hit = snapshot is not None and snapshot.generation == generation
+    metrics.record_cache('ledger_columns', hit)
+    if hit:
+        return snapshot
+    with _lock:
+        if _snapshot is None or _snapshot.generation != generation:
+            _snapshot = build_snapshot(conn, generation, _snapshot, internal_query, internal_params)
+        return _snapshot
+
+def select(conn, snapshot, direction, tipo_filtro='todos', cnpj_filtro='todos',
+           start_date='', end_date='', q=''):
+    """Positions of the rows of a view (same filters as app.build_ledger_query),
+    in the order of the view"""
+    view = snapshot.view
+    if direction == 'internas':
+        mask = snapshot.internal.copy()
+        if cnpj_filtro != 'todos':
+            company = document_mask(snapshot, cnpj_filtro)
+            if cnpj_filtro in snapshot.mentions:
+                company |= snapshot.mentions[cnpj_filtro]
+            mask &= company
+    else:
+        mask = snapshot.external & (view.cents > 0 if direction == 'recebidos' else view.cents < 0)
+        if cnpj_filtro != 'todos':
+            mask &= document_mask(snapshot, cnpj_filtro)
+
+    if tipo_filtro != 'todos':
+        mask &= np.isin(view.categories, filter_category_ids(direction, tipo_filtro))
+
+    start_day = db.parse_day(start_date)
+    if start_day:
+        mask &= view.days >= start_day
+
+    end_day = db.parse_day(end_date)
+    if end_day:
+        mask &= view.days <= end_day
+
+    if q:
+        mask &= id_mask(snapshot.columns, snapshot.rank, matching_ids(conn, [q]))
+
+    return np.flatnonzero(mask)
+
+def type_totals(snapshot, positions, with_legs=False):
+    """(displayed type, transfer leg, absolute centavos) of the selected rows,
+    like app.ledger_type_totals (groups summing to zero are left out)"""
+    keys = snapshot.group_keys[positions]
+    if with_legs:
+        keys += snapshot.legs[positions]
+    sums = np.bincount(keys, weights=snapshot.abs_cents[positions])
+    return [(CATEGORY_NAMES[key // len(LEGS)], LEGS[key % len(LEGS)], int(sums[key]))
+            for key in np.flatnonzero(sums)]
+
+def iter_rows(snapshot, positions, with_legs=False):
+    """Yield the rows at positions, read from SQLite a chunk at a time"""
+    conn = db.get_connection()
+    try:
+        for start in range(0, len(positions), ROW_CHUNK):
+            chunk = positions[start:start + ROW_CHUNK]
+            ids = snapshot.view.ids[chunk].tolist()
+            rows = {row['id']: row for row in
+                    conn.execute(ROW_QUERY.format(','.join('?' * len(ids))), ids)}
+            for row_id, leg in zip(ids, snapshot.legs[chunk].tolist()):
+                row = rows.get(row_id)
+                if row is None:
+                    continue  # deleted since the snapshot
+                row = dict(row)
+                if with_legs:
+                    row['transfer_leg'] = LEGS[leg]
+                yield row
+    finally:
+        conn.close()
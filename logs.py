@@ -0,0 +1,51 @@
+"""Application logging through a queue.
+
+Loggers under 'financeiro' only put records on an in-memory queue; a
+listener thread writes them to stderr. The importing threads never wait
+on console or gunicorn log I/O.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(name)s] %(message)s'
+
+_handler = logging.handlers.QueueHandler(queue.Queue(-1))
+_listener = None
+
+def start_listener():
+    global _listener
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    _listener = logging.handlers.QueueListener(_handler.queue, handler, respect_handler_level=True)
+    _listener.start()
+
+def stop_listener():
+    """Write out the records still queued"""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+def restart_in_child():
+    # Neither the listener thread nor the queue's lock survive a fork
+    # (gunicorn workers): start over with a fresh queue
+    _handler.queue = queue.Queue(-1)
+    start_listener()
+
+def setup():
+    root = logging.getLogger('financeiro')
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+    root.addHandler(_handler)
+    start_listener()
+    atexit.register(stop_listener)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=restart_in_child)
+
+def get_logger(name):
+    return logging.getLogger(f'financeiro.{name}')
+
+setup()
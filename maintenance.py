@@ -0,0 +1,70 @@
+"""Periodic maintenance tasks run by the scheduler (scheduler.py).
+
+The tasks tied to the state of the web app (upload progress, upload
+folder, resuming the imports of a dead worker) are registered in app.py.
+"""
+import cnpj
+import db
+import reconcile
+import writer
+from logs import get_logger
+from scheduler import periodic
+
+logger = get_logger('maintenance')
+
+# Pages given back to the file system per incremental vacuum run
+VACUUM_PAGES = 2000
+# Share of free pages above which a database without auto_vacuum is
+# vacuumed (once, switching it to incremental)
+VACUUM_FREE_RATIO = 0.25
+
+@periodic('retry_cnpjs', 3600, local=True)
+def retry_cnpjs():
+    """Look up again the CNPJs this process failed to fetch"""
+    if not cnpj.failed_cnpjs:
+        return 0
+    recovered, still_failed = cnpj.retry_failed_cnpjs()
+    logger.info("Retry de CNPJs: %s recuperados, %s ainda com falha", recovered, len(still_failed))
+    return recovered
+
+def optimize_command(conn):
+    conn.execute('PRAGMA optimize')
+
+@periodic('optimize', 3600)
+def optimize():
+    """Refresh the planner statistics of the tables that need it"""
+    writer.run(optimize_command)
+
+def incremental_vacuum(conn, pages):
+    # The sqlite3 module steps the pragma once: one page per execute
+    for _ in range(pages):
+        conn.execute('PRAGMA incremental_vacuum(1)')
+    return pages
+
+@periodic('vacuum', 86400)
+def vacuum():
+    """Give the free pages back to the file system; returns how many"""
+    conn = db.get_connection()
+    auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+    free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    if auto_vacuum == 2:
+        return writer.run(incremental_vacuum, min(free_pages, VACUUM_PAGES))
+
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    if free_pages <= page_count * VACUUM_FREE_RATIO:
+        return 0
+    # VACUUM cannot run inside the writer's transaction; the writer waits
+    # for it like for another process (busy_timeout)
+    logger.info("VACUUM completo: %s de %s páginas livres", free_pages, page_count)
+    vacuum_conn = db.connect()
+    try:
+        vacuum_conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        vacuum_conn.execute('VACUUM')
+    finally:
+        vacuum_conn.release()
+    return free_pages
+
+@periodic('reconcile_transfers', 3600)
+def reconcile_transfers():
+    """Match the internal transfers whose legs were left unmatched"""
+    return writer.run(reconcile.match_all)
@@ -0,0 +1,157 @@
+"""In-process metrics exposed in the Prometheus text format at /metrics.
+
+Each gunicorn worker keeps its own values; Prometheus tells them apart by
+the instance it scrapes.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; covers fast SQL statements up to slow external calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def label_values(self):
+        with self._lock:
+            return list(self._values)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{format_labels(self.labelnames, key)} {value}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [bucket counts..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    values[index] += 1
+                    break
+            values[-2] += seconds
+            values[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, values in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, values):
+                    cumulative += count
+                    labels = format_labels(self.labelnames, key, [('le', repr(float(bound)))])
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = format_labels(self.labelnames, key, [('le', '+Inf')])
+                lines.append(f'{self.name}_bucket{labels} {values[-1]}')
+                labels = format_labels(self.labelnames, key)
+                lines.append(f'{self.name}_sum{labels} {values[-2]}')
+                lines.append(f'{self.name}_count{labels} {values[-1]}')
+        return lines
+
+REQUEST_DURATION = Histogram(
+    'financeiro_http_request_duration_seconds',
+    'Time to build and send each response, by route.',
+    ['method', 'route', 'status'])
+SQL_DURATION = Histogram(
+    'financeiro_sql_statement_duration_seconds',
+    'Time spent executing SQL statements (first step; fetches excluded), by operation.',
+    ['operation'])
+AUTH_DURATION = Histogram(
+    'financeiro_auth_verify_duration_seconds',
+    'Latency of token verification against the auth server.',
+    ['result'])
+CNPJ_API_DURATION = Histogram(
+    'financeiro_cnpj_api_duration_seconds',
+    'Latency of BrasilAPI CNPJ lookups.',
+    ['status'])
+CACHE_REQUESTS = Counter(
+    'financeiro_cache_requests_total',
+    'Cache lookups by cache and result (hit or miss).',
+    ['cache', 'result'])
+WRITER_BATCH_SIZE = Histogram(
+    'financeiro_db_writer_batch_commands',
+    'Write commands committed together by the database writer.',
+    buckets=(1, 2, 5, 10, 25, 50, 100, 256))
+WRITER_COMMIT_DURATION = Histogram(
+    'financeiro_db_writer_transaction_duration_seconds',
+    'Time the database writer takes to run and commit a batch of commands.')
+SCHEDULER_TASK_DURATION = Histogram(
+    'financeiro_scheduler_task_duration_seconds',
+    'Duration of the periodic maintenance tasks, by task and result.',
+    ['task', 'status'])
+
+METRICS = [REQUEST_DURATION, SQL_DURATION, AUTH_DURATION, CNPJ_API_DURATION, CACHE_REQUESTS,
+           WRITER_BATCH_SIZE, WRITER_COMMIT_DURATION, SCHEDULER_TASK_DURATION]
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+def sql_operation(sql):
+    """First keyword of a statement, used as the SQL metric label"""
+    words = sql.lstrip().split(None, 1)
+    return words[0].upper() if words else 'EMPTY'
+
+def render_cache_ratios():
+    caches = sorted({key[0] for key in CACHE_REQUESTS.label_values()})
+    lines = ['# HELP financeiro_cache_hit_ratio Share of cache lookups that were hits.',
+             '# TYPE financeiro_cache_hit_ratio gauge']
+    for cache in caches:
+        hits = CACHE_REQUESTS.value(cache=cache, result='hit')
+        total = hits + CACHE_REQUESTS.value(cache=cache, result='miss')
+        ratio = hits / total if total else 0
+        lines.append(f'financeiro_cache_hit_ratio{format_labels(["cache"], [cache])} {ratio}')
+    return lines
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend(render_cache_ratios())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,420 @@
+import sqlite3
+from categories import CATEGORY_IDS, DEFAULT_CATEGORY, seed_categories, backfill_categories, init_categories
+from db import iso_date_sql
+from reconcile import internal_legs, match_legs, store_matches
+from logs import get_logger
+
+logger = get_logger('migrations')
+
+# (version, function) pairs; the schema version is kept in PRAGMA user_version
+MIGRATIONS = []
+
+def migration(version):
+    """Register a schema migration"""
+    def decorator(func):
+        MIGRATIONS.append((version, func))
+        return func
+    return decorator
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def run_migrations(conn):
+    """Apply, in order, every migration newer than the database schema"""
+    for version, func in sorted(MIGRATIONS):
+        if version <= get_schema_version(conn):
+            continue
+
+        # Take the write lock first so concurrent workers migrate only once
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if version <= get_schema_version(conn):
+                conn.rollback()
+                continue
+            logger.info("Aplicando migração %s: %s", version, func.__doc__)
+            func(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+def setup_schema(conn):
+    """Migrate the database and sync the category tables.
+
+    Runs once in the gunicorn master before the workers start
+    (gunicorn.conf.py), or at import of app when it is run otherwise.
+    """
+    run_migrations(conn)
+    init_categories(conn.cursor())
+    conn.commit()
+
+def create_fts(cursor, table):
+    """Full-text index over the descriptions of table, kept in sync by triggers.
+
+    The trigram tokenizer (SQLite 3.34+) makes substring matches
+    index-assisted; older SQLite builds fall back to unicode61.
+    """
+    fts_table = f'{table}_fts'
+    for tokenizer in ['trigram', 'unicode61']:
+        try:
+            cursor.execute(f'''
+                CREATE VIRTUAL TABLE {fts_table} USING fts5(
+                    description,
+                    content='{table}',
+                    content_rowid='id',
+                    tokenize='{tokenizer}'
+                )
+            ''')
+            break
+        except sqlite3.OperationalError as e:
+            logger.warning("FTS5 tokenizer %s indisponível: %s", tokenizer, e)
+    else:
+        return
+
+    # Index the rows that already exist
+    cursor.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+
+    cursor.execute(f'''
+        CREATE TRIGGER trg_{table}_fts_insert AFTER INSERT ON {table}
+        BEGIN
+            INSERT INTO {fts_table} (rowid, description) VALUES (new.id, new.description);
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER trg_{table}_fts_delete AFTER DELETE ON {table}
+        BEGIN
+            INSERT INTO {fts_table} ({fts_table}, rowid, description)
+            VALUES ('delete', old.id, old.description);
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER trg_{table}_fts_update AFTER UPDATE OF description ON {table}
+        BEGIN
+            INSERT INTO {fts_table} ({fts_table}, rowid, description)
+            VALUES ('delete', old.id, old.description);
+            INSERT INTO {fts_table} (rowid, description) VALUES (new.id, new.description);
+        END
+    ''')
+
+def create_generation_triggers(cursor, table):
+    """Bump ledger_state.generation on every change to table (used for ETags and caches)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            generation INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO ledger_state (id, generation) VALUES (1, 0)')
+    for event in ['INSERT', 'UPDATE', 'DELETE']:
+        cursor.execute(f'''
+            CREATE TRIGGER trg_{table}_generation_{event.lower()}
+            AFTER {event} ON {table}
+            BEGIN
+                UPDATE ledger_state SET generation = generation + 1 WHERE id = 1;
+            END
+        ''')
+
+@migration(1)
+def baseline_schema(cursor):
+    """transactions table as created by the unversioned init_db"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date DATE NOT NULL,
+            description TEXT NOT NULL,
+            value REAL NOT NULL,
+            type TEXT NOT NULL,
+            transaction_type TEXT NOT NULL,
+            document TEXT
+        )
+    ''')
+
+    mapping_changed = seed_categories(cursor)
+    cursor.execute('PRAGMA table_info(transactions)')
+    if 'category' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE transactions ADD COLUMN category INTEGER REFERENCES categories(id)')
+    backfill_categories(cursor, 'transactions', everything=mapping_changed)
+
+@migration(2)
+def compact_ledger(cursor):
+    """ledger table with integer centavos and YYYYMMDD days, transactions becomes a view"""
+    cursor.execute('''
+        CREATE TABLE ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            day INTEGER NOT NULL,
+            description TEXT NOT NULL,
+            amount_cents INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            transaction_type TEXT NOT NULL,
+            document TEXT,
+            category INTEGER REFERENCES categories(id)
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO ledger (id, day, description, amount_cents, type, transaction_type, document, category)
+        SELECT id,
+            COALESCE(CAST(strftime('%Y%m%d', date) AS INTEGER), 0),
+            description,
+            CAST(ROUND(value * 100) AS INTEGER),
+            type,
+            transaction_type,
+            document,
+            category
+        FROM transactions
+    ''')
+    cursor.execute("""
+        UPDATE sqlite_sequence SET seq = (SELECT COALESCE(MAX(id), 0) FROM ledger)
+        WHERE name = 'ledger'
+    """)
+
+    # Derived objects of the old table go away with it
+    cursor.execute('DROP TABLE IF EXISTS transactions_fts')
+    cursor.execute('DROP TABLE transactions')
+
+    cursor.execute('CREATE INDEX idx_ledger_day ON ledger(day)')
+    cursor.execute('CREATE INDEX idx_ledger_type ON ledger(type)')
+    cursor.execute('CREATE INDEX idx_ledger_document ON ledger(document)')
+    cursor.execute('CREATE INDEX idx_ledger_category ON ledger(category)')
+    create_generation_triggers(cursor, 'ledger')
+    create_fts(cursor, 'ledger')
+
+    # Compatibility view with the old column names and formats
+    cursor.execute(f'''
+        CREATE VIEW transactions AS
+        SELECT id,
+            {iso_date_sql('day')} AS date,
+            description,
+            amount_cents / 100.0 AS value,
+            type,
+            transaction_type,
+            document,
+            category
+        FROM ledger
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER trg_transactions_view_insert INSTEAD OF INSERT ON transactions
+        BEGIN
+            INSERT INTO ledger (day, description, amount_cents, type, transaction_type, document, category)
+            VALUES (
+                CAST(strftime('%Y%m%d', new.date) AS INTEGER),
+                new.description,
+                CAST(ROUND(new.value * 100) AS INTEGER),
+                new.type,
+                new.transaction_type,
+                new.document,
+                COALESCE(
+                    new.category,
+                    (SELECT category_id FROM category_types WHERE category_types.type = new.type),
+                    {CATEGORY_IDS[DEFAULT_CATEGORY]}
+                )
+            );
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_transactions_view_update INSTEAD OF UPDATE ON transactions
+        BEGIN
+            UPDATE ledger SET
+                day = CAST(strftime('%Y%m%d', new.date) AS INTEGER),
+                description = new.description,
+                amount_cents = CAST(ROUND(new.value * 100) AS INTEGER),
+                type = new.type,
+                transaction_type = new.transaction_type,
+                document = new.document,
+                category = new.category
+            WHERE id = old.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_transactions_view_delete INSTEAD OF DELETE ON transactions
+        BEGIN
+            DELETE FROM ledger WHERE id = old.id;
+        END
+    ''')
+
+@migration(3)
+def route_indexes(cursor):
+    """composite and covering indexes for the ledger routes"""
+    for name in ['idx_ledger_day', 'idx_ledger_type', 'idx_ledger_document', 'idx_ledger_category']:
+        cursor.execute(f'DROP INDEX IF EXISTS {name}')
+
+    # id is part of every key so ORDER BY day DESC, id DESC needs no sort
+
+    # recebidos / enviados: sign filter, date range and order; category and
+    # document are checked in the index before the row is read
+    cursor.execute('''
+        CREATE INDEX idx_ledger_credits ON ledger(day, id, category, document)
+        WHERE amount_cents > 0
+    ''')
+    cursor.execute('''
+        CREATE INDEX idx_ledger_debits ON ledger(day, id, category, document)
+        WHERE amount_cents < 0
+    ''')
+    # Unfiltered listing and the dashboard totals (covering)
+    cursor.execute('CREATE INDEX idx_ledger_day ON ledger(day, id, amount_cents, document, type, category)')
+    # Category filter, summary details, totals per category (covering)
+    cursor.execute('CREATE INDEX idx_ledger_category ON ledger(category, day, id, amount_cents)')
+    # CNPJ filter, internal companies and the top CNPJs (covering)
+    cursor.execute('CREATE INDEX idx_ledger_document ON ledger(document, day, id, amount_cents)')
+
+    cursor.execute('ANALYZE ledger')
+
+@migration(4)
+def import_jobs(cursor):
+    """import_jobs table with the status and stage profile of each upload"""
+    cursor.execute('''
+        CREATE TABLE import_jobs (
+            id TEXT PRIMARY KEY,
+            bank TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            status TEXT NOT NULL,
+            message TEXT,
+            rows INTEGER,
+            started_at TEXT NOT NULL,
+            finished_at TEXT,
+            profile TEXT,
+            profile_path TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX idx_import_jobs_started_at ON import_jobs(started_at)')
+
+@migration(5)
+def statement_files(cursor):
+    """statement_files table keyed by the SHA-256 of each uploaded file"""
+    cursor.execute('''
+        CREATE TABLE statement_files (
+            sha256 TEXT PRIMARY KEY,
+            bank TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            job_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            message TEXT,
+            rows INTEGER,
+            uploaded_at TEXT NOT NULL,
+            finished_at TEXT
+        )
+    ''')
+
+@migration(6)
+def import_rejects(cursor):
+    """import_rejects table with the rows each import left out, and their count per job"""
+    cursor.execute('ALTER TABLE import_jobs ADD COLUMN rejected INTEGER')
+    cursor.execute('''
+        CREATE TABLE import_rejects (
+            job_id TEXT NOT NULL,
+            row INTEGER NOT NULL,
+            field TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            value TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX idx_import_rejects_job ON import_rejects(job_id, row)')
+
+@migration(7)
+def transfer_matches(cursor):
+    """transfer_matches table pairing the two legs of each transfer between AF group accounts"""
+    cursor.execute('''
+        CREATE TABLE transfer_matches (
+            id INTEGER PRIMARY KEY,
+            debit_id INTEGER NOT NULL UNIQUE,
+            credit_id INTEGER NOT NULL UNIQUE,
+            amount_cents INTEGER NOT NULL,
+            debit_day INTEGER NOT NULL,
+            credit_day INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX idx_transfer_matches_day ON transfer_matches(debit_day, amount_cents)')
+    # A deleted entry (pair cleanup, failed import) undoes its match
+    cursor.execute('''
+        CREATE TRIGGER trg_ledger_transfer_matches_delete AFTER DELETE ON ledger
+        BEGIN
+            DELETE FROM transfer_matches WHERE debit_id = old.id OR credit_id = old.id;
+        END
+    ''')
+    # The import of these entries is not known (import_batches comes with
+    # migration 11): they are paired on amount and day only
+    matched = store_matches(cursor, match_legs(*internal_legs(cursor, '1=1', [])))
+    logger.info("%s transferências internas conciliadas", matched)
+
+@migration(8)
+def balance_snapshots(cursor):
+    """balance_snapshots table with the checked daily closing balance of each account"""
+    cursor.execute('''
+        CREATE TABLE balance_snapshots (
+            bank TEXT NOT NULL,
+            account TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            balance_cents INTEGER NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (bank, account, day)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('ALTER TABLE import_jobs ADD COLUMN balance_mismatches INTEGER')
+
+@migration(9)
+def companies(cursor):
+    """companies table with the names fetched for each CNPJ, shared by all workers"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS companies (
+            document TEXT PRIMARY KEY,
+            nome_fantasia TEXT,
+            razao_social TEXT
+        )
+    ''')
+    # A new name changes the CNPJ dropdowns cached per generation
+    create_generation_triggers(cursor, 'companies')
+
+@migration(10)
+def scheduler_tables(cursor):
+    """scheduler_lease and scheduler_runs tables of the background maintenance tasks"""
+    cursor.execute('''
+        CREATE TABLE scheduler_lease (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            owner TEXT,
+            expires_at REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT INTO scheduler_lease (id) VALUES (1)')
+    cursor.execute('''
+        CREATE TABLE scheduler_runs (
+            name TEXT PRIMARY KEY,
+            started_at TEXT NOT NULL,
+            duration REAL NOT NULL,
+            status TEXT NOT NULL,
+            message TEXT,
+            pid INTEGER,
+            runs INTEGER NOT NULL
+        )
+    ''')
+
+@migration(11)
+def import_checkpoints(cursor):
+    """import_batches table and import_jobs checkpoint columns, for resuming the imports of a dead worker"""
+    for column in ['sha256 TEXT', 'filepath TEXT', 'owner TEXT', 'heartbeat_at REAL',
+                   'checkpoint INTEGER NOT NULL DEFAULT 0', 'resumes INTEGER NOT NULL DEFAULT 0']:
+        cursor.execute(f'ALTER TABLE import_jobs ADD COLUMN {column}')
+    cursor.execute('CREATE INDEX idx_import_jobs_status ON import_jobs(status, heartbeat_at)')
+    # Ledger id range of each batch committed by an unfinished import
+    cursor.execute('''
+        CREATE TABLE import_batches (
+            job_id TEXT NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX idx_import_batches_job ON import_batches(job_id)')
+
+@migration(12)
+def transfer_match_generation(cursor):
+    """transfer_matches changes bump the data generation (legs of the internal view)"""
+    # Matches are stored by a writer command after the entries of an import
+    create_generation_triggers(cursor, 'transfer_matches')
+
+@migration(13)
+def balance_checked(cursor):
+    """balance_snapshots and import_jobs tell whether the statement balance was compared with another"""
+    # Earlier snapshots may come from a single printed balance: unchecked
+    # until the statement is imported again
+    cursor.execute('ALTER TABLE balance_snapshots ADD COLUMN checked INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE import_jobs ADD COLUMN balance_checked INTEGER')
@@ -0,0 +1,181 @@
+"""Per-stage profiling of statement imports.
+
+The importing thread activates an IngestProfile; the readers wrap each
+stage in profiling.stage(name), which is a no-op when no profile is
+active (benchmarks, scripts). Stages run once per row are timed into a
+StageTimings and added to the profile once per batch.
+"""
+import cProfile
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Memory tracing slows every allocation of the process while an import
+# runs (about 2x on a CSV upload), so it is only on when asked for
+TRACE_MEMORY = os.getenv('INGEST_TRACE_MEMORY', '0') == '1'
+
+_local = threading.local()
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+
+class StageCall:
+    """One entry into a stage; the caller may set rows"""
+    __slots__ = ['rows']
+
+    def __init__(self, rows=0):
+        self.rows = rows
+
+class IngestProfile:
+    """Wall time, rows and peak traced memory of each stage of one import.
+
+    Stages entered repeatedly (per row) are accumulated. Peaks come from
+    tracemalloc, which is process-wide, so concurrent imports see each
+    other's allocations.
+    """
+
+    def __init__(self, cprofile_path=None, trace_memory=TRACE_MEMORY):
+        self.stages = {}
+        self.cprofile_path = cprofile_path
+        self.trace_memory = trace_memory
+        self.started = None
+        self.seconds = None
+        self.peak_kb = 0
+        self._profiler = None
+
+    def start(self):
+        global _tracing_users
+        self.started = time.perf_counter()
+        if self.trace_memory:
+            with _tracing_lock:
+                if _tracing_users == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                _tracing_users += 1
+        if self.cprofile_path:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def finish(self):
+        global _tracing_users
+        if self.started is None or self.seconds is not None:
+            return
+        self.seconds = time.perf_counter() - self.started
+        if self._profiler is not None:
+            self._profiler.disable()
+            os.makedirs(os.path.dirname(self.cprofile_path) or '.', exist_ok=True)
+            self._profiler.dump_stats(self.cprofile_path)
+        if self.trace_memory:
+            with _tracing_lock:
+                _tracing_users -= 1
+                if _tracing_users == 0 and tracemalloc.is_tracing():
+                    tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        call = StageCall(rows)
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield call
+        finally:
+            elapsed = time.perf_counter() - start
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'seconds': 0.0, 'calls': 0, 'rows': 0, 'peak_kb': 0}
+            stage['seconds'] += elapsed
+            stage['calls'] += 1
+            stage['rows'] += call.rows
+            if tracing:
+                peak_kb = tracemalloc.get_traced_memory()[1] // 1024
+                stage['peak_kb'] = max(stage['peak_kb'], peak_kb)
+                self.peak_kb = max(self.peak_kb, peak_kb)
+
+    def add_timings(self, timings):
+        """Add the stages timed by the caller (StageTimings); memory is
+        sampled once for all of them"""
+        peak_kb = 0
+        if self.trace_memory and tracemalloc.is_tracing():
+            peak_kb = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.reset_peak()
+            self.peak_kb = max(self.peak_kb, peak_kb)
+        for name, (seconds, calls, rows) in timings.items():
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'seconds': 0.0, 'calls': 0, 'rows': 0, 'peak_kb': 0}
+            stage['seconds'] += seconds
+            stage['calls'] += calls
+            stage['rows'] += rows
+            stage['peak_kb'] = max(stage['peak_kb'], peak_kb)
+
+    def as_dict(self):
+        """JSON-ready breakdown, in the order the stages were first entered"""
+        seconds = self.seconds
+        if seconds is None and self.started is not None:
+            seconds = time.perf_counter() - self.started
+        return {
+            'seconds': round(seconds or 0, 4),
+            'peak_kb': self.peak_kb if self.trace_memory else None,
+            'cprofile': bool(self.cprofile_path),
+            'stages': [
+                {
+                    'name': name,
+                    'seconds': round(stage['seconds'], 4),
+                    'calls': stage['calls'],
+                    'rows': stage['rows'],
+                    'rows_per_second': round(stage['rows'] / stage['seconds'], 1) if stage['rows'] and stage['seconds'] else None,
+                    'peak_kb': stage['peak_kb'] if self.trace_memory else None
+                }
+                # list() since the importing thread may add stages meanwhile
+                for name, stage in list(self.stages.items())
+            ]
+        }
+
+class StageTimings:
+    """Time of the stages run once per row, summed until flush()"""
+
+    def __init__(self):
+        self.timings = {}
+
+    def add(self, name, seconds, rows=1):
+        timing = self.timings.get(name)
+        if timing is None:
+            self.timings[name] = [seconds, 1, rows]
+        else:
+            timing[0] += seconds
+            timing[1] += 1
+            timing[2] += rows
+
+    def flush(self):
+        """Add the sums to the current profile (if any) and start over"""
+        profile = current()
+        if profile is not None and self.timings:
+            profile.add_timings(self.timings)
+        self.timings = {}
+
+def activate(profile):
+    """Make profile the current one of this thread and start it"""
+    _local.profile = profile
+    profile.start()
+
+def deactivate():
+    profile = getattr(_local, 'profile', None)
+    _local.profile = None
+    if profile is not None:
+        profile.finish()
+    return profile
+
+def current():
+    return getattr(_local, 'profile', None)
+
+@contextmanager
+def stage(name, rows=0):
+    """Time a stage of the current thread's import (no-op without one)"""
+    profile = current()
+    if profile is None:
+        yield StageCall(rows)
+    else:
+        with profile.stage(name, rows) as call:
+            yield call
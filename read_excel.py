@@ -3,6 +3,9 @@ import os
 import time
 from functools import wraps
 from datetime import datetime
+from logs import get_logger
+
+logger = get_logger('read_excel')
 
 MAX_RETRIES = 3
 RETRY_DELAY = 5  # seconds
@@ -180,8 +183,7 @@ def process_excel_file(file):
                             try:
                                 data = datetime.strptime(data, '%Y-%m-%d').strftime('%Y-%m-%d')
                             except ValueError:
-                                print(f"Erro ao processar linha {_}: 'Data'")
-                                print(f"Dados da linha: {dict(row)}")
+                                logger.debug("Linha %s rejeitada: data inválida", _)
                                 continue
                     elif isinstance(data, datetime):
                         data = data.strftime('%Y-%m-%d')
@@ -189,12 +191,10 @@ def process_excel_file(file):
                         try:
                             data = pd.to_datetime(data).strftime('%Y-%m-%d')
                         except:
-                            print(f"Erro ao processar linha {_}: 'Data'")
-                            print(f"Dados da linha: {dict(row)}")
+                            logger.debug("Linha %s rejeitada: data inválida", _)
                             continue
                 except Exception as e:
-                    print(f"Erro ao processar linha {_}: 'Data'")
-                    print(f"Dados da linha: {dict(row)}")
+                    logger.debug("Linha %s rejeitada: data inválida", _)
                     continue
                 
                 # Get description
@@ -227,7 +227,7 @@ def process_excel_file(file):
                 })
                 
             except Exception as e:
-                print(f"Erro ao processar linha: {e}")
+                logger.debug("Linha rejeitada: %s", e)
                 continue
         
         if not transactions:
@@ -1,5 +1,10 @@
-from .base import BankReader
-from .santander import SantanderReader
-from .itau import ItauReader
+from .base import BankReader, Record, SheetReader
+from .delimited import CsvReader
+from .ofx import OfxReader
+from .registry import READERS, detect_reader, get_reader, register, supported_extensions
+from .santander import SantanderReader, SantanderCsvReader, SantanderOfxReader
+from .itau import ItauReader, ItauCsvReader, ItauOfxReader
 
-__all__ = ['BankReader', 'SantanderReader', 'ItauReader']
\ No newline at end of file
+__all__ = ['BankReader', 'SheetReader', 'CsvReader', 'OfxReader', 'Record', 'READERS', 'detect_reader',
+           'get_reader', 'register', 'supported_extensions', 'SantanderReader', 'SantanderCsvReader',
+           'SantanderOfxReader', 'ItauReader', 'ItauCsvReader', 'ItauOfxReader']
@@ -0,0 +1,45 @@
+"""Running-balance check of a statement against its own saldo column.
+
+The first balance printed in the statement fixes the opening balance;
+every later one must equal it plus the cumulative sum of the entries
+read up to its row. A row left out (or a truncated file) shows up as a
+change in the difference between both, from that row on. With a single
+balance (OFX, which only carries LEDGERBAL) nothing is compared.
+"""
+from collections import namedtuple
+import numpy as np
+
+# A balance printed in the statement: its row, the number of records up
+# to it (including the one on the same row), its date and the balance in
+# reais
+Balance = namedtuple('Balance', ['row', 'position', 'date', 'balance'])
+
+def format_brl(cents):
+    return f'{cents / 100:,.2f}'.replace(',', 'X').replace('.', ',').replace('X', '.')
+
+def check_running_balance(cents, balances):
+    """Compare the statement balances with the running sum of the entries.
+
+    cents holds the amounts of the records in file order. Returns
+    (breaks, closing): breaks lists (Balance, expected cents) where the
+    difference changes, closing maps each date to (cents, checked) of its
+    last balance, if that one agrees with the running sum; checked is
+    False for the first balance, which was compared with nothing.
+    Statements in descending date order are not checked.
+    """
+    if not balances or balances[0].date > balances[-1].date:
+        return [], {}
+
+    running = np.concatenate(([0], np.cumsum(np.asarray(cents, dtype=np.int64))))
+    positions = np.array([balance.position for balance in balances])
+    printed = np.rint(np.array([balance.balance for balance in balances]) * 100).astype(np.int64)
+
+    expected = printed[0] - running[positions[0]] + running[positions]
+    difference = printed - expected
+    changed = np.flatnonzero(np.diff(difference, prepend=0))
+    breaks = [(balances[index], int(expected[index])) for index in changed]
+
+    last_of_day = {balance.date: index for index, balance in enumerate(balances)}
+    closing = {day: (int(printed[index]), index > 0) for day, index in last_of_day.items()
+               if difference[index] == 0}
+    return breaks, closing
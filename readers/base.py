@@ -1,41 +1,284 @@
+"""Base class of the statement readers.
+
+A reader only turns a file into normalized records: it never touches the
+database, the CNPJ API or the Flask app, so it can run in any thread or
+worker process. ingest.import_statement() classifies, enriches and stores
+what it yields.
+"""
+import re
 from abc import ABC, abstractmethod
-import sqlite3
+from collections import namedtuple
+from datetime import datetime
 import pandas as pd
+import profiling
+from cnpj import extract_cnpj
+from .balances import Balance, check_running_balance, format_brl
+
+# One statement entry: date is a datetime.date, value a float in reais
+# (negative for debits), document the CNPJ found in the description
+Record = namedtuple('Record', ['date', 'description', 'value', 'document'])
+
+# A row left out of the import: its number in the file (1-based), the
+# column at fault, why, and the cell as read
+Rejected = namedtuple('Rejected', ['row', 'column', 'reason', 'value'])
+
+# Rejected rows kept per import; the rest are only counted
+MAX_REJECTED = 10000
+
+# 'Agência: 0715  Conta: 13001234-5' in the preamble of the exports
+ACCOUNT_PATTERN = re.compile(r'ag[êe]ncia\W*(\d+)\W+conta\W*(\d[\d.\-]*)', re.IGNORECASE)
+
+# Keywords of the types that do not depend on the sign, checked in order
+SECONDARY_TYPES = {
+    'TARIFA': ['TARIFA', 'TAR'],
+    'IOF': ['IOF'],
+    'RESGATE': ['RESGATE'],
+    'APLICACAO': ['APLICACAO', 'APLICAÇÃO'],
+    'COMPRA': ['COMPRA'],
+    'COMPENSACAO': ['COMPENSACAO', 'COMPENSAÇÃO'],
+    'CHEQUE': ['CHEQUE'],
+    'JUROS': ['JUROS'],
+    'MULTA': ['MULTA']
+}
+
+def detect_transaction_type(description, value):
+    """Detect transaction type from description and value"""
+    description_upper = description.upper()
+
+    # Check for PAGAMENTO first
+    if 'PAGAMENTO' in description_upper:
+        return 'PAGAMENTO'
+
+    # Check PIX and TED
+    if 'PIX' in description_upper:
+        return 'PIX RECEBIDO' if value > 0 else 'PIX ENVIADO'
+    elif 'TED' in description_upper:
+        return 'TED RECEBIDA' if value > 0 else 'TED ENVIADA'
+
+    for tipo, keywords in SECONDARY_TYPES.items():
+        if any(keyword in description_upper for keyword in keywords):
+            return tipo
+
+    return 'DIVERSOS' if value > 0 else 'DEBITO'
+
+def process_date(date_val):
+    """Process date values from the statement (dd/mm/yyyy, ISO or Excel dates)"""
+    if pd.isna(date_val):
+        return None
+
+    try:
+        if isinstance(date_val, str):
+            date_val = date_val.strip()
+            for date_format in ('%d/%m/%Y', '%Y-%m-%d'):
+                try:
+                    return datetime.strptime(date_val, date_format).date()
+                except ValueError:
+                    continue
+            return None
+        elif isinstance(date_val, datetime):
+            return date_val.date()
+        else:
+            return pd.to_datetime(date_val).date()
+    except Exception:
+        return None
+
+def process_value(value):
+    """Process monetary values: numbers as they are, text as 1.234,56"""
+    if pd.isna(value):
+        return None
+
+    try:
+        if isinstance(value, (int, float)):
+            return float(value)
+        value_str = str(value).replace('R$', '').strip()
+        if not value_str:
+            return None
+        return float(value_str.replace('.', '').replace(',', '.'))
+    except Exception:
+        return None
+
+def cell_text(value):
+    """Stripped text of a cell, '' for empty ones"""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return ''
+    return str(value).strip()
+
+def find_header(rows, required):
+    """Index of the first row containing all the required column names
+    (case-insensitive), or None"""
+    required = {name.lower() for name in required}
+    for index, row in enumerate(rows):
+        if required <= {cell_text(cell).lower() for cell in row}:
+            return index
+    return None
+
+def statement_account(rows):
+    """'agência/conta' named in the preamble rows, or None"""
+    for row in rows:
+        match = ACCOUNT_PATTERN.search(' '.join(cell_text(cell) for cell in row))
+        if match:
+            return f'{match.group(1)}/{match.group(2)}'
+    return None
+
+def column_index(header, names):
+    """Position of the first header cell matching one of names, or None"""
+    wanted = [name.lower() for name in names]
+    cells = [cell_text(cell).lower() for cell in header]
+    for name in wanted:
+        if name in cells:
+            return cells.index(name)
+    return None
 
 class BankReader(ABC):
+    """A statement layout.
+
+    Subclasses set name, bank (the key used at upload and in the jobs) and
+    the file extensions they read, and implement sniff() and parse().
+    """
+    name = "Base Reader"
+    bank = None
+    extensions = ('xls', 'xlsx')
+    # Entries in the file being parsed (known once parse() returns), for the progress
+    total_rows = 0
+
     def __init__(self):
-        self.name = "Base Reader"
-        self.batch_size = 5  # Reduced
-        self.chunk_size = 100  # For Excel reading
-        self.timeout = 120  # 2 minutes timeout
-        self.commit_interval = 5  # Commit every N rows
+        self.rejected = []
+        self.rejected_count = 0
+        # Account of the statement and the balances it prints (Balance
+        # tuples), known once parse() returns or the records are consumed
+        self.account = None
+        self.balances = []
+        self.balance_mismatches = []
+        # Whether check_balances() compared two printed balances or more
+        # (None when the statement prints none)
+        self.balance_checked = None
 
-    @abstractmethod
     def get_bank_name(self):
-        pass
-    
-    def get_db_connection(self):
-        return sqlite3.connect('instance/financas.db', timeout=self.timeout)
-
-    def validate_value(self, value_str):
-        """Validate and convert value string to float"""
-        try:
-            if pd.isna(value_str):
-                return None
-            clean_value = str(value_str).replace('R$', '').strip()
-            if not clean_value:
-                return None
-            return float(clean_value.replace('.', '').replace(',', '.'))
-        except Exception as e:
-            print(f"Error validating value '{value_str}': {str(e)}")
-            return None
+        return self.name
+
+    @classmethod
+    @abstractmethod
+    def sniff(cls, rows):
+        """Whether the first rows of a file (lists of cells) are this layout.
+
+        Must be cheap: it runs on every upload before any parsing.
+        """
+
+    @abstractmethod
+    def parse(self, filepath):
+        """Read the file and return an iterator of Record.
+
+        The file is read and checked here, eagerly; the records are
+        produced lazily as the caller consumes them.
+        """
+
+    def classify(self, description, value):
+        """Transaction type (PIX RECEBIDO, TARIFA, ...) of an entry"""
+        return detect_transaction_type(description, value)
+
+    def reject(self, row, column, reason, value=''):
+        """Report a row left out of the import; returns None"""
+        self.rejected_count += 1
+        if len(self.rejected) < MAX_REJECTED:
+            self.rejected.append(Rejected(row, column, reason, str(value)[:200]))
+
+    def add_balance(self, row, position, date, balance_val):
+        """Keep the balance cell of row, position records into the file"""
+        balance = process_value(balance_val)
+        if balance is not None and date is not None:
+            self.balances.append(Balance(row, position, date, balance))
+
+    def check_balances(self, cents):
+        """Check the printed balances against cents, the amounts of the records.
 
-    def parse_date(self, value):
-        """Parse date with validation"""
-        try:
-            if pd.isna(value):
+        Rows where the running sum stops agreeing go to
+        balance_mismatches; returns the closing balance of each day that
+        does agree, as (cents, checked).
+        """
+        breaks, closing = check_running_balance(cents, self.balances)
+        if self.balances:
+            self.balance_checked = any(checked for _, checked in closing.values()) or bool(breaks)
+        self.balance_mismatches = [
+            Rejected(balance.row, 'saldo', 'saldo divergente',
+                     f'extrato {format_brl(round(balance.balance * 100))}, calculado {format_brl(expected)}')
+            for balance, expected in breaks
+        ]
+        return closing
+
+    def make_record(self, row, date_val, description, value):
+        """Record from the raw cells of row (its number in the file).
+
+        Blank rows, text-only rows (footers) and balance lines give None;
+        entries with a bad date, value or description are also rejected.
+        """
+        return self.check_row(row, process_date(date_val), cell_text(date_val),
+                              cell_text(description), process_value(value), cell_text(value))
+
+    def check_row(self, row, date, raw_date, description, value, raw_value):
+        """Record from parsed cells (date and value None when invalid)"""
+        if not raw_date and not raw_value:
+            return None
+        if date is None:
+            return self.reject(row, 'data', 'data inválida' if raw_date else 'data vazia', raw_date)
+        if not raw_value:
+            if description.upper().startswith('SALDO'):
                 return None
-            return pd.to_datetime(value, dayfirst=True).date()
-        except Exception as e:
-            print(f"Error parsing date '{value}': {str(e)}")
-            return None
\ No newline at end of file
+            return self.reject(row, 'valor', 'valor vazio')
+        if value is None:
+            return self.reject(row, 'valor', 'valor inválido', raw_value)
+        if not description:
+            return self.reject(row, 'descrição', 'descrição vazia')
+        return Record(date, description, value, extract_cnpj(description))
+
+class SheetReader(BankReader):
+    """Spreadsheet layout: a preamble, a header row, one entry per row.
+
+    Subclasses list the header cells that identify the layout and the
+    accepted names of the date, description and value columns.
+    """
+    header = []
+    date_columns = []
+    description_columns = []
+    value_columns = []
+    # Running balance; optional
+    balance_columns = []
+
+    @classmethod
+    def sniff(cls, rows):
+        return find_header(rows, cls.header) is not None
+
+    def parse(self, filepath):
+        with profiling.stage('read') as stage:
+            df = pd.read_excel(filepath, header=None)
+            stage.rows = len(df)
+
+        with profiling.stage('header_scan') as stage:
+            header_row = find_header(df.itertuples(index=False, name=None), self.header)
+            stage.rows = len(df) if header_row is None else header_row + 1
+        if header_row is None:
+            raise ValueError(f"Header '{self.header[0]}' não encontrado")
+
+        header = list(df.iloc[header_row])
+        columns = [column_index(header, names) for names in
+                   (self.date_columns, self.description_columns, self.value_columns)]
+        if None in columns:
+            raise ValueError(f"Colunas necessárias não encontradas. Colunas disponíveis: {header}")
+
+        self.account = statement_account(df.iloc[:header_row].itertuples(index=False, name=None))
+        body = df.iloc[header_row + 1:]
+        self.total_rows = len(body)
+        # Sheet rows are numbered from 1, the header is header_row + 1
+        return self.sheet_records(body, header_row + 2, *columns,
+                                  column_index(header, self.balance_columns))
+
+    def sheet_records(self, body, first_row, date_col, desc_col, value_col, balance_col=None):
+        position = 0
+        for number, row in enumerate(body.itertuples(index=False, name=None), first_row):
+            record = self.make_record(number, row[date_col], row[desc_col], row[value_col])
+            if record is not None:
+                position += 1
+                yield record
+            if balance_col is not None:
+                self.add_balance(number, position,
+                                 record.date if record is not None else process_date(row[date_col]),
+                                 row[balance_col])
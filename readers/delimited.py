@@ -0,0 +1,136 @@
+"""CSV exports of the spreadsheet layouts, parsed with the pandas C engine."""
+import csv
+import pandas as pd
+import profiling
+from cnpj import extract_cnpj
+from logs import get_logger
+from .base import (Balance, Record, SheetReader, cell_text, column_index, find_header, process_value,
+                   statement_account)
+from .registry import csv_delimiter, read_text_head
+
+logger = get_logger('readers')
+
+def csv_lines(filepath, encoding, delimiter, skip_lines):
+    """(file line number, fields) of each record after the first skip_lines lines"""
+    with open(filepath, encoding=encoding, errors='replace', newline='') as f:
+        for _ in range(skip_lines):
+            f.readline()
+        reader = csv.reader(f, delimiter=delimiter)
+        line = skip_lines + 1
+        for fields in reader:
+            yield line, fields
+            # A quoted field may span lines
+            line = skip_lines + reader.line_num + 1
+
+def numeric_column(column):
+    if pd.api.types.is_numeric_dtype(column):
+        return column
+    # Cells the C parser could not read as numbers (R$ prefixes, ...)
+    return column.map(process_value)
+
+class CsvReader(SheetReader):
+    """The layout of a SheetReader exported as CSV.
+
+    Combine with the bank's sheet reader, which supplies the header and
+    column names: class SantanderCsvReader(CsvReader, SantanderReader).
+    Only the needed columns are read; dates and pt-BR values (1.234,56)
+    are converted a column at a time.
+    """
+    extensions = ('csv',)
+
+    def parse(self, filepath):
+        with profiling.stage('header_scan') as stage:
+            lines, encoding = read_text_head(filepath)
+            delimiter = csv_delimiter(lines)
+            rows = list(csv.reader(lines, delimiter=delimiter))
+            header_row = find_header(rows, self.header)
+            stage.rows = len(rows) if header_row is None else header_row + 1
+        if header_row is None:
+            raise ValueError(f"Header '{self.header[0]}' não encontrado")
+
+        header = rows[header_row]
+        columns = [column_index(header, names) for names in
+                   (self.date_columns, self.description_columns, self.value_columns)]
+        if None in columns:
+            raise ValueError(f"Colunas necessárias não encontradas. Colunas disponíveis: {header}")
+        date_col, desc_col, value_col = columns
+        balance_col = column_index(header, self.balance_columns)
+        self.account = statement_account(rows[:header_row])
+
+        with profiling.stage('read') as stage:
+            df = pd.read_csv(
+                filepath, sep=delimiter, skiprows=header_row + 1, header=None,
+                usecols=columns + ([balance_col] if balance_col is not None else []),
+                dtype={date_col: str, desc_col: str},
+                decimal=',', thousands='.', encoding=encoding, engine='c', on_bad_lines='skip',
+                skip_blank_lines=False  # keeps the file line numbers for the report
+            )
+            stage.rows = len(df)
+
+        with profiling.stage('line_scan') as stage:
+            lines, keep = self.data_lines(filepath, encoding, delimiter, header_row + 1, len(header), len(df))
+            stage.rows = len(lines)
+        if keep is not None:
+            df = df.iloc[keep].reset_index(drop=True)
+
+        self.total_rows = len(df)
+        raw_dates = df[date_col]
+        dates = pd.to_datetime(raw_dates.str.strip(), format='%d/%m/%Y', errors='coerce')
+        raw_values = df[value_col]
+        values = numeric_column(raw_values)
+        if balance_col is not None:
+            self.csv_balances(lines, dates, df[desc_col], values, numeric_column(df[balance_col]))
+        return self.csv_records(lines, raw_dates, dates, df[desc_col], raw_values, values)
+
+    def data_lines(self, filepath, encoding, delimiter, skip_lines, width, rows):
+        """(file line number of each row to import, positions of those rows
+        among the rows pandas read, or None for all of them).
+
+        Lines with values past the width columns of the header are
+        malformed (a delimiter inside a field shifts the columns): they
+        are rejected with their line number, whether the C parser skipped
+        them (on_bad_lines='skip', too many fields for the first row) or
+        read them cut to the columns asked for.
+        """
+        lines = []
+        keep = []
+        bad = []
+        for position, (line, fields) in enumerate(csv_lines(filepath, encoding, delimiter, skip_lines)):
+            if len(fields) > width and any(field.strip() for field in fields[width:]):
+                bad.append((line, fields))
+            else:
+                lines.append(line)
+                keep.append(position)
+
+        if len(lines) + len(bad) == rows:
+            keep = keep if bad else None
+        elif len(lines) != rows:
+            logger.warning("Linhas de %s não conferem com as lidas (%s de %s); o relatório pode apontar "
+                           "linhas erradas", filepath, rows, len(lines) + len(bad))
+            return range(skip_lines + 1, skip_lines + 1 + rows), None
+        else:
+            keep = None  # skipped by the parser already
+
+        for line, fields in bad:
+            self.reject(line, 'linha', f'{len(fields)} colunas, esperadas {width}', delimiter.join(fields))
+        return lines, keep
+
+    def csv_balances(self, lines, dates, descriptions, values, balances):
+        """Balances of the saldo column, with the records before them counted
+        the way csv_records() produces them"""
+        described = descriptions.fillna('').astype(str).str.strip() != ''
+        positions = (dates.notna() & values.notna() & described).cumsum()
+        for index in (dates.notna() & balances.notna()).to_numpy().nonzero()[0]:
+            self.balances.append(Balance(lines[int(index)], int(positions.iat[index]),
+                                         dates.iat[index].date(), float(balances.iat[index])))
+
+    def csv_records(self, lines, raw_dates, dates, descriptions, raw_values, values):
+        rows = zip(lines, raw_dates, dates, descriptions, raw_values, values)
+        for number, raw_date, date, description, raw_value, value in rows:
+            description = description.strip() if isinstance(description, str) else ''
+            if not pd.isna(date) and not pd.isna(value) and description:
+                yield Record(date.date(), description, float(value), extract_cnpj(description))
+            else:
+                # Not an entry (blank, balance line) or a rejected one
+                self.check_row(number, None if pd.isna(date) else date.date(), cell_text(raw_date),
+                               description, None if pd.isna(value) else float(value), cell_text(raw_value))
@@ -0,0 +1,131 @@
+"""OFX statements, read as a stream of tag events.
+
+Works for OFX 1.x (SGML, leaf elements without closing tags) and 2.x
+(XML) alike: the file is scanned in chunks and each <STMTTRN> aggregate
+becomes a Record once its closing tag is seen, so memory does not grow
+with the statement.
+"""
+import html
+import re
+from datetime import datetime
+from cnpj import extract_cnpj
+from .base import Balance, BankReader, Record
+from .registry import text_encoding
+
+TAG_PATTERN = re.compile(r'<(/?)([A-Za-z0-9.]+)[^>]*>([^<]*)')
+
+# Characters read per step
+CHUNK_SIZE = 65536
+
+def ofx_encoding(head):
+    """Encoding declared in the OFX header (CHARSET/ENCODING or the XML declaration)"""
+    match = re.search(rb'encoding="([^"]+)"', head)
+    if match:
+        return match.group(1).decode('ascii')
+    match = re.search(rb'CHARSET:\s*(\d+)', head)
+    if match:
+        return 'cp' + match.group(1).decode('ascii')
+    if re.search(rb'ENCODING:\s*UTF-8', head):
+        return 'utf-8'
+    return text_encoding(head)
+
+def ofx_events(filepath, encoding):
+    """Yield (closing, TAG, text) for each tag of the file, in order"""
+    with open(filepath, encoding=encoding, errors='replace') as f:
+        buffer = ''
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            buffer += chunk
+            # The text of the last tag may continue in the next chunk
+            end = buffer.rfind('<') if chunk else len(buffer)
+            if end > 0:
+                for match in TAG_PATTERN.finditer(buffer, 0, end):
+                    yield match.group(1) == '/', match.group(2).upper(), match.group(3).strip()
+                buffer = buffer[end:]
+            if not chunk:
+                break
+
+def ofx_date(text):
+    """Date of an OFX datetime (YYYYMMDD[HHMMSS[.XXX]][[offset:TZ]])"""
+    try:
+        return datetime.strptime(text[:8], '%Y%m%d').date()
+    except ValueError:
+        return None
+
+def ofx_amount(text):
+    try:
+        return float(text.replace(',', '.'))
+    except ValueError:
+        return None
+
+class OfxReader(BankReader):
+    """OFX statement of the banks with one of bank_ids as BANKID.
+
+    Rejected rows are numbered by their position among the STMTTRN. The
+    account comes from BANKACCTFROM and the closing balance from LEDGERBAL.
+    """
+    extensions = ('ofx',)
+    bank_ids = ()  # without leading zeros
+
+    @classmethod
+    def sniff(cls, rows):
+        tags = [row[0] for row in rows if row]
+        if not any(tag.upper().startswith('<OFX') for tag in tags):
+            return False
+        for tag in tags:
+            match = re.match(r'<BANKID>\s*(\d+)', tag, re.IGNORECASE)
+            if match:
+                return match.group(1).lstrip('0') in cls.bank_ids
+        return False
+
+    def parse(self, filepath):
+        with open(filepath, 'rb') as f:
+            encoding = ofx_encoding(f.read(4096))
+        return self.ofx_records(filepath, encoding)
+
+    def ofx_records(self, filepath, encoding):
+        transaction = None
+        number = 0
+        position = 0
+        fields = {}  # leaf elements outside the transactions (account, balance)
+        available = False
+        for closing, tag, text in ofx_events(filepath, encoding):
+            if tag == 'STMTTRN':
+                if not closing:
+                    transaction = {}
+                    number += 1
+                elif transaction is not None:
+                    record = self.transaction_record(number, transaction)
+                    if record is not None:
+                        position += 1
+                        yield record
+                    transaction = None
+            elif transaction is not None and not closing and text:
+                transaction[tag] = html.unescape(text) if '&' in text else text
+            elif tag == 'AVAILBAL':
+                available = not closing  # its BALAMT is not the ledger balance
+            elif not closing and text and not available:
+                fields[tag] = text
+
+        if fields.get('ACCTID'):
+            self.account = '/'.join(filter(None, [fields.get('BRANCHID'), fields['ACCTID']]))
+        # Closing balance (LEDGERBAL), after the last transaction
+        balance = ofx_amount(fields.get('BALAMT', ''))
+        day = ofx_date(fields.get('DTASOF', ''))
+        if balance is not None and day is not None:
+            self.balances.append(Balance(number, position, day, balance))
+
+    def transaction_record(self, number, fields):
+        """Record of the number-th STMTTRN aggregate, or None (rejected) if incomplete"""
+        date = ofx_date(fields.get('DTPOSTED', ''))
+        if date is None:
+            return self.reject(number, 'DTPOSTED', 'data inválida' if fields.get('DTPOSTED') else 'data vazia',
+                               fields.get('DTPOSTED', ''))
+        value = ofx_amount(fields.get('TRNAMT', ''))
+        if value is None:
+            return self.reject(number, 'TRNAMT', 'valor inválido' if fields.get('TRNAMT') else 'valor vazio',
+                               fields.get('TRNAMT', ''))
+        description = fields.get('MEMO') or fields.get('NAME') or ''
+        if not description:
+            return self.reject(number, 'MEMO', 'descrição vazia')
+        return Record(date, description, value, extract_cnpj(description))
@@ -0,0 +1,108 @@
+"""Registry of the statement readers and layout detection.
+
+Readers register themselves with @register; detect_reader() picks the one
+whose sniff() accepts the first rows of an upload, without parsing it.
+"""
+import csv
+import os
+import re
+import pandas as pd
+from logs import get_logger
+
+logger = get_logger('readers')
+
+# Rows read to detect the layout; the headers sit within the preamble
+SNIFF_ROWS = 20
+# Bytes of a text file (CSV, OFX) read to detect the layout
+SNIFF_BYTES = 16384
+
+READERS = []  # reader classes, in registration order
+
+def register(cls):
+    """Class decorator adding a BankReader subclass to the registry"""
+    READERS.append(cls)
+    return cls
+
+def file_extension(filepath):
+    return os.path.splitext(filepath)[1].lstrip('.').lower()
+
+def get_reader(bank, filepath=None):
+    """New reader of a bank for the extension of filepath, or None"""
+    extension = file_extension(filepath) if filepath else None
+    for cls in READERS:
+        if cls.bank == bank and (extension is None or extension in cls.extensions):
+            return cls()
+    return None
+
+def supported_extensions():
+    return {extension for cls in READERS for extension in cls.extensions}
+
+def text_encoding(data):
+    """Encoding of the start of a text export: UTF-8, else Windows-1252"""
+    try:
+        data.decode('utf-8')
+        return 'utf-8-sig'
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut at the end of the sample is still UTF-8
+        if e.start >= len(data) - 3:
+            return 'utf-8-sig'
+        return 'cp1252'
+
+def read_text_head(filepath, size=SNIFF_BYTES):
+    """First complete lines of a text file and its encoding"""
+    with open(filepath, 'rb') as f:
+        data = f.read(size)
+    encoding = text_encoding(data)
+    text = data.decode(encoding, errors='replace')
+    lines = text.splitlines()
+    if len(data) == size and lines:
+        lines.pop()  # probably cut in the middle
+    return lines, encoding
+
+def csv_delimiter(lines):
+    """Most frequent of ; , and tab in the lines (bank exports use ;)"""
+    sample = '\n'.join(lines)
+    return max([';', ',', '\t'], key=sample.count)
+
+def read_excel_head(filepath, rows):
+    df = pd.read_excel(filepath, header=None, nrows=rows)
+    return [list(row) for row in df.itertuples(index=False, name=None)]
+
+def read_csv_head(filepath, rows):
+    lines, _ = read_text_head(filepath)
+    return list(csv.reader(lines[:rows], delimiter=csv_delimiter(lines[:rows])))
+
+def read_ofx_head(filepath, rows):
+    # Tags may all be on one line; one row per tag so sniff() sees them
+    lines, _ = read_text_head(filepath)
+    return [[tag] for tag in re.findall(r'<[^<]*', '\n'.join(lines))]
+
+# extension -> function(filepath, rows) returning the first rows as cell lists
+HEAD_READERS = {
+    'xls': read_excel_head,
+    'xlsx': read_excel_head,
+    'csv': read_csv_head,
+    'ofx': read_ofx_head
+}
+
+def read_head(filepath, rows=SNIFF_ROWS):
+    read = HEAD_READERS.get(file_extension(filepath))
+    if read is None:
+        return []
+    return read(filepath, rows)
+
+def detect_reader(filepath):
+    """New reader for the layout of a file, or None if no reader knows it"""
+    extension = file_extension(filepath)
+    candidates = [cls for cls in READERS if extension in cls.extensions]
+    if not candidates:
+        return None
+    try:
+        head = read_head(filepath)
+    except Exception as e:
+        logger.warning("Erro ao ler o início de %s: %s", filepath, e)
+        return None
+    for cls in candidates:
+        if cls.sniff(head):
+            return cls()
+    return None
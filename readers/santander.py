@@ -1,26 +1,24 @@
-import os
-from .base import BankReader
-from read_excel import process_excel_file
+from .base import SheetReader
+from .delimited import CsvReader
+from .ofx import OfxReader
+from .registry import register
 
-class SantanderReader(BankReader):
-    def __init__(self):
-        super().__init__()
-        self.name = "Santander"
-        self.type_mapping = {
-            'PIX RECEBIDO': ['PIX RECEBIDO'],
-            'PIX ENVIADO': ['PIX ENVIADO'],
-            'TED RECEBIDA': ['TED RECEBIDA', 'TED CREDIT'],
-            'TED ENVIADA': ['TED ENVIADA', 'TED DEBIT'],
-            'PAGAMENTO': ['PAGAMENTO', 'PGTO', 'PAG'],
-            'TARIFA': ['TARIFA', 'TAR'],
-            'IOF': ['IOF'],
-            'RESGATE': ['RESGATE']
-        }
+@register
+class SantanderReader(SheetReader):
+    name = "Santander"
+    bank = 'santander'
+    header = ['Data', 'Histórico']
+    date_columns = ['Data']
+    description_columns = ['Histórico']
+    value_columns = ['Valor (R$)', 'Valor']
+    balance_columns = ['Saldo (R$)', 'Saldo']
 
-    def get_bank_name(self):
-        return self.name
+@register
+class SantanderCsvReader(CsvReader, SantanderReader):
+    pass
 
-    def process_file(self, filepath, process_id, upload_progress):
-        """Call common process_file_with_progress logic"""
-        from app import process_file_with_progress
-        return process_file_with_progress(filepath, process_id)
\ No newline at end of file
+@register
+class SantanderOfxReader(OfxReader):
+    name = "Santander"
+    bank = 'santander'
+    bank_ids = ('33',)
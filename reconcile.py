@@ -0,0 +1,151 @@
+"""Intercompany transfer reconciliation.
+
+A transfer between two AF group accounts is in the ledger twice: as a
+debit in the statement of the paying company and as a credit in the one
+of the receiving company. After each import the new internal entries are
+hash-joined on the amount with the unmatched internal entries already
+stored, within TRANSFER_WINDOW_DAYS, and each pair found is recorded in
+transfer_matches. The internal view counts a matched transfer once.
+Both legs of a transfer never come from the same import.
+"""
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import timedelta
+import db
+from fts import description_match
+
+AF_COMPANIES = {
+    '50389827000107': 'AF ENERGY SOLAR 360',
+    '43077430000114': 'AF 360 CORRETORA DE SEGUROS LTDA',
+    '53720093000195': 'AF CREDITO BANK',
+    '55072511000100': 'AF COMERCIO DE CALCADOS LTDA',
+    '17814862000150': 'AF 360 FRANQUIAS LTDA'
+}
+
+# Description markers of the AF group companies excluded from the external views
+AF_DESCRIPTION_EXCLUSIONS = [
+    'AF ENERGY SOLAR 360',
+    'AF 360 CORRETORA DE SEGUROS',
+    'AF CREDITO BANK',
+    'AF COMERCIO DE CALCADOS',
+    'AF 360 FRANQUIAS',
+    'AF 360 CORRETORA'
+]
+
+# Extra description markers that identify internal transactions
+AF_INTERNAL_MARKERS = ['AF 360', 'AF ENERGY', 'AF CREDITO', 'AF COMERCIO', 'AF 360 CORRETORA']
+
+# Days between the two legs of a transfer (TED settled the next business day)
+TRANSFER_WINDOW_DAYS = 3
+
+def shift_day(day, days):
+    return db.date_to_day(db.day_to_date(day) + timedelta(days=days))
+
+def internal_match(alias='t'):
+    """SQL condition (and params) for the entries with an AF group company"""
+    markers, marker_params = description_match(
+        list(AF_COMPANIES.values()) + AF_INTERNAL_MARKERS, alias=alias)
+    condition = '({alias}.document IN ({af_companies}) OR {markers})'.format(
+        alias=alias, af_companies=','.join(['?' for _ in AF_COMPANIES]), markers=markers)
+    return condition, list(AF_COMPANIES.keys()) + marker_params
+
+def match_legs(debits, credits, window=TRANSFER_WINDOW_DAYS, import_of=None):
+    """Pair debits with credits of the same amount at most window days apart.
+
+    Both are lists of (id, day, amount_cents). The credits are hashed by
+    amount; each debit, oldest first, takes the closest credit of its
+    bucket (the lowest id on ties). import_of, if given, maps an entry id
+    to its import (None when unknown); legs of the same import are not
+    paired. Returns (debit_id, credit_id, amount_cents, debit_day,
+    credit_day) tuples.
+    """
+    import_of = import_of or (lambda entry_id: None)
+    buckets = defaultdict(list)
+    for credit_id, day, cents in credits:
+        buckets[cents].append((db.day_to_date(day).toordinal(), credit_id, day, import_of(credit_id)))
+
+    matches = []
+    for debit_id, day, cents in sorted(debits, key=lambda leg: (leg[1], leg[0])):
+        bucket = buckets.get(-cents)
+        if not bucket:
+            continue
+        ordinal = db.day_to_date(day).toordinal()
+        debit_import = import_of(debit_id)
+        best = None
+        for index, (credit_ordinal, credit_id, _, credit_import) in enumerate(bucket):
+            if debit_import is not None and credit_import == debit_import:
+                continue
+            distance = abs(credit_ordinal - ordinal)
+            if distance <= window and (best is None or (distance, credit_id) < best[:2]):
+                best = (distance, credit_id, index)
+        if best is not None:
+            _, credit_id, credit_day, _ = bucket.pop(best[2])
+            matches.append((debit_id, credit_id, -cents, day, credit_day))
+    return matches
+
+UNMATCHED = '''
+    NOT EXISTS (SELECT 1 FROM transfer_matches m WHERE m.debit_id = t.id)
+    AND NOT EXISTS (SELECT 1 FROM transfer_matches m WHERE m.credit_id = t.id)
+'''
+
+def internal_legs(conn, where, params):
+    """Unmatched internal entries satisfying where, split into (debits, credits)"""
+    internal, internal_params = internal_match()
+    rows = conn.execute(f'''
+        SELECT t.id, t.day, t.amount_cents FROM ledger t
+        WHERE {internal} AND {UNMATCHED} AND {where}
+    ''', internal_params + list(params)).fetchall()
+    debits = [tuple(row) for row in rows if row[2] < 0]
+    credits = [tuple(row) for row in rows if row[2] > 0]
+    return debits, credits
+
+def store_matches(conn, matches):
+    conn.executemany('''
+        INSERT INTO transfer_matches (debit_id, credit_id, amount_cents, debit_day, credit_day)
+        VALUES (?, ?, ?, ?, ?)
+    ''', matches)
+    return len(matches)
+
+def match_transfers(conn, ranges):
+    """Writer command: match the entries of an import, given as (first, last) id ranges.
+
+    The new legs are only paired with entries of earlier imports: both
+    legs of a transfer never come from the same statement.
+    """
+    if not ranges:
+        return 0
+    in_ranges = ' OR '.join(['t.id BETWEEN ? AND ?' for _ in ranges])
+    new_debits, new_credits = internal_legs(
+        conn, f'({in_ranges})', [bound for id_range in ranges for bound in id_range])
+    new_legs = new_debits + new_credits
+    if not new_legs:
+        return 0
+
+    first_day = shift_day(min(leg[1] for leg in new_legs), -TRANSFER_WINDOW_DAYS)
+    last_day = shift_day(max(leg[1] for leg in new_legs), TRANSFER_WINDOW_DAYS)
+    new_ids = {leg[0] for leg in new_legs}
+    old_debits, old_credits = internal_legs(conn, 't.day BETWEEN ? AND ?', [first_day, last_day])
+    old_debits = [leg for leg in old_debits if leg[0] not in new_ids]
+    old_credits = [leg for leg in old_credits if leg[0] not in new_ids]
+
+    return store_matches(conn, match_legs(new_debits, old_credits) + match_legs(old_debits, new_credits))
+
+def import_lookup(conn):
+    """Function giving the import (job id) of a ledger id, from the id
+    ranges of import_batches; None for entries of no known import"""
+    ranges = conn.execute('SELECT first_id, last_id, job_id FROM import_batches ORDER BY first_id').fetchall()
+    firsts = [first_id for first_id, _, _ in ranges]
+
+    def import_of(entry_id):
+        index = bisect_right(firsts, entry_id) - 1
+        if index >= 0 and entry_id <= ranges[index][1]:
+            return ranges[index][2]
+        return None
+    return import_of
+
+def match_all(conn):
+    """Writer command: match every unmatched internal entry (entries imported
+    before matching existed, or whose other leg came later), never two legs
+    of the same import"""
+    debits, credits = internal_legs(conn, '1=1', [])
+    return store_matches(conn, match_legs(debits, credits, import_of=import_lookup(conn)))
@@ -0,0 +1,165 @@
+"""Background scheduler of the periodic maintenance tasks.
+
+Tasks are registered with @periodic(name, seconds) and run by one
+scheduler thread per process, checked every TICK seconds. Shared tasks
+(the default) work on the database and run in one process at a time: the
+one holding the lease in scheduler_lease, renewed at every tick and taken
+over by another gunicorn worker once it expires. Local tasks clean up
+state kept in the memory of each process, so every process runs them.
+
+The start, duration and result of the last run of each shared task are
+kept in scheduler_runs; those of the local tasks stay in the memory of the
+process, which would otherwise write a row every few seconds per worker
+(/api/scheduler shows them as run by the worker answering).
+"""
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime
+import db
+import metrics
+import writer
+from logs import get_logger
+
+logger = get_logger('scheduler')
+
+# Seconds between checks for due tasks
+TICK = 15
+# Seconds the lease lasts without being renewed (a dead holder is replaced after this)
+LEASE_SECONDS = 120
+
+Task = namedtuple('Task', ['name', 'interval', 'func', 'local'])
+
+TASKS = {}
+
+_local_runs = {}  # name -> last run of the local tasks in this process (as in scheduler_runs)
+_thread = None
+_pid = None
+_start_lock = threading.Lock()
+
+def periodic(name, interval, local=False):
+    """Register func() to run every interval seconds"""
+    def decorator(func):
+        TASKS[name] = Task(name, interval, func, local)
+        return func
+    return decorator
+
+def acquire_lease(conn, owner, now):
+    """Writer command: take or renew the lease; whether owner holds it"""
+    return conn.execute('''
+        UPDATE scheduler_lease SET owner = ?, expires_at = ?
+        WHERE id = 1 AND (owner = ? OR owner IS NULL OR expires_at < ?)
+    ''', (owner, now + LEASE_SECONDS, owner, now)).rowcount == 1
+
+def record_run(conn, name, started_at, duration, status, message):
+    conn.execute('''
+        INSERT INTO scheduler_runs (name, started_at, duration, status, message, pid, runs)
+        VALUES (?, ?, ?, ?, ?, ?, 1)
+        ON CONFLICT(name) DO UPDATE SET
+            started_at = excluded.started_at, duration = excluded.duration,
+            status = excluded.status, message = excluded.message, pid = excluded.pid,
+            runs = scheduler_runs.runs + 1
+    ''', (name, started_at, duration, status, message, os.getpid()))
+
+def last_runs():
+    """name -> datetime of the last run of each shared task, in any process"""
+    conn = db.get_connection()
+    rows = conn.execute('SELECT name, started_at FROM scheduler_runs').fetchall()
+    return {row['name']: datetime.fromisoformat(row['started_at']) for row in rows}
+
+def is_due(task, last_run, now):
+    return last_run is None or (now - last_run).total_seconds() >= task.interval
+
+def run_task(task):
+    """Run a task now, recording its run; errors are logged, not raised"""
+    started = datetime.now()
+    start = time.perf_counter()
+    status, message = 'ok', None
+    try:
+        result = task.func()
+        if result is not None:
+            message = str(result)
+    except Exception as e:
+        status, message = 'error', str(e)
+        logger.exception("Erro na tarefa agendada %s", task.name)
+    duration = time.perf_counter() - start
+
+    metrics.SCHEDULER_TASK_DURATION.observe(duration, task=task.name, status=status)
+    if task.local:
+        previous = _local_runs.get(task.name, {})
+        _local_runs[task.name] = {
+            'started_at': started.isoformat(timespec='seconds'),
+            'duration': duration,
+            'status': status,
+            'message': message,
+            'pid': os.getpid(),
+            'runs': previous.get('runs', 0) + 1
+        }
+    else:
+        writer.run(record_run, task.name, started.isoformat(timespec='seconds'), duration, status, message)
+    return status
+
+def run_due_tasks(owner):
+    """Run the tasks due now; shared ones only while owner holds the lease"""
+    holder = writer.run(acquire_lease, owner, time.time())
+    shared_runs = last_runs() if holder else {}
+    for task in list(TASKS.values()):
+        now = datetime.now()
+        if task.local:
+            last_run = _local_runs.get(task.name)
+            if is_due(task, last_run and datetime.fromisoformat(last_run['started_at']), now):
+                run_task(task)
+        elif holder and is_due(task, shared_runs.get(task.name), now):
+            run_task(task)
+            # A long task must not let the lease lapse
+            holder = writer.run(acquire_lease, owner, time.time())
+
+def scheduler_loop():
+    owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+    while True:
+        time.sleep(TICK)
+        try:
+            run_due_tasks(owner)
+        except Exception:
+            logger.exception("Erro no agendador")
+
+def start():
+    """Start the scheduler thread of this process (again after a fork)"""
+    global _thread, _pid
+    with _start_lock:
+        if _thread is not None and _pid == os.getpid():
+            return
+        _pid = os.getpid()
+        _local_runs.clear()
+        _thread = threading.Thread(target=scheduler_loop, name='scheduler', daemon=True)
+        _thread.start()
+
+def status():
+    """Tasks with their interval and last run, and the lease holder"""
+    conn = db.get_connection()
+    runs = {row['name']: dict(row) for row in conn.execute('SELECT * FROM scheduler_runs')}
+    lease = conn.execute('SELECT owner, expires_at FROM scheduler_lease WHERE id = 1').fetchone()
+    tasks = []
+    for task in TASKS.values():
+        run = _local_runs.get(task.name, {}) if task.local else runs.get(task.name, {})
+        tasks.append({
+            'name': task.name,
+            'interval': task.interval,
+            'local': task.local,
+            'last_run': run.get('started_at'),
+            'duration': run.get('duration'),
+            'status': run.get('status'),
+            'message': run.get('message'),
+            'pid': run.get('pid'),
+            'runs': run.get('runs', 0)
+        })
+    holder = None
+    if lease is not None and lease['owner'] and lease['expires_at'] > time.time():
+        holder = {
+            'owner': lease['owner'],
+            'expires_at': datetime.fromtimestamp(lease['expires_at']).isoformat(timespec='seconds')
+        }
+    return {'tasks': tasks, 'lease': holder}
@@ -0,0 +1,134 @@
+"""Single writer: one thread per process owns the write connection.
+
+Code that changes the database submits commands, functions called as
+func(conn, *args) on the writer connection, and gets a Future of their
+result. The writer takes every command queued at that moment (up to
+MAX_BATCH) and runs them in one transaction, each in its own savepoint:
+a failing command is rolled back alone and its future gets the
+exception, the others are committed together (group commit). Commands
+must not commit or roll back themselves.
+
+With a single writer per process the imports, the job records and the
+CNPJ enrichment never wait on each other's locks; busy_timeout (db.py)
+still covers other processes, e.g. migrations of another worker.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import db
+import metrics
+from logs import get_logger
+
+logger = get_logger('writer')
+
+# Commands committed together at most
+MAX_BATCH = 256
+# Seconds to wait for more commands once the first of a batch arrives
+GROUP_COMMIT_WAIT = 0.002
+
+_queue = queue.Queue()
+_thread = None
+_pid = None
+_start_lock = threading.Lock()
+
+def submit(func, *args):
+    """Queue func(conn, *args) for the writer; returns a Future of its result"""
+    future = Future()
+    ensure_started()
+    _queue.put((func, args, future))
+    return future
+
+def run(func, *args):
+    """submit() and wait for the result (re-raising the command's error)"""
+    return submit(func, *args).result()
+
+def execute(sql, parameters=()):
+    """Future of the rowcount of one statement"""
+    return submit(execute_command, sql, parameters)
+
+def executemany(sql, seq_of_parameters):
+    """Future of the rowcount of a statement run for each parameter tuple"""
+    return submit(executemany_command, sql, list(seq_of_parameters))
+
+def execute_command(conn, sql, parameters):
+    return conn.execute(sql, parameters).rowcount
+
+def executemany_command(conn, sql, seq_of_parameters):
+    return conn.executemany(sql, seq_of_parameters).rowcount
+
+def ensure_started():
+    global _thread, _pid, _queue
+    if _thread is not None and _pid == os.getpid():
+        return
+    with _start_lock:
+        if _thread is not None and _pid == os.getpid():
+            return
+        if _pid is not None:
+            # Forked (gunicorn worker): the thread did not come along and
+            # the queue may hold the parent's commands
+            _queue = queue.Queue()
+        _pid = os.getpid()
+        _thread = threading.Thread(target=writer_loop, args=(_queue,), name='db-writer', daemon=True)
+        _thread.start()
+
+def next_batch(commands):
+    """Block for one command, then take those queued right after it"""
+    batch = [commands.get()]
+    deadline = time.monotonic() + GROUP_COMMIT_WAIT
+    while len(batch) < MAX_BATCH:
+        try:
+            batch.append(commands.get(timeout=max(deadline - time.monotonic(), 0)))
+        except queue.Empty:
+            break
+    return batch
+
+def writer_loop(commands):
+    conn = path = None
+    while True:
+        # Cancelled commands are dropped; the others can no longer be cancelled
+        batch = [command for command in next_batch(commands) if command[2].set_running_or_notify_cancel()]
+        if not batch:
+            continue
+        try:
+            if conn is None or path != db.DATABASE_PATH:
+                # First batch, or the database was switched (benchmarks)
+                if conn is not None:
+                    conn.release()
+                    conn = None
+                path = db.DATABASE_PATH
+                conn = db.connect(path)
+            results = run_batch(conn, batch)
+        except Exception as e:
+            # The transaction itself failed: nothing of the batch was written
+            logger.exception("Erro ao gravar lote de %s comandos", len(batch))
+            if conn is not None and conn.in_transaction:
+                conn.rollback()
+            for _, _, future in batch:
+                future.set_exception(e)
+            continue
+        for (_, _, future), (ok, value) in zip(batch, results):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+def run_batch(conn, batch):
+    """Run the commands in one transaction; (ok, result or error) per command"""
+    results = []
+    start = time.perf_counter()
+    conn.execute('BEGIN IMMEDIATE')
+    for func, args, _ in batch:
+        conn.execute('SAVEPOINT command')
+        try:
+            results.append((True, func(conn, *args)))
+            conn.execute('RELEASE command')
+        except Exception as e:
+            conn.execute('ROLLBACK TO command')
+            conn.execute('RELEASE command')
+            results.append((False, e))
+    conn.commit()
+    metrics.WRITER_BATCH_SIZE.observe(len(batch))
+    metrics.WRITER_COMMIT_DURATION.observe(time.perf_counter() - start)
+    return results